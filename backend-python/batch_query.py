@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+离线批量域名查询
+从 RULES_DIR 中保存的原始规则或编译索引快照加载规则，不启动 Web 服务、不访问网络，
+用进程池并行查询，输出与 /api/query/domain 相同判定语义的 CSV 或 NDJSON
+
+用法:
+    python3 batch_query.py domains.txt                     # 从 RULES_DIR 加载，输出 NDJSON
+    cat domains.txt | python3 batch_query.py - -f csv -o result.csv
+    python3 batch_query.py --save-snapshot index.pkl       # 只编译并保存索引快照
+    python3 batch_query.py --snapshot index.pkl domains.txt --blocked-only
+"""
+
+import argparse
+import csv
+import io
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="离线批量查询域名是否被规则拦截")
+    parser.add_argument('inputs', nargs='*', help="域名文件，每行一个；'-' 表示标准输入")
+    parser.add_argument('--rules-dir', help="原始规则目录（默认使用 RULES_DIR 环境变量）")
+    parser.add_argument('--sources', help="规则源配置文件（默认使用 RULE_SOURCES_CONFIG_FILE 环境变量）")
+    parser.add_argument('--snapshot', help="从编译索引快照加载，而不是解析原始规则")
+    parser.add_argument('--save-snapshot', help="加载后把编译索引保存到该文件")
+    parser.add_argument('-f', '--format', choices=['ndjson', 'csv'], default='ndjson', help="输出格式")
+    parser.add_argument('-o', '--output', help="输出文件（默认标准输出）")
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count() or 1, help="工作进程数")
+    parser.add_argument('--chunk-size', type=int, default=5000, help="每个任务包含的域名数")
+    parser.add_argument('--blocked-only', action='store_true', help="只输出被拦截的域名")
+    parser.add_argument('-v', '--verbose', action='store_true', help="输出加载日志")
+    return parser.parse_args()
+
+
+def import_backend(args):
+    """按命令行参数设置环境变量后再导入 main，保证 RULES_DIR 等配置生效"""
+    if args.rules_dir:
+        os.environ['RULES_DIR'] = os.path.abspath(args.rules_dir)
+    if args.sources:
+        os.environ['RULE_SOURCES_CONFIG_FILE'] = os.path.abspath(args.sources)
+    sys.path.insert(0, BACKEND_DIR)
+    os.makedirs('logs', exist_ok=True)
+    import main
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    return main
+
+
+def load_index(main, args) -> int:
+    if args.snapshot:
+        return main.load_compiled_snapshot(args.snapshot)
+    sources = main.load_rule_sources()
+    for source in sources:
+        main.register_rule_source(source)
+    main.load_rules_snapshot(sources)
+    return len(main.compiled_rules)
+
+
+def iter_domains(inputs):
+    for path in inputs:
+        f = sys.stdin if path == '-' else open(path, 'r', encoding='utf-8', errors='replace')
+        try:
+            for line in f:
+                domain = line.strip().lower()
+                if domain and not domain.startswith('#'):
+                    yield domain
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+
+def iter_chunks(domains, size):
+    chunk = []
+    for domain in domains:
+        chunk.append(domain)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+CSV_FIELDS = ['domain', 'blocked', 'matched_rule', 'rule_type', 'rule_source', 'matched_sources', 'exceptions']
+
+# 工作进程中的状态，fork 时直接继承父进程已加载的索引
+_main = None
+_options = None
+
+
+def _init_worker(args):
+    global _main, _options
+    _options = args
+    _main = import_backend(args)
+    if not _main.compiled_rules:
+        # spawn 启动方式下需要在子进程中重新加载
+        load_index(_main, args)
+
+
+def _format_result(result, fmt: str) -> str:
+    if fmt == 'ndjson':
+        return _main.dumps_json(result.to_dict()).decode('utf-8') + '\n'
+    buf = io.StringIO()
+    csv.writer(buf).writerow([
+        result.domain,
+        'true' if result.blocked else 'false',
+        result.matched_rule or '',
+        result.rule_type or '',
+        result.rule_source or '',
+        ';'.join(_main.get_rule_source_name(url) for _, url, _ in result.matches),
+        len(result.exceptions)
+    ])
+    return buf.getvalue()
+
+
+def process_chunk(chunk):
+    """查询一批域名，返回 (格式化后的输出, 有效域名数, 拦截数, 无效域名数)"""
+    out, valid, blocked, invalid = [], 0, 0, 0
+    for domain in chunk:
+        if not _main.is_valid_domain(domain):
+            invalid += 1
+            continue
+        # 与 query_domain_internal 相同的判定，离线时绕过查询缓存
+        result = _main.evaluate_domain(domain)
+        valid += 1
+        if result.blocked:
+            blocked += 1
+        elif _options.blocked_only:
+            continue
+        out.append(_format_result(result, _options.format))
+    return ''.join(out), valid, blocked, invalid
+
+
+def main_cli():
+    args = parse_args()
+    start = time.time()
+    main = import_backend(args)
+    loaded = load_index(main, args)
+    counts = main.count_compiled_rules()
+    print(f"已加载 {loaded} 个规则源, 规则 {sum(counts.values()):,} 条, 耗时 {time.time() - start:.1f}s",
+          file=sys.stderr)
+    if not loaded:
+        print("没有可用的规则，请先运行服务下载规则或指定 --snapshot", file=sys.stderr)
+        return 1
+
+    if args.save_snapshot:
+        main.save_compiled_snapshot(args.save_snapshot)
+        print(f"已保存编译索引快照: {args.save_snapshot}", file=sys.stderr)
+    if not args.inputs:
+        return 0
+
+    out = open(args.output, 'w', encoding='utf-8', newline='') if args.output else sys.stdout
+    if args.format == 'csv':
+        csv.writer(out).writerow(CSV_FIELDS)
+
+    total = blocked_total = invalid_total = 0
+    query_start = time.time()
+    chunks = iter_chunks(iter_domains(args.inputs), max(1, args.chunk_size))
+    try:
+        if args.workers <= 1:
+            _init_worker(args)
+            results = map(process_chunk, chunks)
+            pool = None
+        else:
+            methods = multiprocessing.get_all_start_methods()
+            ctx = multiprocessing.get_context('fork' if 'fork' in methods else 'spawn')
+            pool = ctx.Pool(args.workers, initializer=_init_worker, initargs=(args,))
+            results = pool.imap(process_chunk, chunks)
+        for text, valid, blocked, invalid in results:
+            out.write(text)
+            total += valid
+            blocked_total += blocked
+            invalid_total += invalid
+        if pool is not None:
+            pool.close()
+            pool.join()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    elapsed = time.time() - query_start
+    rate = total / elapsed if elapsed > 0 else 0
+    print(
+        f"查询 {total:,} 个域名, 拦截 {blocked_total:,}, 无效 {invalid_total:,}, "
+        f"耗时 {elapsed:.1f}s, {rate:,.0f} 个/秒 ({args.workers} 个进程)",
+        file=sys.stderr
+    )
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
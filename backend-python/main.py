@@ -4,30 +4,114 @@ import time
 import threading
 import os
 import hashlib
+import sys
 import json
+import heapq
+import itertools
+import queue
+import random
+import gzip
+import pickle
+import tempfile
+import select
+import hmac
+import tracemalloc
+import math
+import socket
+import subprocess
 from urllib.parse import urlparse
 from datetime import datetime
 from typing import List, Dict, Optional, Set, Union, Any
-from urllib.parse import urlparse
 import logging
+import logging.handlers
+import atexit
+try:
+    from re import _parser as _sre_parser, _constants as _sre_constants
+except ImportError:  # Python < 3.11
+    import sre_parse as _sre_parser
+    import sre_constants as _sre_constants
 
 import requests
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Request
+from fastapi.responses import StreamingResponse, FileResponse, Response, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from cachetools import TTLCache
-import schedule
+try:
+    import orjson
+except ImportError:  # 未安装时退回标准库 json
+    orjson = None
 
 # 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('logs/backend.log'),
-        logging.StreamHandler()
-    ]
-)
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text').lower()  # text 或 json
+LOG_FILE = os.environ.get('LOG_FILE', 'logs/backend.log')
+ACCESS_LOG_SAMPLE_RATE = min(1.0, max(0.0, float(os.environ.get('ACCESS_LOG_SAMPLE_RATE', 0))))
+
+class JsonLogFormatter(logging.Formatter):
+    """每条日志输出一行 JSON，extra={'fields': {...}} 中的字段并入顶层"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage()
+        }
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """
+    日志经队列交给后台线程写入，请求处理与规则更新线程不会因磁盘刷写而阻塞
+    """
+    if LOG_FORMAT == 'json':
+        formatter = JsonLogFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handlers = [logging.StreamHandler()]
+    if LOG_FILE:
+        os.makedirs(os.path.dirname(LOG_FILE) or '.', exist_ok=True)
+        handlers.append(logging.FileHandler(LOG_FILE))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # 退出时写完队列中剩余的日志
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
+access_logger = logging.getLogger(f"{__name__}.access")
+
+def access_log_sampled() -> bool:
+    """按 ACCESS_LOG_SAMPLE_RATE 决定是否记录本次查询，默认关闭"""
+    return ACCESS_LOG_SAMPLE_RATE > 0 and random.random() < ACCESS_LOG_SAMPLE_RATE
+
+def log_query_access(path: str, domain: str, cache: str, started: float, blocked: Optional[bool] = None):
+    """记录一条查询访问日志：耗时与缓存状态（hit/miss/not_modified）"""
+    duration_ms = round((time.perf_counter() - started) * 1000, 3)
+    access_logger.info(
+        f"{path} {domain} cache={cache} blocked={blocked} duration={duration_ms}ms",
+        extra={'fields': {
+            'path': path, 'domain': domain, 'cache': cache,
+            'blocked': blocked, 'durationMs': duration_ms
+        }}
+    )
 
 # 创建FastAPI应用
 app = FastAPI(
@@ -36,15 +120,6 @@ app = FastAPI(
     version="1.0.0"
 )
 
-# 配置CORS
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
 # 数据模型
 class RuleSource(BaseModel):
     url: str
@@ -53,12 +128,12 @@ class RuleSource(BaseModel):
     last_updated: Optional[int] = None
     rule_count: int = 0
     status: str = "未更新"
-
-class MatchedRule(BaseModel):
-    rule: str
-    rule_source: str
-    rule_source_url: str
-    rule_type: str
+    # 调度相关: refresh_interval 为配置文件中的覆盖值(秒)，priority 越小越先更新
+    refresh_interval: Optional[int] = None
+    priority: int = 0
+    expires: Optional[int] = None  # 规则列表头部 "! Expires:" 声明的更新周期(秒)
+    next_update: Optional[int] = None
+    failure_count: int = 0
 
 class SearchResult(BaseModel):
     rule: str
@@ -66,16 +141,78 @@ class SearchResult(BaseModel):
     rule_source_url: str
     rule_type: str
 
-class DomainQueryResult(BaseModel):
-    domain: str
-    blocked: bool
-    matched_rules: List[MatchedRule] = []
-    # 保留向后兼容性
-    matched_rule: Optional[str] = None
-    rule_source: Optional[str] = None
-    rule_type: Optional[str] = None
-    query_time: int
-    duration: int
+class DomainQueryResult:
+    """
+    查询结果的紧凑表示，查询路径上不构造 pydantic 对象。命中与例外都是元组，
+    规则源只记录 URL，名称在序列化时解析：
+    matches: (规则, 规则源URL, 类型)；exceptions: (白名单规则, 类型, 被覆盖的规则, 被覆盖规则类型, 规则源URL)
+    """
+    __slots__ = ('domain', 'matches', 'exceptions', 'query_time', 'duration')
+
+    def __init__(self, domain: str, matches: tuple = (), exceptions: tuple = (),
+                 query_time: int = 0, duration: int = 0):
+        self.domain = domain
+        self.matches = matches
+        self.exceptions = exceptions
+        self.query_time = query_time
+        self.duration = duration
+
+    @property
+    def blocked(self) -> bool:
+        return bool(self.matches)
+
+    # 保留向后兼容性：第一个匹配的规则
+    @property
+    def matched_rule(self) -> Optional[str]:
+        return self.matches[0][0] if self.matches else None
+
+    @property
+    def rule_source(self) -> Optional[str]:
+        return get_rule_source_name(self.matches[0][1]) if self.matches else None
+
+    @property
+    def rule_type(self) -> Optional[str]:
+        return self.matches[0][2] if self.matches else None
+
+    def to_dict(self) -> dict:
+        """按接口原有字段与顺序输出"""
+        name = get_rule_source_name
+        matched = [
+            {'rule': rule, 'rule_source': name(url), 'rule_source_url': url, 'rule_type': rule_type}
+            for rule, url, rule_type in self.matches
+        ]
+        first = matched[0] if matched else None
+        return {
+            'domain': self.domain,
+            'blocked': bool(matched),
+            'matched_rules': matched,
+            'exceptions': [
+                {
+                    'rule': rule, 'rule_type': rule_type,
+                    'overridden_rule': overridden, 'overridden_rule_type': overridden_type,
+                    'rule_source': name(url), 'rule_source_url': url
+                }
+                for rule, rule_type, overridden, overridden_type, url in self.exceptions
+            ],
+            'matched_rule': first['rule'] if first else None,
+            'rule_source': first['rule_source'] if first else None,
+            'rule_type': first['rule_type'] if first else None,
+            'query_time': self.query_time,
+            'duration': self.duration
+        }
+
+    def to_pairs(self) -> list:
+        """单域名查询接口的 data 为 [字段, 值] 列表"""
+        return [[key, value] for key, value in self.to_dict().items()]
+
+    def to_cache(self) -> list:
+        """共享缓存中的紧凑格式，不含规则源名称"""
+        return [self.domain, self.matches, self.exceptions, self.query_time, self.duration]
+
+    @classmethod
+    def from_cache(cls, data: list) -> "DomainQueryResult":
+        domain, matches, exceptions, query_time, duration = data
+        return cls(domain, tuple(map(tuple, matches)), tuple(map(tuple, exceptions)), query_time, duration)
 
 class ApiResponse(BaseModel):
     code: int
@@ -83,17 +220,91 @@ class ApiResponse(BaseModel):
     data: Optional[Union[Dict, List, str, int]] = None
     timestamp: int
 
+def dumps_json(obj: Any) -> bytes:
+    """紧凑的 UTF-8 JSON，输出与 FastAPI 默认的 JSONResponse 相同"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def loads_json(data: Union[bytes, str]) -> Any:
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+def api_json_response(message: str, data: Any, response: Optional[Response] = None, code: int = 200) -> Response:
+    """
+    生成与 ApiResponse 结构相同的响应，跳过 pydantic 校验与 jsonable_encoder，用于查询接口。
+    response 为接口注入的 Response 时沿用其中已设置的响应头（ETag 等）
+    """
+    body = dumps_json({'code': code, 'message': message, 'data': data, 'timestamp': int(time.time() * 1000)})
+    headers = dict(response.headers) if response is not None else None
+    return Response(content=body, media_type='application/json', headers=headers)
+
 class BulkQueryRequest(BaseModel):
     domains: List[str]
 
+class RefreshJob(BaseModel):
+    id: str
+    scope: str  # 规则源URL，"*" 表示全部规则源
+    status: str = "queued"  # queued / running / completed / completed_with_errors / failed
+    created: int
+    started: Optional[int] = None
+    finished: Optional[int] = None
+    total: int = 0
+    completed: int = 0
+    failed: int = 0
+    error: Optional[str] = None
+
 # 全局变量
-domain_rules: Dict[str, Set[str]] = {}  # URL -> Set[domain]
-regex_rules: Dict[str, Set[re.Pattern]] = {}  # URL -> Set[Pattern]
-hosts_rules: Dict[str, Set[str]] = {}  # URL -> Set[domain]
+compiled_rules: Dict[str, "CompiledRules"] = {}  # URL -> 编译后的规则索引
+badfilter_rules: Set[tuple] = set()  # 所有规则源中 $badfilter 禁用的规则，跨规则源生效
+# 发布规则时增量维护的统计，统计接口无需遍历规则
+source_kind_counts: Dict[str, Dict[str, int]] = {}  # URL -> 各类规则数
+rule_kind_totals: Dict[str, int] = {
+    'suffix': 0, 'exact': 0, 'wildcard': 0, 'hosts': 0, 'regex': 0,
+    'exception': 0, 'important': 0, 'badfilter': 0
+}
+last_rule_update = 0
+_publish_lock = threading.Lock()
 rule_sources: Dict[str, RuleSource] = {}  # URL -> RuleSource
+enabled_source_count = 0  # 随规则源增删维护
+index_generation = 0  # 每次发布编译结果递增
+index_fingerprint = ''  # 由规则源内容哈希计算的索引指纹，用于 ETag 与导出缓存
+BOOT_ID = os.urandom(4).hex()
+index_ready = False  # 首次发布索引（本地快照或网络）后置为 True
+index_ready_origin: Optional[str] = None  # snapshot / network / leader
 query_cache = TTLCache(maxsize=10000, ttl=3600)  # 1小时缓存
 all_default_sources: List[RuleSource] = []  # 所有默认规则源（包括配置文件）
 
+# 刷新调度配置（单位: 秒）
+DEFAULT_REFRESH_INTERVAL = int(os.environ.get('RULE_REFRESH_INTERVAL', 6 * 3600))
+MIN_REFRESH_INTERVAL = int(os.environ.get('RULE_REFRESH_MIN_INTERVAL', 3600))
+MAX_REFRESH_INTERVAL = int(os.environ.get('RULE_REFRESH_MAX_INTERVAL', 7 * 24 * 3600))
+RETRY_BASE_INTERVAL = int(os.environ.get('RULE_REFRESH_RETRY_INTERVAL', 300))
+REFRESH_JITTER = float(os.environ.get('RULE_REFRESH_JITTER', 0.1))  # 按周期比例随机抖动
+REFRESH_WORKERS = max(1, int(os.environ.get('RULE_REFRESH_WORKERS', 2)))
+STARTUP_REFRESH_SPREAD = float(os.environ.get('RULE_REFRESH_STARTUP_SPREAD', 30))
+
+# 单个规则源的资源上限（0 表示不限制）与所有规则源索引的内存预算，超出时拒绝该规则源的新内容
+SOURCE_MAX_BYTES = int(os.environ.get('SOURCE_MAX_BYTES', 64 * 1024 * 1024))  # 下载（解压后）字节数
+SOURCE_MAX_RULES = int(os.environ.get('SOURCE_MAX_RULES', 2000000))
+SOURCE_MAX_REGEX = int(os.environ.get('SOURCE_MAX_REGEX', 5000))
+INDEX_MEMORY_BUDGET = int(os.environ.get('INDEX_MEMORY_BUDGET_MB', 1024)) * 1024 * 1024
+
+class SourceQuotaExceeded(Exception):
+    """规则源超出资源限制，消息即记录到 RuleSource.status 的原因"""
+
+# 构建索引时移除同一规则源内被祖先域名覆盖的规则，命中时返回祖先规则
+RULE_COMPACTION = os.environ.get('RULE_COMPACTION', 'false').lower() in ('1', 'true', 'yes')
+
+# 原始规则存储: RULES_DIR/objects/<sha256>.txt.gz，manifest.json 记录 URL -> 内容哈希
+RULES_DIR = os.environ.get('RULES_DIR', 'data/rules')
+RULES_OBJECTS_DIR = os.path.join(RULES_DIR, 'objects')
+RULES_MANIFEST_FILE = os.path.join(RULES_DIR, 'manifest.json')
+source_content_hashes: Dict[str, str] = {}  # URL -> 当前已加载内容的哈希
+source_generations: Dict[str, int] = {}  # URL -> 最近一次发布该规则源时的索引代数，用于计算增量
+removed_generations: Dict[str, int] = {}  # 已移除的 URL -> 移除时的索引代数（最多保留 1024 条）
+delta_floor = 0  # 早于该代数的增量因移除记录被淘汰而无法计算
+_store_lock = threading.Lock()
+
 # 默认规则源配置
 DEFAULT_RULE_SOURCES = [
 
@@ -301,6 +512,34 @@ def load_rule_sources() -> List[RuleSource]:
         logger.info(f"配置文件不存在: {config_file}，使用默认配置")
         return [RuleSource(**item) for item in DEFAULT_RULE_SOURCES]
 
+# 域名: 至少两段，顶级域为2位以上字母，不允许首尾点号和连续点号
+_DOMAIN = r'(?:[A-Za-z0-9-]+\.)+[A-Za-z]{2,}'
+_IP = r'(?:\d{1,3}(?:\.\d{1,3}){3}|[0-9A-Fa-f]*:[0-9A-Fa-f:.]*)'
+DOMAIN_PATTERN = re.compile(_DOMAIN)
+
+# 整个文件一次性扫描的规则分类器，每种规则格式对应一个命名分组，
+# 不匹配任何分组的行（注释、元素隐藏、URL规则等）由正则引擎直接跳过
+RULE_LINE_PATTERN = re.compile(
+    r'^[ \t]*(?:'
+    r'@@(?P<exception>[^\s]+)'                                   # @@||example.com^ 白名单
+    r'|\|\|(?P<adguard>' + _DOMAIN + r')\^'                     # ||example.com^
+    r'|\|(?P<exact>' + _DOMAIN + r')\^'                          # |example.com^
+    r'|/(?P<regex>[^\r\n]+)/'                                  # /regex/
+    r'|' + _IP + r'[ \t]+(?P<hosts>' + _DOMAIN + r'(?:[ \t]+' + _DOMAIN + r')*)(?:[ \t]*#[^\r\n]*)?'  # 0.0.0.0 example.com
+    r'|address=/(?P<dnsmasq>' + _DOMAIN + r')/[^\r\n]*'         # address=/example.com/
+    r'|(?P<plain>' + _DOMAIN + r')'                             # example.com
+    r'|(?P<pattern>\|{0,2}[A-Za-z0-9*.-]+\^?(?:\$[^\r\n]+)?)'  # *.example.com、||ads.*.example.com^、||x^$important
+    r')[ \t]*\r?$',
+    re.MULTILINE
+)
+LABEL_PATTERN = re.compile(r'[a-z0-9-]+')
+
+# DNS 过滤中有意义的规则修饰符，带其他修饰符（$script、$domain= 等）的规则只对浏览器有效，直接忽略
+SUPPORTED_RULE_OPTIONS = frozenset({'important', 'badfilter'})
+
+# hosts 文件中常见的本地主机名，不视为拦截规则
+HOSTS_IGNORED_NAMES = frozenset({'localhost.localdomain', 'local.localdomain', 'ip6-localhost.localdomain'})
+
 def is_valid_domain(domain: str) -> bool:
     """验证域名格式"""
     if not domain or not isinstance(domain, str):
@@ -310,265 +549,3374 @@ def is_valid_domain(domain: str) -> bool:
     if not domain:
         return False
     
-    # 基本的域名格式验证
-    pattern = r'^[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return (re.match(pattern, domain) and 
-            not domain.startswith('.') and 
-            not domain.endswith('.') and 
-            '..' not in domain)
-
-def parse_rules(source: RuleSource, content: str) -> tuple:
-    """解析规则内容"""
-    lines = content.split('\n')
-    domains = set()
-    regexes = set()
-    hosts = set()
+    return DOMAIN_PATTERN.fullmatch(domain) is not None
+
+EXPIRES_PATTERN = re.compile(
+    r'^[!#]\s*Expires\s*:\s*(\d+)\s*(days?|d|hours?|h)?', re.IGNORECASE | re.MULTILINE
+)
+
+def parse_expires(content: str) -> Optional[int]:
+    """解析列表头部的 "! Expires: 4 days" 声明，返回秒数"""
+    # Expires 只出现在文件头部，避免扫描整个列表
+    match = EXPIRES_PATTERN.search(content, 0, 4096)
+    if not match:
+        return None
+    value = int(match.group(1))
+    unit = (match.group(2) or 'days').lower()
+    seconds = value * 3600 if unit.startswith('h') else value * 86400
+    return seconds if seconds > 0 else None
+
+def compute_refresh_delay(source: RuleSource) -> float:
+    """计算规则源距下次刷新的秒数：覆盖值 > Expires 声明 > 默认周期，失败时指数退避"""
+    interval = source.refresh_interval or source.expires or DEFAULT_REFRESH_INTERVAL
+    interval = min(max(interval, MIN_REFRESH_INTERVAL), MAX_REFRESH_INTERVAL)
+
+    if source.failure_count > 0:
+        backoff = RETRY_BASE_INTERVAL * (2 ** min(source.failure_count - 1, 16))
+        interval = min(backoff, interval)
+
+    # 加入抖动，避免所有列表在同一时刻下载
+    return interval * (1 + random.uniform(-REFRESH_JITTER, REFRESH_JITTER))
+
+# 规则优先级（同一规则源内）: 重要白名单 > 重要拦截 > 白名单 > 普通拦截
+RULE_BLOCK = 0
+RULE_IMPORTANT = 1
+RULE_ALLOW = 2
+RULE_IMPORTANT_ALLOW = 3
+
+def _rule_text(anchor: str, domain: str, level: int) -> str:
+    """按优先级还原域名规则的展示文本"""
+    text = f"{anchor}{domain}^"
+    if level >= RULE_ALLOW:
+        text = '@@' + text
+    if level in (RULE_IMPORTANT, RULE_IMPORTANT_ALLOW):
+        text += '$important'
+    return text
+
+REGEX_CACHE_SIZE = int(os.environ.get('REGEX_CACHE_SIZE', 8192))
+REGEX_QUARANTINE = os.environ.get('REGEX_QUARANTINE', 'true').lower() in ('1', 'true', 'yes')
+REGEX_QUARANTINE_DEADLINE = float(os.environ.get('REGEX_QUARANTINE_DEADLINE_MS', 50)) / 1000
+REGEX_QUARANTINE_MAX_TIMEOUTS = int(os.environ.get('REGEX_QUARANTINE_MAX_TIMEOUTS', 3))
+REGEX_SANDBOX_WORKERS = max(1, int(os.environ.get('REGEX_SANDBOX_WORKERS', 2)))  # 隔离进程数
+# 隔离进程启动（解释器初始化）的等待上限，不计入匹配截止时间
+REGEX_SANDBOX_START_TIMEOUT = float(os.environ.get('REGEX_SANDBOX_START_TIMEOUT_MS', 5000)) / 1000
+REGEX_PROFILE_SAMPLE_RATE = float(os.environ.get('REGEX_PROFILE_SAMPLE_RATE', 0.01))
+
+def analyze_regex_risk(tree) -> Optional[str]:
+    """在已解析的语法树中检查可能导致灾难性回溯的结构，返回原因；无风险时返回 None"""
+    repeats = (_sre_constants.MAX_REPEAT, _sre_constants.MIN_REPEAT)
+
+    def walk(items, outer_unbounded: bool) -> Optional[str]:
+        for op, av in items:
+            if op in repeats:
+                _, hi, item = av
+                unbounded = hi == _sre_constants.MAXREPEAT or hi > 16
+                if outer_unbounded and hi > 1:
+                    return "嵌套量词"
+                reason = walk(item, outer_unbounded or unbounded)
+                if reason:
+                    return reason
+            elif op == _sre_constants.SUBPATTERN:
+                reason = walk(av[-1], outer_unbounded)
+                if reason:
+                    return reason
+            elif op == _sre_constants.BRANCH:
+                for branch in av[1]:
+                    reason = walk(branch, outer_unbounded)
+                    if reason:
+                        return reason
+            elif op in (_sre_constants.ASSERT, _sre_constants.ASSERT_NOT):
+                reason = walk(av[1], outer_unbounded)
+                if reason:
+                    return reason
+        return None
+
+    return walk(tree, False)
+
+
+class RegexCache:
+    """
+    正则规则的全局编译缓存：规则中只保存驻留的 (模式, 标志) 键，多个规则源共享同一个键，
+    首次匹配时才编译，超出容量时淘汰最早编译的；登记时校验语法，无法编译的模式只记录一次，
+    不计入规则数。发布时按已发布的索引清理不再使用的键
+    """
+
+    def __init__(self, capacity: int = REGEX_CACHE_SIZE):
+        self.capacity = max(1, capacity)
+        self._keys: Dict[tuple, tuple] = {}
+        self._compiled: Dict[tuple, re.Pattern] = {}
+        self._failed: Dict[tuple, str] = {}
+        self.quarantined: Dict[tuple, str] = {}  # 可能灾难性回溯的模式 -> 原因，在隔离进程中匹配
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.compile_time = 0.0
+
+    def key(self, pattern: str, flags: int = 0) -> tuple:
+        """返回驻留的键，相同模式在所有规则源中只保存一份"""
+        key = (pattern, flags)
+        interned = self._keys.get(key)
+        if interned is not None:
+            return interned
+        if key in self._failed:
+            return key
+        try:
+            # 只解析一次校验语法并复用语法树做回溯风险检查，编译留到首次匹配
+            tree = _sre_parser.parse(pattern, flags)
+        except (re.error, OverflowError, RecursionError) as e:
+            self._failed[key] = str(e)
+            logger.warning(f"正则编译失败，已忽略: {pattern} - {e}")
+            return key
+        reason = analyze_regex_risk(tree) if REGEX_QUARANTINE else None
+        with self._lock:
+            # 与 prune 互斥，避免登记到被替换掉的表中
+            if reason and key not in self.quarantined:
+                self.quarantined[key] = reason
+                logger.warning(f"正则存在回溯风险({reason})，隔离匹配: {pattern}")
+            return self._keys.setdefault(key, key)
+
+    def is_failed(self, key: tuple) -> bool:
+        return key in self._failed
+
+    def prune(self, live: Set[tuple]) -> int:
+        """只保留 live 中的键（及其编译结果和隔离标记），返回移除的键数"""
+        with self._lock:
+            removed = len(self._keys)
+            self._keys = {key: key for key in self._keys if key in live}
+            self._compiled = {key: pattern for key, pattern in self._compiled.items() if key in live}
+            self.quarantined = {key: reason for key, reason in self.quarantined.items() if key in live}
+            return removed - len(self._keys)
+
+    def get(self, key: tuple) -> Optional[re.Pattern]:
+        pattern = self._compiled.get(key)
+        if pattern is not None:
+            self.hits += 1
+            return pattern
+        return self._compile(key)
+
+    def _compile(self, key: tuple) -> Optional[re.Pattern]:
+        with self._lock:
+            pattern = self._compiled.get(key)
+            if pattern is not None:
+                return pattern
+            if key in self._failed:
+                return None
+            self.misses += 1
+            start = time.perf_counter()
+            try:
+                pattern = re.compile(key[0], key[1])
+            except re.error as e:
+                self._failed[key] = str(e)
+                logger.warning(f"正则编译失败，已忽略: {key[0]} - {e}")
+                return None
+            finally:
+                self.compile_time += time.perf_counter() - start
+            if len(self._compiled) >= self.capacity:
+                # dict 按插入顺序，淘汰最早编译的模式
+                self._compiled.pop(next(iter(self._compiled)))
+                self.evictions += 1
+            self._compiled[key] = pattern
+            return pattern
+
+    def memory_usage(self) -> int:
+        """已编译正则对象（含字节码）与驻留键的估算内存"""
+        getsizeof = sys.getsizeof
+        return (sum(map(getsizeof, list(self._compiled.values())))
+                + sum(getsizeof(key) + getsizeof(key[0]) for key in list(self._keys)))
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'patterns': len(self._keys),
+            'compiled': len(self._compiled),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hitRatio': round(self.hits / lookups, 4) if lookups else 0.0,
+            'evictions': self.evictions,
+            'compileTime': int(self.compile_time * 1000),
+            'failures': len(self._failed),
+            'quarantined': len(self.quarantined),
+            'failedPatterns': [
+                {'pattern': pattern, 'error': error} for (pattern, _), error in list(self._failed.items())[:50]
+            ]
+        }
+
+regex_cache = RegexCache()
+
+class RegexProfiler:
+    """抽样记录每个正则模式的匹配耗时，用于找出代价最高的规则"""
+
+    def __init__(self, sample_rate: float = REGEX_PROFILE_SAMPLE_RATE):
+        self.sample_rate = min(1.0, max(0.0, sample_rate))
+        self._stats: Dict[tuple, list] = {}  # 键 -> [样本数, 总耗时, 最大耗时]
+        self._lock = threading.Lock()
+
+    def sampled(self) -> bool:
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def record(self, key: tuple, seconds: float):
+        with self._lock:
+            entry = self._stats.get(key)
+            if entry is None:
+                self._stats[key] = [1, seconds, seconds]
+            else:
+                entry[0] += 1
+                entry[1] += seconds
+                if seconds > entry[2]:
+                    entry[2] = seconds
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    def report(self, limit: int = 50) -> dict:
+        with self._lock:
+            stats = list(self._stats.items())
+        top = heapq.nlargest(limit, stats, key=lambda kv: kv[1][1])
+        # 反查每个模式所在的规则源
+        wanted = {key for key, _ in top}
+        sources: Dict[tuple, List[str]] = {key: [] for key in wanted}
+        for url, compiled in list(compiled_rules.items()):
+            keys = set(compiled.regex.values()) | {key for key, _ in compiled.regex_special.values()}
+            for key in keys & wanted:
+                sources[key].append(get_rule_source_name(url))
+        scale = 1.0 / self.sample_rate if self.sample_rate > 0 else 1.0
+        return {
+            'sampleRate': self.sample_rate,
+            'patterns': len(stats),
+            'top': [
+                {
+                    'pattern': key[0],
+                    'sources': sources.get(key, []),
+                    'samples': count,
+                    'estimatedTotalMs': round(total * scale * 1000, 3),
+                    'avgUs': round(total / count * 1e6, 1),
+                    'maxUs': round(peak * 1e6, 1),
+                    'quarantined': regex_cache.quarantined.get(key),
+                    'timeouts': regex_sandbox.timeouts.get(key, 0)
+                }
+                for key, (count, total, peak) in top
+            ]
+        }
+
+regex_profiler = RegexProfiler()
+
+# 隔离进程只依赖标准库，逐个匹配并立即输出结果，超时时父进程据已收到的结果数定位模式
+_REGEX_SANDBOX_CODE = r"""
+import json, re, sys, time
+patterns = {}
+out = sys.stdout
+out.write('ready\n')
+out.flush()
+for line in sys.stdin:
+    message = json.loads(line)
+    domain = message['d']
+    for source, flags in message['k']:
+        key = (source, flags)
+        pattern = patterns.get(key)
+        if pattern is None:
+            pattern = patterns[key] = re.compile(source, flags)
+        start = time.perf_counter()
+        hit = pattern.search(domain) is not None
+        out.write('%d %.9f\n' % (hit, time.perf_counter() - start))
+        out.flush()
+"""
+
+class _SandboxWorker:
+    """一个隔离子进程及其管道，由所属的锁保证同一时间只服务一个请求"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.process: Optional[subprocess.Popen] = None
+        self.buffer = b''
+
+    def send(self, domain: str, keys: List[tuple]):
+        if self.process is None or self.process.poll() is not None:
+            self.start()
+        self.process.stdin.write((json.dumps({'d': domain, 'k': keys}) + '\n').encode('utf-8'))
+
+    def start(self):
+        """启动子进程并等待其就绪，启动耗时不占用任何模式的截止时间"""
+        self.process = subprocess.Popen(
+            [sys.executable, '-c', _REGEX_SANDBOX_CODE],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0
+        )
+        self.buffer = b''
+        if self.read_line(time.monotonic() + REGEX_SANDBOX_START_TIMEOUT) != b'ready':
+            self.stop()
+            raise OSError("隔离进程启动超时")
+
+    def stop(self):
+        if self.process is not None:
+            try:
+                self.process.kill()
+                self.process.wait(1)
+            except Exception:
+                pass
+        self.process = None
+
+    def read_line(self, deadline: float) -> Optional[bytes]:
+        stdout = self.process.stdout
+        while b'\n' not in self.buffer:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            ready, _, _ = select.select([stdout], [], [], remaining)
+            if not ready:
+                return None
+            chunk = os.read(stdout.fileno(), 4096)
+            if not chunk:
+                raise EOFError("隔离进程已退出")
+            self.buffer += chunk
+        line, _, self.buffer = self.buffer.partition(b'\n')
+        return line
+
+class RegexSandbox:
+    """
+    在独立进程中按截止时间匹配被隔离的正则：re 匹配期间不释放 GIL 也无法中断，
+    超时后结束子进程并视为未命中，超时次数过多的模式被停用。
+    使用少量进程组成的池，所有进程都忙时直接跳过隔离模式（视为未命中），查询不会排队等待慢模式
+    """
+
+    def __init__(self, deadline: float = REGEX_QUARANTINE_DEADLINE, workers: int = REGEX_SANDBOX_WORKERS):
+        self.deadline = deadline
+        self.timeouts: Dict[tuple, int] = {}
+        self.disabled: Set[tuple] = set()
+        self.skipped = 0  # 因进程池繁忙跳过的查询次数
+        self._workers = [_SandboxWorker() for _ in range(max(1, workers))]
+        self._local = threading.local()  # 当前线程的查询是否有隔离模式未得出结果
+
+    def begin(self):
+        """在一次判定开始前调用，清除当前线程的未完成标记"""
+        self._local.incomplete = False
+
+    def incomplete(self) -> bool:
+        """自上次 begin 以来，当前线程是否有隔离模式因繁忙、超时或异常而未得出结果"""
+        return getattr(self._local, 'incomplete', False)
+
+    def _acquire(self) -> Optional[_SandboxWorker]:
+        for worker in self._workers:
+            if worker.lock.acquire(blocking=False):
+                return worker
+        return None
+
+    def search_many(self, domain: str, keys: List[tuple]) -> Set[tuple]:
+        """返回命中的模式键；每个模式单独计时，超时的模式视为未命中，重启进程后继续匹配其余模式"""
+        keys = [key for key in keys if key not in self.disabled]
+        if not keys:
+            return set()
+        worker = self._acquire()
+        if worker is None:
+            self.skipped += 1
+            self._local.incomplete = True
+            return set()
+        matched = set()
+        try:
+            pending = keys
+            while pending:
+                worker.send(domain, pending)
+                for i, key in enumerate(pending):
+                    line = worker.read_line(time.monotonic() + self.deadline)
+                    if line is None:
+                        worker.stop()
+                        self._local.incomplete = True
+                        self._on_timeout(key, domain)
+                        pending = [k for k in pending[i + 1:] if k not in self.disabled]
+                        break
+                    hit, seconds = line.split()
+                    regex_profiler.record(key, float(seconds))
+                    if hit == b'1':
+                        matched.add(key)
+                else:
+                    pending = []
+        except (EOFError, OSError, ValueError) as e:
+            logger.warning(f"正则隔离进程异常: {e}")
+            self._local.incomplete = True
+            worker.stop()
+        finally:
+            worker.lock.release()
+        return matched
+
+    def _on_timeout(self, key: tuple, domain: str):
+        count = self.timeouts[key] = self.timeouts.get(key, 0) + 1
+        regex_profiler.record(key, self.deadline)
+        logger.warning(f"隔离正则匹配超时({count}): {key[0]} - {domain}")
+        if count >= REGEX_QUARANTINE_MAX_TIMEOUTS:
+            self.disabled.add(key)
+            logger.warning(f"隔离正则超时次数过多，已停用: {key[0]}")
+
+regex_sandbox = RegexSandbox()
+
+
+class CompiledRules:
+    """单个规则源编译后的索引结构，查询时按域名后缀逐级直接查找，只有不规则的模式才交给正则引擎"""
+
+    __slots__ = (
+        'suffix', 'exact', 'special', 'wildcard', 'hosts', 'regex', 'regex_special',
+        'badfilter', 'rule_count', 'compaction', 'covering', 'memory_bytes'
+    )
+
+    def __init__(self):
+        self.suffix: Set[str] = set()  # ||x^、纯域名、address=/x/: 匹配 x 及其子域
+        self.exact: Set[str] = set()  # |x^: 仅匹配 x
+        # 白名单与 $important 规则较少，单独按 (锚点, 域名) 存放优先级位图，与普通规则在同一次后缀遍历中查找
+        self.special: Dict[tuple, int] = {}
+        self.wildcard: Dict[str, List[tuple]] = {}  # 固定后缀 -> [(左侧标签元组, 是否精确锚定, 优先级, 原始规则)]
+        self.hosts: Set[str] = set()
+        self.regex: Dict[str, tuple] = {}  # 原始规则 -> 正则缓存键（普通拦截），首次匹配时编译
+        self.regex_special: Dict[str, tuple] = {}  # 原始规则 -> (正则缓存键, 优先级)
+        self.badfilter: Set[tuple] = set()  # 被 $badfilter 禁用的 (锚点, 域名, 优先级)
+        self.rule_count = 0
+        self.compaction: Optional[Dict[str, int]] = None  # 压缩统计，未压缩时为 None
+        self.covering: Set[str] = set()  # 压缩时实际覆盖了其他规则的 ||x^ 祖先域名
+        self.memory_bytes = 0  # 估算的内存占用，首次用到时计算
+
+    def kind_counts(self) -> Dict[str, int]:
+        counts = {
+            'suffix': len(self.suffix),
+            'exact': len(self.exact),
+            'wildcard': 0,
+            'hosts': len(self.hosts),
+            'regex': len(self.regex),
+            'exception': 0,
+            'important': 0,
+            'badfilter': len(self.badfilter)
+        }
+        for (anchor, _), bits in self.special.items():
+            for level in (RULE_IMPORTANT, RULE_ALLOW, RULE_IMPORTANT_ALLOW):
+                if bits & (1 << level):
+                    counts['exception' if level >= RULE_ALLOW else 'important'] += 1
+                    if level == RULE_IMPORTANT:
+                        counts['suffix' if anchor == '||' else 'exact'] += 1
+        for entries in self.wildcard.values():
+            for _, _, level, _ in entries:
+                if level >= RULE_ALLOW:
+                    counts['exception'] += 1
+                else:
+                    counts['wildcard'] += 1
+                    counts['important'] += level == RULE_IMPORTANT
+        for _, level in self.regex_special.values():
+            if level >= RULE_ALLOW:
+                counts['exception'] += 1
+            else:
+                counts['regex'] += 1
+                counts['important'] += level == RULE_IMPORTANT
+        return counts
+
+    def domain_rule_count(self) -> int:
+        counts = self.kind_counts()
+        return counts['suffix'] + counts['exact'] + counts['wildcard']
+
+    def iter_domain_rules(self):
+        """按展示格式遍历域名类规则"""
+        yield from self.suffix
+        for domain in self.exact:
+            yield f"|{domain}^"
+        for (anchor, domain), bits in self.special.items():
+            for level in range(4):
+                if bits & (1 << level):
+                    yield _rule_text(anchor, domain, level)
+        for entries in self.wildcard.values():
+            for _, _, _, rule in entries:
+                yield rule
+
+    def overlap_keys(self) -> Set[str]:
+        """用于跨规则源比较的规则集合：||x^、纯域名与 hosts 都按域名比较，其余按规则文本比较"""
+        others = []
+        if self.exact:
+            others.append({f"|{domain}^" for domain in self.exact})
+        if self.special:
+            others.append({
+                _rule_text(anchor, domain, level)
+                for (anchor, domain), bits in self.special.items()
+                for level in range(4) if bits & (1 << level)
+            })
+        if self.wildcard:
+            others.append({entry[3] for entries in self.wildcard.values() for entry in entries})
+        if self.regex or self.regex_special:
+            others.append(set(self.regex) | set(self.regex_special))
+        parts = [p for p in (self.suffix, self.hosts) if p] + others
+        if not parts:
+            return set()
+        if len(parts) == 1:
+            # 只有一类规则时直接复用索引中的集合，不复制
+            return parts[0]
+        return set().union(*parts)
+
+    def match_domain(self, domain: str, labels: List[str], suffixes: List[str],
+                     badfilters: Set[tuple] = frozenset()) -> tuple:
+        """
+        一次后缀遍历匹配域名类规则（||x^、|x^、修饰符规则、通配符与 hosts），
+        返回 (各级别首个命中的规则文本, 命中的 hosts 主机名或 None)
+        """
+        found: List[Optional[str]] = [None, None, None, None]
+        host_rule = None
+        special = self.special
+        suffix_rules = self.suffix
+        wildcard = self.wildcard
+        hosts = self.hosts
+
+        if domain in self.exact and not (badfilters and ('|', domain, RULE_BLOCK) in badfilters):
+            found[RULE_BLOCK] = f"|{domain}^"
+        for i, suffix in enumerate(suffixes):
+            if found[RULE_BLOCK] is None and suffix in suffix_rules:
+                if not (badfilters and ('||', suffix, RULE_BLOCK) in badfilters):
+                    found[RULE_BLOCK] = suffix
+            if special:
+                for anchor in (('|', '||') if i == 0 else ('||',)):
+                    bits = special.get((anchor, suffix))
+                    if not bits:
+                        continue
+                    for level in range(1, 4):
+                        if bits & (1 << level) and found[level] is None:
+                            if not (badfilters and (anchor, suffix, level) in badfilters):
+                                found[level] = _rule_text(anchor, suffix, level)
+            if host_rule is None and hosts and suffix in hosts:
+                host_rule = suffix
+            # 通配符规则挂在固定后缀上，左侧至少还要有一个标签
+            entries = wildcard.get(suffix) if wildcard and i else None
+            if entries:
+                for prefix, exact_anchor, level, rule in entries:
+                    n = len(prefix)
+                    if found[level] is not None or n > i or (exact_anchor and n != i):
+                        continue
+                    left = labels[i - n:i]
+                    if all(p == '*' or p == label for p, label in zip(prefix, left)):
+                        found[level] = rule
+        return found, host_rule
+
+    def match_regex(self, domain: str) -> List[Optional[str]]:
+        """匹配正则规则，按优先级返回各级别首个命中的规则文本"""
+        found: List[Optional[str]] = [None, None, None, None]
+        get_pattern = regex_cache.get
+        quarantined = regex_cache.quarantined
+        deferred = []  # 隔离的模式最后在隔离进程中匹配
+        if regex_profiler.sampled():
+            return self._match_regex_profiled(domain, found, deferred)
+        for rule, (key, level) in self.regex_special.items():
+            if found[level] is None:
+                if key in quarantined:
+                    deferred.append((rule, key, level))
+                    continue
+                pattern = get_pattern(key)
+                if pattern is not None and pattern.search(domain):
+                    found[level] = rule
+        for rule, key in self.regex.items():
+            if key in quarantined:
+                deferred.append((rule, key, RULE_BLOCK))
+                continue
+            pattern = get_pattern(key)
+            if pattern is None:
+                continue
+            try:
+                if pattern.search(domain):
+                    found[RULE_BLOCK] = rule
+                    break
+            except Exception as e:
+                logger.debug("正则匹配错误: %s - %s", rule, e)
+        if deferred:
+            self._match_quarantined(domain, found, deferred)
+        return found
+
+    def _match_regex_profiled(self, domain: str, found: List[Optional[str]], deferred: list) -> List[Optional[str]]:
+        """与 match_regex 相同，但记录每个模式的耗时（抽样调用）"""
+        get_pattern = regex_cache.get
+        quarantined = regex_cache.quarantined
+        record = regex_profiler.record
+        perf_counter = time.perf_counter
+        for rule, (key, level) in self.regex_special.items():
+            if found[level] is None:
+                if key in quarantined:
+                    deferred.append((rule, key, level))
+                    continue
+                pattern = get_pattern(key)
+                if pattern is not None:
+                    start = perf_counter()
+                    matched = pattern.search(domain)
+                    record(key, perf_counter() - start)
+                    if matched:
+                        found[level] = rule
+        for rule, key in self.regex.items():
+            if key in quarantined:
+                deferred.append((rule, key, RULE_BLOCK))
+                continue
+            pattern = get_pattern(key)
+            if pattern is None:
+                continue
+            start = perf_counter()
+            matched = pattern.search(domain)
+            record(key, perf_counter() - start)
+            if matched:
+                found[RULE_BLOCK] = rule
+                break
+        if deferred:
+            self._match_quarantined(domain, found, deferred)
+        return found
+
+    @staticmethod
+    def _match_quarantined(domain: str, found: List[Optional[str]], deferred: list):
+        pending = [(rule, key, level) for rule, key, level in deferred if found[level] is None]
+        if not pending:
+            return
+        matched = regex_sandbox.search_many(domain, [key for _, key, _ in pending])
+        for rule, key, level in pending:
+            if key in matched and found[level] is None:
+                found[level] = rule
+
+    def evaluate(self, domain: str, labels: List[str], suffixes: List[str],
+                 badfilters: Set[tuple] = frozenset()) -> tuple:
+        """
+        计算该规则源对域名的最终判定
+        返回 (生效的拦截 [(规则, 类型)], 被白名单覆盖的拦截 [(白名单规则, 白名单类型, 拦截规则, 拦截类型)])
+        """
+        domain_found, host_rule = self.match_domain(domain, labels, suffixes, badfilters)
+        regex_found = self.match_regex(domain) if (self.regex or self.regex_special) else (None, None, None, None)
+        return self.resolve(domain_found, host_rule, regex_found)
+
+    @staticmethod
+    def resolve(domain_found: List[Optional[str]], host_rule: Optional[str],
+                regex_found: List[Optional[str]]) -> tuple:
+        """由各类规则的命中结果计算最终判定，白名单覆盖同源的拦截"""
+        candidates = []
+        if domain_found[RULE_IMPORTANT] or domain_found[RULE_BLOCK]:
+            important = domain_found[RULE_IMPORTANT] is not None
+            candidates.append((domain_found[RULE_IMPORTANT] or domain_found[RULE_BLOCK], "domain", important))
+        if host_rule is not None:
+            candidates.append((host_rule, "hosts", False))
+        if regex_found[RULE_IMPORTANT] or regex_found[RULE_BLOCK]:
+            important = regex_found[RULE_IMPORTANT] is not None
+            candidates.append((regex_found[RULE_IMPORTANT] or regex_found[RULE_BLOCK], "regex", important))
+        if not candidates:
+            return [], []
+
+        important_allow = (domain_found[RULE_IMPORTANT_ALLOW] and (domain_found[RULE_IMPORTANT_ALLOW], "domain")) or \
+            (regex_found[RULE_IMPORTANT_ALLOW] and (regex_found[RULE_IMPORTANT_ALLOW], "regex"))
+        allow = (domain_found[RULE_ALLOW] and (domain_found[RULE_ALLOW], "domain")) or \
+            (regex_found[RULE_ALLOW] and (regex_found[RULE_ALLOW], "regex"))
+
+        blocks, overridden = [], []
+        for rule, rule_type, important in candidates:
+            winner = important_allow or (None if important else allow)
+            if winner:
+                overridden.append((winner[0], winner[1], rule, rule_type))
+            else:
+                blocks.append((rule, rule_type))
+        return blocks, overridden
+
+    def apply_badfilters(self):
+        """$badfilter 在本规则源内直接移除对应规则"""
+        for anchor, domain, level in self.badfilter:
+            if anchor == 'wildcard':
+                # 通配符与正则规则以原始文本标识
+                for key, entries in list(self.wildcard.items()):
+                    kept = [e for e in entries if not (e[3] == domain and e[2] == level)]
+                    if kept:
+                        self.wildcard[key] = kept
+                    else:
+                        del self.wildcard[key]
+            elif anchor == 'regex':
+                if level == RULE_BLOCK:
+                    self.regex.pop(domain, None)
+                else:
+                    self.regex_special.pop(domain, None)
+            elif level == RULE_BLOCK:
+                (self.suffix if anchor == '||' else self.exact).discard(domain)
+            else:
+                bits = self.special.get((anchor, domain), 0) & ~(1 << level)
+                if bits:
+                    self.special[(anchor, domain)] = bits
+                else:
+                    self.special.pop((anchor, domain), None)
+
+    def compact(self, disabled: Set[str] = frozenset()) -> Dict[str, int]:
+        """
+        移除已被同一规则源中祖先域名覆盖的规则：||ads.example.com^ 被 ||example.com^ 覆盖，
+        hosts 同理；|x^ 被 ||x^ 或其祖先覆盖。命中时返回实际存在的祖先规则。
+        disabled 为其他规则源以 $badfilter 禁用的 ||x^ 域名，它们不作为覆盖规则；
+        实际起覆盖作用的祖先记录在 covering 中，之后被禁用时需要重新构建索引
+        """
+        before = sys.getsizeof(self.suffix) + sys.getsizeof(self.exact) + sys.getsizeof(self.hosts)
+        freed = 0
+        covering = set()
+
+        def covering_rule(domain: str, rules: Set[str], include_self: bool) -> Optional[str]:
+            if include_self and domain in rules:
+                return domain
+            idx = domain.find('.')
+            while idx != -1:
+                ancestor = domain[idx + 1:]
+                if ancestor in rules:
+                    return ancestor
+                idx = domain.find('.', idx + 1)
+            return None
+
+        def compact_set(rules: Set[str], cover: Set[str], include_self: bool, track: bool) -> tuple:
+            nonlocal freed
+            kept, removed = set(), 0
+            for domain in rules:
+                ancestor = covering_rule(domain, cover, include_self)
+                if ancestor is None:
+                    kept.add(domain)
+                    continue
+                removed += 1
+                freed += sys.getsizeof(domain)
+                if track:
+                    covering.add(ancestor)
+            # 重新建集合，discard 不会缩小哈希表
+            return (kept, removed) if removed else (rules, 0)
+
+        # hosts 规则不受 $badfilter 影响，只有 ||x^ 祖先可能在查询时被其他规则源禁用
+        suffix_cover = self.suffix - disabled if disabled else self.suffix
+        self.suffix, suffix_removed = compact_set(self.suffix, suffix_cover, False, True)
+        self.exact, exact_removed = compact_set(self.exact, suffix_cover, True, True)
+        self.hosts, hosts_removed = compact_set(self.hosts, self.hosts, False, False)
+        self.covering = covering
+        after = sys.getsizeof(self.suffix) + sys.getsizeof(self.exact) + sys.getsizeof(self.hosts)
+        self.compaction = {
+            'suffix': suffix_removed,
+            'exact': exact_removed,
+            'hosts': hosts_removed,
+            'removed': suffix_removed + exact_removed + hosts_removed,
+            'bytesSaved': max(0, before - after) + freed
+        }
+        return self.compaction
+
+    def memory_usage(self) -> int:
+        """粗略估算索引占用的内存（容器哈希表与字符串对象），用于全局内存预算"""
+        # 旧版本快照反序列化后没有该属性
+        size = getattr(self, 'memory_bytes', 0)
+        if not size:
+            size = self.memory_bytes = sum(self.memory_breakdown().values())
+        return size
+
+    def memory_breakdown(self) -> Dict[str, int]:
+        """按数据结构估算内存占用"""
+        getsizeof = sys.getsizeof
+        sizes = {
+            kind: getsizeof(rules) + sum(map(getsizeof, rules))
+            for kind, rules in (('suffix', self.suffix), ('exact', self.exact), ('hosts', self.hosts))
+        }
+        sizes['special'] = getsizeof(self.special) + sum(getsizeof(key) + getsizeof(key[1]) for key in self.special)
+        sizes['wildcard'] = getsizeof(self.wildcard) + sum(
+            getsizeof(entries) + sum(getsizeof(entry) + getsizeof(entry[3]) for entry in entries)
+            for entries in self.wildcard.values()
+        )
+        # 正则键在全局缓存中驻留共享，这里只计原始规则文本
+        sizes['regex'] = (getsizeof(self.regex) + getsizeof(self.regex_special)
+                          + sum(map(getsizeof, self.regex)) + sum(map(getsizeof, self.regex_special)))
+        return sizes
+
+    def to_wire(self) -> dict:
+        """转换为只含 JSON 基本类型的结构，用于集群分发（不使用可执行代码的 pickle）"""
+        return {
+            'suffix': list(self.suffix),
+            'exact': list(self.exact),
+            'special': [[anchor, domain, bits] for (anchor, domain), bits in self.special.items()],
+            'wildcard': {
+                suffix: [[list(labels), exact, level, rule] for labels, exact, level, rule in entries]
+                for suffix, entries in self.wildcard.items()
+            },
+            'hosts': list(self.hosts),
+            'regex': {rule: list(key) for rule, key in self.regex.items()},
+            'regexSpecial': {rule: [key[0], key[1], level] for rule, (key, level) in self.regex_special.items()},
+            'badfilter': [list(entry) for entry in self.badfilter],
+            'ruleCount': self.rule_count,
+            'compaction': self.compaction,
+            'covering': list(self.covering)
+        }
+
+    @classmethod
+    def from_wire(cls, data: dict) -> "CompiledRules":
+        """由 to_wire 的结构重建索引，正则键直接登记到全局编译缓存"""
+        compiled = cls()
+        compiled.suffix = set(data['suffix'])
+        compiled.exact = set(data['exact'])
+        compiled.special = {(anchor, domain): int(bits) for anchor, domain, bits in data['special']}
+        compiled.wildcard = {
+            suffix: [(tuple(labels), bool(exact), int(level), rule) for labels, exact, level, rule in entries]
+            for suffix, entries in data['wildcard'].items()
+        }
+        compiled.hosts = set(data['hosts'])
+        compiled.regex = {rule: regex_cache.key(pattern, int(flags)) for rule, (pattern, flags) in data['regex'].items()}
+        compiled.regex_special = {
+            rule: (regex_cache.key(pattern, int(flags)), int(level))
+            for rule, (pattern, flags, level) in data['regexSpecial'].items()
+        }
+        compiled.badfilter = {tuple(entry) for entry in data['badfilter']}
+        compiled.rule_count = int(data['ruleCount'])
+        compiled.compaction = data.get('compaction')
+        compiled.covering = set(data.get('covering', ()))
+        return compiled
+
+    def intern_regex(self):
+        """反序列化后把正则键重新登记到全局编译缓存，与其他规则源共享"""
+        for rule, key in list(self.regex.items()):
+            self.regex[rule] = regex_cache.key(*key)
+        for rule, (key, level) in list(self.regex_special.items()):
+            self.regex_special[rule] = (regex_cache.key(*key), level)
+
+    def add_domain_rule(self, anchor: str, domain: str, level: int):
+        if level == RULE_BLOCK:
+            (self.suffix if anchor == '||' else self.exact).add(domain)
+        else:
+            key = (anchor, domain)
+            self.special[key] = self.special.get(key, 0) | (1 << level)
+
+def _compile_pattern_rule(rule: str, compiled: CompiledRules, exception: bool = False) -> bool:
+    """把带锚点、通配符或修饰符的 AdGuard 规则归一化到索引结构，返回是否接受该规则"""
+    body, _, options = rule.partition('$')
+    option_set = {o.strip().lower() for o in options.split(',')} if options else set()
+    if not option_set <= SUPPORTED_RULE_OPTIONS:
+        return False
+    important = 'important' in option_set
+    if exception:
+        level = RULE_IMPORTANT_ALLOW if important else RULE_ALLOW
+    else:
+        level = RULE_IMPORTANT if important else RULE_BLOCK
+    badfilter = 'badfilter' in option_set
+    display = ('@@' if exception else '') + body + ('$important' if important else '')
+
+    if body.startswith('/') and body.endswith('/') and len(body) > 2:
+        if not exception or badfilter:
+            return False
+        key = regex_cache.key(body[1:-1], re.IGNORECASE)
+        if regex_cache.is_failed(key):
+            return False
+        compiled.regex_special[display] = (key, level)
+        return True
+
+    if body.startswith('||'):
+        anchor, body = '||', body[2:]
+    elif body.startswith('|'):
+        anchor, body = '|', body[1:]
+    else:
+        anchor = ''
+    separator = body.endswith('^')
+    body = body.rstrip('^').lower()
+
+    if '*' not in body:
+        if not DOMAIN_PATTERN.fullmatch(body):
+            return False
+        anchor = anchor or '||'
+        if badfilter:
+            compiled.badfilter.add((anchor, body, level))
+        else:
+            compiled.add_domain_rule(anchor, body, level)
+        return True
+
+    labels = body.split('.')
+    if '' in labels:
+        return False
+
+    # 单标签通配符: 最后一个 * 之后必须是完整域名，例如 ||ads.*.example.com^、*.doubleclick.net
+    if all(label == '*' or LABEL_PATTERN.fullmatch(label) for label in labels):
+        split = len(labels) - labels[::-1].index('*')
+        suffix = '.'.join(labels[split:])
+        if suffix and DOMAIN_PATTERN.fullmatch(suffix):
+            if badfilter:
+                compiled.badfilter.add(('wildcard', display, level))
+            else:
+                compiled.wildcard.setdefault(suffix, []).append(
+                    (tuple(labels[:split]), anchor == '|', level, display)
+                )
+            return True
+
+    # 其余不规则模式（如 ||ad*.example.com^）转换为正则；没有锚点或字面量过少的模式匹配面太广，忽略
+    if not anchor or len(body.replace('*', '').replace('.', '')) < 3:
+        return False
+    if badfilter:
+        compiled.badfilter.add(('regex', display, level))
+        return True
+    regex_str = ('^' if anchor == '|' else r'(?:^|\.)') + re.escape(body).replace(r'\*', '.*')
+    if separator:
+        regex_str += '$'
+    key = regex_cache.key(regex_str)
+    if level == RULE_BLOCK:
+        compiled.regex[display] = key
+    else:
+        compiled.regex_special[display] = (key, level)
+    return True
+
+def badfiltered_suffixes(badfilters: Set[tuple]) -> Set[str]:
+    """被 $badfilter 禁用的普通 ||x^ 拦截规则的域名"""
+    return {domain for anchor, domain, level in badfilters if anchor == '||' and level == RULE_BLOCK}
+
+def parse_rules(source: RuleSource, content: str, max_rules: int = 0, max_regex: int = 0) -> CompiledRules:
+    """
+    解析规则内容，对整个内容做一次正则扫描而不是逐行分支判断。
+    规则数或正则规则数超过 max_rules / max_regex（0 为不限制）时立即抛出 SourceQuotaExceeded
+    """
+    compiled = CompiledRules()
+    add_suffix = compiled.suffix.add
     rule_count = 0
     
-    for line in lines:
-        line = line.strip()
-        
-        # 跳过空行和注释
-        if not line or line.startswith('#') or line.startswith('!'):
-            continue
-        
-        try:
-            # 处理AdGuard格式规则
-            if line.startswith('||') and line.endswith('^'):
-                # 域名规则: ||example.com^
-                domain = line[2:-1].lower()
-                if is_valid_domain(domain):
-                    domains.add(domain)
+    for match in RULE_LINE_PATTERN.finditer(content):
+        if max_rules and rule_count > max_rules:
+            raise SourceQuotaExceeded(f"规则数超过上限 {max_rules}")
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'hosts':
+            # 一行 hosts 可以包含多个主机名
+            for host in value.lower().split():
+                if host not in HOSTS_IGNORED_NAMES:
+                    compiled.hosts.add(host)
                     rule_count += 1
-            elif line.startswith('/') and line.endswith('/'):
-                # 正则规则: /regex/
-                regex_str = line[1:-1]
-                try:
-                    regex_pattern = re.compile(regex_str, re.IGNORECASE)
-                    regexes.add(regex_pattern)
-                    rule_count += 1
-                except re.error:
-                    logger.debug(f"无效正则表达式: {regex_str}")
-            elif ' ' in line:
-                # Hosts格式: 0.0.0.0 example.com
-                parts = line.split()
-                if len(parts) >= 2:
-                    domain = parts[1].lower()
-                    if is_valid_domain(domain):
-                        hosts.add(domain)
-                        rule_count += 1
-            elif line.startswith('@@'):
-                # 白名单规则，暂时跳过
+            continue
+        if kind == 'exact':
+            compiled.exact.add(value.lower())
+        elif kind == 'regex':
+            # 只保存驻留的模式字符串，首次匹配时才编译；已知无法编译的模式直接跳过
+            key = regex_cache.key(value, re.IGNORECASE)
+            if regex_cache.is_failed(key):
                 continue
-            elif is_valid_domain(line):
-                # 纯域名
-                domains.add(line.lower())
-                rule_count += 1
-        except Exception as e:
-            logger.debug(f"解析规则失败: {line} - {e}")
+            compiled.regex[key[0]] = key
+            if max_regex and len(compiled.regex) + len(compiled.regex_special) > max_regex:
+                raise SourceQuotaExceeded(f"正则规则数超过上限 {max_regex}")
+        elif kind in ('pattern', 'exception'):
+            # 不规则的通配符规则会转换为正则，同样计入正则规则数上限
+            if not _compile_pattern_rule(value, compiled, exception=kind == 'exception'):
+                continue
+            if max_regex and len(compiled.regex) + len(compiled.regex_special) > max_regex:
+                raise SourceQuotaExceeded(f"正则规则数超过上限 {max_regex}")
+        else:
+            # ||x^、address=/x/ 与纯域名匹配自身及子域
+            add_suffix(value.lower())
+        rule_count += 1
     
-    return domains, regexes, hosts, rule_count
+    if compiled.badfilter:
+        compiled.apply_badfilters()
+    compiled.rule_count = rule_count
+    if RULE_COMPACTION:
+        stats = compiled.compact(badfiltered_suffixes(badfilter_rules))
+        if stats['removed']:
+            logger.info(
+                f"规则压缩: {source.name if source else '-'} 移除 {stats['removed']} 条被覆盖的规则，"
+                f"节省约 {stats['bytesSaved'] / 1024 / 1024:.1f} MB"
+            )
+    return compiled
 
-def update_rule_from_source(source: RuleSource):
-    """从单个规则源更新规则"""
+def _atomic_write(path: str, data: bytes):
+    """先写临时文件再原子替换，避免读到写了一半的文件"""
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
     try:
-        logger.info(f"正在更新规则源: {source.name} - {source.url}")
-        
-        response = requests.get(source.url, timeout=60)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def raw_rules_path(digest: str) -> str:
+    return os.path.join(RULES_OBJECTS_DIR, f"{digest}.txt.gz")
+
+def load_rules_manifest() -> Dict[str, dict]:
+    """读取 URL -> 内容哈希 的清单"""
+    try:
+        with open(RULES_MANIFEST_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.warning(f"读取规则清单失败: {RULES_MANIFEST_FILE} - {e}")
+        return {}
+
+def read_raw_rules(digest: str) -> str:
+    """读取按哈希保存的原始规则内容"""
+    with gzip.open(raw_rules_path(digest), 'rb') as f:
+        return f.read().decode('utf-8', errors='replace')
+
+def store_raw_rules(url: str, digest: str, raw: bytes) -> bool:
+    """压缩保存原始规则并更新清单，返回是否写入了新对象"""
+    with _store_lock:
+        os.makedirs(RULES_OBJECTS_DIR, exist_ok=True)
+        path = raw_rules_path(digest)
+        written = False
+        if not os.path.exists(path):
+            # 相同内容（包括不同镜像URL）只保存一份
+            _atomic_write(path, gzip.compress(raw, compresslevel=6))
+            written = True
+            logger.info(f"已保存规则源到: {path} ({len(raw)} 字节)")
+
+        manifest = load_rules_manifest()
+        entry = manifest.get(url)
+        if entry and entry.get('hash') == digest:
+            return written
+
+        old_digest = entry.get('hash') if entry else None
+        manifest[url] = {'hash': digest, 'size': len(raw), 'stored': int(time.time() * 1000)}
+        _atomic_write(
+            RULES_MANIFEST_FILE,
+            json.dumps(manifest, ensure_ascii=False, indent=2).encode('utf-8')
+        )
+
+        # 清理不再被任何规则源引用的旧对象
+        if old_digest and all(e.get('hash') != old_digest for e in manifest.values()):
+            try:
+                os.unlink(raw_rules_path(old_digest))
+            except OSError:
+                pass
+        return written
+
+def forget_raw_rules(url: str):
+    """从清单中移除规则源，并清理不再被引用的对象"""
+    with _store_lock:
+        manifest = load_rules_manifest()
+        entry = manifest.pop(url, None)
+        if not entry:
+            return
+        _atomic_write(
+            RULES_MANIFEST_FILE,
+            json.dumps(manifest, ensure_ascii=False, indent=2).encode('utf-8')
+        )
+        if all(e.get('hash') != entry.get('hash') for e in manifest.values()):
+            try:
+                os.unlink(raw_rules_path(entry['hash']))
+            except OSError:
+                pass
+
+def download_rule_source(url: str) -> tuple:
+    """
+    流式下载规则源，超过 SOURCE_MAX_BYTES（按解压后的字节计）时立即中止，
+    不把超大响应整体读入内存。返回 (原始字节, 文本)
+    """
+    with requests.get(url, timeout=60, stream=True) as response:
         response.raise_for_status()
+        declared = response.headers.get('Content-Length', '')
+        if SOURCE_MAX_BYTES and declared.isdigit() and int(declared) > SOURCE_MAX_BYTES:
+            raise SourceQuotaExceeded(f"下载大小 {int(declared)} 字节超过上限 {SOURCE_MAX_BYTES} 字节")
+        chunks, total = [], 0
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            total += len(chunk)
+            if SOURCE_MAX_BYTES and total > SOURCE_MAX_BYTES:
+                raise SourceQuotaExceeded(f"下载大小超过上限 {SOURCE_MAX_BYTES} 字节，已中止")
+            chunks.append(chunk)
+        # 未声明字符集时按 UTF-8 解码，避免对整个响应做编码探测
+        declared_charset = 'charset' in response.headers.get('Content-Type', '').lower()
+        encoding = (response.encoding if declared_charset else None) or 'utf-8'
+    raw = b''.join(chunks)
+    return raw, raw.decode(encoding, errors='replace')
+
+def index_memory_usage(exclude_url: Optional[str] = None) -> int:
+    """已发布索引的估算内存，多个镜像共享的编译结果只计一次"""
+    seen, total = set(), 0
+    for url, compiled in list(compiled_rules.items()):
+        if url == exclude_url or id(compiled) in seen:
+            continue
+        seen.add(id(compiled))
+        total += compiled.memory_usage()
+    return total
+
+def check_memory_budget(url: str, compiled: CompiledRules):
+    """发布前检查替换该规则源后的总内存是否超出 INDEX_MEMORY_BUDGET"""
+    if not INDEX_MEMORY_BUDGET:
+        return
+    others = index_memory_usage(exclude_url=url)
+    shared = any(c is compiled for u, c in list(compiled_rules.items()) if u != url)
+    total = others + (0 if shared else compiled.memory_usage())
+    if total > INDEX_MEMORY_BUDGET:
+        raise SourceQuotaExceeded(
+            f"索引内存预算不足: 需要约 {total / 1024 / 1024:.0f} MB，预算 {INDEX_MEMORY_BUDGET / 1024 / 1024:.0f} MB"
+        )
+
+def update_rule_from_source(source: RuleSource) -> bool:
+    """从单个规则源更新规则，返回是否更新成功"""
+    global last_rule_update
+    success = False
+    source.status = "更新中"
+    event_broadcaster.publish('source', rule_source_to_dict(source))
+    try:
+        logger.info(f"正在更新规则源: {source.name} - {source.url}")
         
-        content = response.text
+        raw, content = download_rule_source(source.url)
         if not content.strip():
             logger.warning(f"规则源内容为空: {source.url}")
             source.status = "内容为空"
-            rule_sources[source.url] = source
-            return
+            source.failure_count += 1
+            register_rule_source(source)
+            return False
+        
+        digest = hashlib.sha256(raw).hexdigest()
+        last_rule_update = int(time.time() * 1000)
+        if source_content_hashes.get(source.url) == digest:
+            # 内容未变化，沿用已加载的规则
+            logger.info(f"规则源内容未变化，跳过解析: {source.name}")
+            rule_count = source.rule_count
+            event_broadcaster.publish('statistics', build_statistics())
+        else:
+            mirror_url = next(
+                (url for url, h in source_content_hashes.items() if h == digest and url != source.url),
+                None
+            )
+            if mirror_url is not None:
+                # 其他镜像已提供相同内容，直接共享解析结果
+                logger.info(f"规则源内容与 {mirror_url} 相同，复用解析结果: {source.name}")
+                compiled = compiled_rules[mirror_url]
+            else:
+                compiled = parse_rules(source, content, SOURCE_MAX_RULES, SOURCE_MAX_REGEX)
+            check_memory_budget(source.url, compiled)
+            
+            # 存储规则
+            publish_compiled_rules(source.url, compiled, digest)
+            rule_count = compiled.rule_count
         
-        # 保存下载的原始规则到可挂载目录，便于 Docker 挂载查看/调试
+        # 按内容哈希压缩保存原始规则，内容未变化时不重写；超限被拒绝的内容不落盘，重启后仍加载旧规则
         try:
-            rules_dir = os.environ.get('RULES_DIR', 'data/rules')
-            os.makedirs(rules_dir, exist_ok=True)
-            parsed = urlparse(source.url)
-            safe_name = (parsed.netloc + parsed.path).strip()
-            if not safe_name:
-                # fallback to hash
-                safe_name = hashlib.sha256(source.url.encode('utf-8')).hexdigest()
-            # 替换不安全字符
-            safe_name = re.sub(r'[^0-9a-zA-Z._-]', '_', safe_name)
-            if not safe_name.lower().endswith('.txt'):
-                safe_name = safe_name + '.txt'
-            file_path = os.path.join(rules_dir, safe_name)
-            with open(file_path, 'w', encoding='utf-8') as f:
-                f.write(content)
-            logger.info(f"已保存规则源到: {file_path}")
+            store_raw_rules(source.url, digest, raw)
         except Exception as e:
             logger.warning(f"保存规则文件失败: {source.url} - {e}")
-
-        domains, regexes, hosts, rule_count = parse_rules(source, content)
-        
-        # 存储规则
-        if domains:
-            domain_rules[source.url] = domains
-        if regexes:
-            regex_rules[source.url] = regexes
-        if hosts:
-            hosts_rules[source.url] = hosts
         
         source.rule_count = rule_count
-        source.last_updated = int(time.time() * 1000)
+        source.last_updated = last_rule_update
         source.status = "更新成功"
-        rule_sources[source.url] = source
+        source.expires = parse_expires(content)
+        source.failure_count = 0
+        register_rule_source(source)
+        success = True
+        # 本地快照仍在加载时网络刷新先完成，也以网络结果标记就绪
+        mark_index_ready('network')
         
         logger.info(f"规则源更新完成: {source.name} - 规则数: {rule_count}")
         
+    except SourceQuotaExceeded as e:
+        # 超限的新内容不发布，该规则源已加载的旧索引保持不变
+        logger.warning(f"规则源超出资源限制，已拒绝: {source.url} - {e}")
+        source.status = f"超出限制: {e}"
+        source.failure_count += 1
+        register_rule_source(source)
     except Exception as e:
         logger.error(f"更新规则源失败: {source.url} - {e}")
         source.status = f"更新失败: {str(e)}"
-        rule_sources[source.url] = source
+        source.failure_count += 1
+        register_rule_source(source)
+    finally:
+        # 无论成功与否，都按规则源自身的周期安排下次刷新
+        refresh_scheduler.schedule(source)
+        event_broadcaster.publish('source', rule_source_to_dict(source))
+
+    return success
+
+class SingleFlight:
+    """相同 key 的并发调用只执行一次，其余调用等待并共享同一个结果"""
+
+    class _Call:
+        __slots__ = ('event', 'result', 'error')
+
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error: Optional[BaseException] = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Any, "SingleFlight._Call"] = {}
+        self.shared = 0  # 加入进行中调用的次数
 
-def update_all_rules():
+    def do(self, key, fn, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = SingleFlight._Call()
+            else:
+                self.shared += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
+
+source_refresh_flight = SingleFlight()  # 同一规则源的并发刷新只下载解析一次
+query_flight = SingleFlight()  # 同一域名的并发未命中只计算一次
+
+def refresh_source(source: RuleSource) -> bool:
+    """刷新单个规则源；若该源正在被其他任务刷新，则等待并共享其结果"""
+    return source_refresh_flight.do(source.url, update_rule_from_source, source)
+
+def update_all_rules(job: Optional["RefreshJob"] = None):
     """更新所有规则"""
     logger.info("开始更新所有AdGuard规则...")
     
-    # 更新默认规则源（包括配置文件中的）
-    for source in all_default_sources:
-        if source.enabled:
-            update_rule_from_source(source)
-    
-    # 更新自定义规则源
+    # 默认规则源（包括配置文件中的）在前，自定义规则源在后
     default_urls = {s.url for s in all_default_sources}
-    for source in list(rule_sources.values()):
-        if source.enabled and source.url not in default_urls:
-            update_rule_from_source(source)
+    sources = [s for s in all_default_sources if s.enabled]
+    sources += [s for s in list(rule_sources.values()) if s.enabled and s.url not in default_urls]
+    if job:
+        job.total = len(sources)
+    
+    for source in sources:
+        ok = refresh_source(source)
+        if job:
+            job.completed += 1
+            job.failed += 0 if ok else 1
+            event_broadcaster.publish('refresh', refresh_job_to_dict(job))
     
     logger.info("规则更新完成")
-    logger.info(f"域名规则源: {len(domain_rules)}, 总规则数: {sum(len(rules) for rules in domain_rules.values())}")
-    logger.info(f"正则规则源: {len(regex_rules)}, 总规则数: {sum(len(rules) for rules in regex_rules.values())}")
-    logger.info(f"Hosts规则源: {len(hosts_rules)}, 总规则数: {sum(len(rules) for rules in hosts_rules.values())}")
+    totals = count_compiled_rules()
+    logger.info(f"已加载规则源: {len(compiled_rules)}, 各类规则数: {totals}")
 
-def query_domain_internal(domain: str) -> DomainQueryResult:
-    """内部域名查询函数，支持返回多个匹配规则"""
-    start_time = time.time()
-    
-    # 检查缓存
-    cache_key = f"query:{domain.lower()}"
-    cached_result = query_cache.get(cache_key)
-    if cached_result:
-        return cached_result
-    
-    result = DomainQueryResult(
-        domain=domain,
-        blocked=False,
-        matched_rules=[],
-        query_time=int(time.time() * 1000),
-        duration=0
-    )
-    
-    lower_domain = domain.lower()
-    matched_rules = []
-    
-    # 1. 检查域名规则
-    for source_url, domains in domain_rules.items():
-        # 精确匹配
-        if lower_domain in domains:
-            matched_rules.append(MatchedRule(
-                rule=lower_domain,
-                rule_source=get_rule_source_name(source_url),
-                rule_source_url=source_url,
-                rule_type="domain"
-            ))
-        else:
-            # 子域名匹配
-            for rule_domain in domains:
-                if lower_domain.endswith('.' + rule_domain):
-                    matched_rules.append(MatchedRule(
-                        rule=rule_domain,
-                        rule_source=get_rule_source_name(source_url),
-                        rule_source_url=source_url,
-                        rule_type="domain"
-                    ))
-                    break  # 同一个源只匹配一个规则
-    
-    # 2. 检查Hosts规则
-    for source_url, hosts in hosts_rules.items():
-        if lower_domain in hosts:
-            matched_rules.append(MatchedRule(
-                rule=lower_domain,
-                rule_source=get_rule_source_name(source_url),
-                rule_source_url=source_url,
-                rule_type="hosts"
-            ))
-        else:
-            # 子域名匹配
-            for host_domain in hosts:
-                if lower_domain.endswith('.' + host_domain):
-                    matched_rules.append(MatchedRule(
-                        rule=host_domain,
-                        rule_source=get_rule_source_name(source_url),
-                        rule_source_url=source_url,
-                        rule_type="hosts"
-                    ))
-                    break  # 同一个源只匹配一个规则
-    
-    # 3. 检查正则规则
-    for source_url, patterns in regex_rules.items():
-        for pattern in patterns:
-            try:
-                if pattern.search(lower_domain):
-                    matched_rules.append(MatchedRule(
-                        rule=pattern.pattern,
-                        rule_source=get_rule_source_name(source_url),
-                        rule_source_url=source_url,
-                        rule_type="regex"
-                    ))
-                    break  # 同一个源只匹配一个正则规则
-            except Exception as e:
-                logger.debug(f"正则匹配错误: {pattern.pattern} - {e}")
-    
-    # 设置结果
-    result.matched_rules = matched_rules
-    result.blocked = len(matched_rules) > 0
+class RefreshCoordinator:
+    """刷新任务协调器：相同范围（单个规则源或全部）的并发刷新请求加入已在进行的任务"""
+
+    ALL = '*'
+
+    def __init__(self, max_history: int = 50):
+        self._lock = threading.Lock()
+        self._jobs: Dict[str, RefreshJob] = {}
+        self._active: Dict[str, RefreshJob] = {}  # 范围 -> 进行中的任务
+        self._max_history = max_history
+
+    def submit(self, url: Optional[str] = None) -> tuple:
+        """提交刷新任务，返回 (任务, 是否加入了已有任务)"""
+        scope = url or self.ALL
+        with self._lock:
+            # 全量刷新进行中时，单个规则源的刷新请求直接加入全量任务
+            active = self._active.get(scope) or (self._active.get(self.ALL) if url else None)
+            if active is not None:
+                return active, True
+            job = RefreshJob(
+                id=hashlib.sha1(f"{scope}:{time.time_ns()}".encode('utf-8')).hexdigest()[:12],
+                scope=scope,
+                created=int(time.time() * 1000)
+            )
+            self._active[scope] = job
+            self._jobs[job.id] = job
+            while len(self._jobs) > self._max_history:
+                oldest = next(iter(self._jobs))
+                if self._jobs[oldest].status in ('queued', 'running'):
+                    break
+                del self._jobs[oldest]
+        threading.Thread(target=self._run, args=(job,), name=f"refresh-job-{job.id}", daemon=True).start()
+        return job, False
+
+    def get(self, job_id: str) -> Optional["RefreshJob"]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _run(self, job: "RefreshJob"):
+        job.status = 'running'
+        job.started = int(time.time() * 1000)
+        event_broadcaster.publish('refresh', refresh_job_to_dict(job))
+        try:
+            if job.scope == self.ALL:
+                update_all_rules(job)
+            else:
+                job.total = 1
+                source = rule_sources.get(job.scope)
+                ok = refresh_source(source) if source else False
+                job.completed = 1
+                job.failed = 0 if ok else 1
+            job.status = 'completed' if job.failed == 0 else 'completed_with_errors'
+        except Exception as e:
+            logger.error(f"刷新任务失败: {job.id} - {e}")
+            job.status = 'failed'
+            job.error = str(e)
+        finally:
+            job.finished = int(time.time() * 1000)
+            with self._lock:
+                if self._active.get(job.scope) is job:
+                    del self._active[job.scope]
+            event_broadcaster.publish('refresh', refresh_job_to_dict(job))
+
+refresh_coordinator = RefreshCoordinator()
+
+# 共享查询缓存（Redis 协议），多个副本共用查询结果；未配置时只使用进程内缓存
+SHARED_CACHE_URL = os.environ.get('SHARED_CACHE_URL', '')  # redis://[:password@]host:6379/0
+SHARED_CACHE_PREFIX = os.environ.get('SHARED_CACHE_PREFIX', 'wbyd:query')
+SHARED_CACHE_TTL = int(os.environ.get('SHARED_CACHE_TTL', 3600))
+SHARED_CACHE_TIMEOUT = int(os.environ.get('SHARED_CACHE_TIMEOUT_MS', 50)) / 1000
+SHARED_CACHE_BATCH = max(1, int(os.environ.get('SHARED_CACHE_BATCH', 100)))
+SHARED_CACHE_MAX_PENDING = max(1, int(os.environ.get('SHARED_CACHE_MAX_PENDING', 10000)))
+SHARED_CACHE_RETRY_INTERVAL = int(os.environ.get('SHARED_CACHE_RETRY_INTERVAL', 30))
+
+class RespError(Exception):
+    """Redis 协议返回的错误响应"""
+
+class RespClient:
+    """最小的 Redis 协议（RESP2）客户端，只实现查询缓存需要的单条命令与流水线"""
+
+    def __init__(self, host: str, port: int, db: int = 0, password: Optional[str] = None,
+                 timeout: float = SHARED_CACHE_TIMEOUT):
+        self._sock = socket.create_connection((host, port), timeout)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._file = self._sock.makefile('rb')
+        try:
+            if password:
+                self.execute('AUTH', password)
+            if db:
+                self.execute('SELECT', db)
+        except Exception:
+            self.close()
+            raise
+
+    @staticmethod
+    def _encode(args) -> bytes:
+        out = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode('utf-8')
+            out.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        return b''.join(out)
+
+    def _read(self):
+        line = self._file.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError("共享缓存连接已关闭")
+        kind, body = line[:1], line[1:-2]
+        if kind == b'+':
+            return body
+        if kind == b'-':
+            return RespError(body.decode('utf-8', 'replace'))
+        if kind == b':':
+            return int(body)
+        if kind == b'$':
+            size = int(body)
+            return None if size < 0 else self._file.read(size + 2)[:-2]
+        if kind == b'*':
+            size = int(body)
+            return None if size < 0 else [self._read() for _ in range(size)]
+        raise ConnectionError(f"无法解析的共享缓存响应: {line[:32]!r}")
+
+    def execute(self, *args):
+        self._sock.sendall(self._encode(args))
+        reply = self._read()
+        if isinstance(reply, RespError):
+            raise reply
+        return reply
+
+    def pipeline(self, commands: List[tuple]) -> list:
+        """一次发送多条命令再依次读取响应，错误响应以 RespError 对象返回"""
+        self._sock.sendall(b''.join(self._encode(args) for args in commands))
+        return [self._read() for _ in commands]
+
+    def close(self):
+        try:
+            self._sock.close()
+        except OSError:
+            pass
+
+class SharedQueryCache:
+    """
+    进程外的第二级查询缓存。键包含索引指纹，规则变化后旧结果不再被读到并随 TTL 过期；
+    写入进入队列由后台线程批量流水线提交，共享缓存不可用时读写直接跳过，按间隔重试
+    """
+
+    def __init__(self, url: str = SHARED_CACHE_URL):
+        self.enabled = bool(url)
+        parsed = urlparse(url) if url else None
+        self._host = parsed.hostname if parsed else None
+        self._port = (parsed.port or 6379) if parsed else 6379
+        self._db = int((parsed.path or '/0').strip('/') or 0) if parsed else 0
+        self._password = parsed.password if parsed else None
+        self._local = threading.local()
+        self._pending: queue.Queue = queue.Queue(maxsize=SHARED_CACHE_MAX_PENDING)
+        self._writer: Optional[threading.Thread] = None
+        self._writer_lock = threading.Lock()
+        self._down_until = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.writes = 0
+        self.dropped = 0
+
+    def _client(self, timeout: float = SHARED_CACHE_TIMEOUT) -> RespClient:
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = RespClient(
+                self._host, self._port, self._db, self._password, timeout
+            )
+        return client
+
+    def _fail(self, error: Exception):
+        client = getattr(self._local, 'client', None)
+        if client is not None:
+            client.close()
+            self._local.client = None
+        self.errors += 1
+        if self.available():
+            logger.warning(f"共享缓存不可用，{SHARED_CACHE_RETRY_INTERVAL} 秒内只使用本地缓存: {error}")
+        self._down_until = time.monotonic() + SHARED_CACHE_RETRY_INTERVAL
+
+    def available(self) -> bool:
+        return self.enabled and time.monotonic() >= self._down_until
+
+    @staticmethod
+    def key(fingerprint: str, domain: str) -> str:
+        return f"{SHARED_CACHE_PREFIX}:{fingerprint}:{domain}"
+
+    def get(self, fingerprint: str, domain: str) -> Optional[DomainQueryResult]:
+        if not self.available():
+            return None
+        try:
+            data = self._client().execute('GET', self.key(fingerprint, domain))
+        except (OSError, RespError, ValueError) as e:
+            self._fail(e)
+            return None
+        if data is None:
+            self.misses += 1
+            return None
+        try:
+            result = DomainQueryResult.from_cache(loads_json(data))
+        except (ValueError, TypeError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return result
+
+    def put(self, fingerprint: str, domain: str, result: DomainQueryResult):
+        if not self.available():
+            return
+        if self._writer is None:
+            self._start_writer()
+        try:
+            self._pending.put_nowait((self.key(fingerprint, domain), dumps_json(result.to_cache())))
+        except queue.Full:
+            self.dropped += 1
+
+    def _start_writer(self):
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name='shared-cache-writer', daemon=True)
+                self._writer.start()
+
+    def _write_loop(self):
+        while True:
+            batch = [self._pending.get()]
+            while len(batch) < SHARED_CACHE_BATCH:
+                try:
+                    batch.append(self._pending.get_nowait())
+                except queue.Empty:
+                    break
+            if not self.available():
+                self.dropped += len(batch)
+                continue
+            try:
+                replies = self._client(max(SHARED_CACHE_TIMEOUT, 1.0)).pipeline(
+                    [('SET', key, value, 'EX', SHARED_CACHE_TTL) for key, value in batch]
+                )
+                failed = sum(1 for reply in replies if isinstance(reply, RespError))
+                self.writes += len(batch) - failed
+                self.dropped += failed
+            except (OSError, RespError, ValueError) as e:
+                # 包括连接时 AUTH/SELECT 失败与无法解析的响应，写入线程继续运行，按间隔重试
+                self._fail(e)
+                self.dropped += len(batch)
+            except Exception as e:
+                logger.error(f"共享缓存写入失败: {e}")
+                self.dropped += len(batch)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'enabled': self.enabled,
+            'available': self.available(),
+            'server': f"{self._host}:{self._port}/{self._db}" if self.enabled else None,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hitRatio': round(self.hits / lookups, 4) if lookups else 0.0,
+            'errors': self.errors,
+            'writes': self.writes,
+            'pendingWrites': self._pending.qsize(),
+            'droppedWrites': self.dropped,
+            'ttl': SHARED_CACHE_TTL
+        }
+
+shared_query_cache = SharedQueryCache()
+local_cache_hits = 0  # 进程内缓存命中/未命中（近似计数，不加锁）
+local_cache_misses = 0
+
+def query_cache_stats() -> dict:
+    """两级查询缓存各自的命中率"""
+    lookups = local_cache_hits + local_cache_misses
+    return {
+        'local': {
+            'hits': local_cache_hits,
+            'misses': local_cache_misses,
+            'hitRatio': round(local_cache_hits / lookups, 4) if lookups else 0.0,
+            'size': len(query_cache),
+            'capacity': query_cache.maxsize,
+            'ttl': query_cache.ttl
+        },
+        'shared': shared_query_cache.stats(),
+        'warmup': cache_warmer.stats(),
+        'generation': index_generation,
+        'fingerprint': index_fingerprint
+    }
+
+def get_cached_query_result(domain: str) -> Optional[DomainQueryResult]:
+    """只查缓存，不做计算"""
+    return query_cache.get(f"query:{domain.lower()}")
+
+def note_local_cache_hit():
+    """接口直接从进程内缓存返回结果时计数"""
+    global local_cache_hits
+    local_cache_hits += 1
+
+def query_domain_internal(domain: str) -> DomainQueryResult:
+    """内部域名查询函数，支持返回多个匹配规则"""
+    global local_cache_hits, local_cache_misses
+    # 检查缓存
+    cache_key = f"query:{domain.lower()}"
+    cached_result = query_cache.get(cache_key)
+    if cached_result:
+        local_cache_hits += 1
+        return cached_result
+    local_cache_misses += 1
     
-    # 为了向后兼容，设置第一个匹配的规则
-    if matched_rules:
-        first_match = matched_rules[0]
-        result.matched_rule = first_match.rule
-        result.rule_source = first_match.rule_source
-        result.rule_type = first_match.rule_type
+    # 相同域名的并发未命中只计算一次
+    return query_flight.do(cache_key, _compute_domain_query, domain, cache_key)
+
+def _compute_domain_query(domain: str, cache_key: str) -> DomainQueryResult:
+    # 等待期间其他调用可能已经写入缓存
+    cached_result = query_cache.get(cache_key)
+    if cached_result:
+        return cached_result
     
-    result.duration = int((time.time() - start_time) * 1000)
+    # 本地未命中时先查共享缓存；代数与指纹在计算前取得，计算期间发布了新规则时结果不写入任何缓存
+    with _publish_lock:
+        generation = index_generation
+        fingerprint = index_fingerprint
+    result = shared_query_cache.get(fingerprint, domain) if shared_query_cache.enabled else None
+    computed = result is None
+    if computed:
+        regex_sandbox.begin()
+        result = evaluate_domain(domain)
+        if regex_sandbox.incomplete():
+            # 隔离模式因繁忙或超时未得出结果，判定取决于当时的负载，不写入任何缓存
+            return result
     
-    # 缓存结果
-    query_cache[cache_key] = result
+    # 发布在同一把锁内递增代数并清空缓存，代数未变说明结果与当前规则一致
+    with _publish_lock:
+        current = index_generation == generation
+        if current:
+            query_cache[cache_key] = result
+    if current and computed and shared_query_cache.enabled:
+        shared_query_cache.put(fingerprint, domain, result)
     
     return result
 
-def get_rule_source_name(url: str) -> str:
-    """获取规则源名称"""
-    source = rule_sources.get(url)
-    return source.name if source else url
+def evaluate_domain(domain: str) -> DomainQueryResult:
+    """对所有已发布的规则源计算域名的判定，不读写缓存"""
+    start_time = time.time()
+    
+    lower_domain = domain.lower()
+    
+    # 预先计算域名的各级后缀，所有规则源共用: a.b.com -> [a.b.com, b.com, com]
+    labels = lower_domain.split('.')
+    suffixes = ['.'.join(labels[i:]) for i in range(len(labels))]
+    badfilters = badfilter_rules
+    
+    # 每个规则源在一次后缀遍历中同时匹配拦截、白名单与 $important 规则，同一个源每种类型只匹配一个规则
+    matched_by_type: Dict[str, list] = {"domain": [], "hosts": [], "regex": []}
+    exceptions = []
+    for source_url, compiled in list(compiled_rules.items()):
+        blocks, overridden = compiled.evaluate(lower_domain, labels, suffixes, badfilters)
+        if not blocks and not overridden:
+            continue
+        for rule, rule_type in blocks:
+            matched_by_type[rule_type].append((rule, source_url, rule_type))
+        for allow_rule, allow_type, block_rule, block_type in overridden:
+            exceptions.append((allow_rule, allow_type, block_rule, block_type, source_url))
+    
+    # 依次为域名规则、Hosts规则、正则规则
+    matches = tuple(matched_by_type["domain"] + matched_by_type["hosts"] + matched_by_type["regex"])
+    
+    return DomainQueryResult(
+        domain, matches, tuple(exceptions),
+        int(start_time * 1000), int((time.time() - start_time) * 1000)
+    )
+
+def explain_domain(domain: str) -> tuple:
+    """
+    与 evaluate_domain 相同的判定，并记录各阶段耗时（微秒）、检查的候选数、探测的后缀与跳过的规则源，
+    返回 (查询结果, 诊断信息)，两者来自同一次计算。只在请求 explain 时走这条路径，普通查询不承担计时开销
+    """
+    perf_counter = time.perf_counter
+    total_start = perf_counter()
+    start_time = time.time()
+
+    lower_domain = domain.lower()
+    start = perf_counter()
+    cached = get_cached_query_result(lower_domain)
+    cache_us = (perf_counter() - start) * 1e6
+
+    labels = lower_domain.split('.')
+    suffixes = ['.'.join(labels[i:]) for i in range(len(labels))]
+    badfilters = badfilter_rules
+    stages = {
+        'domainIndex': {'us': 0.0, 'candidates': 0, 'sources': 0},
+        'regexPrefilter': {'us': 0.0, 'candidates': 0, 'quarantined': 0, 'skippedSources': []},
+        'regex': {'us': 0.0, 'candidates': 0, 'sources': 0}
+    }
+    domain_stage = stages['domainIndex']
+    prefilter_stage, regex_stage = stages['regexPrefilter'], stages['regex']
+    quarantined = regex_cache.quarantined
+    per_source = []
+    matched_by_type: Dict[str, list] = {"domain": [], "hosts": [], "regex": []}
+    exceptions = []
+
+    for source_url, compiled in list(compiled_rules.items()):
+        source_name = get_rule_source_name(source_url)
+
+        # 域名索引：exact 一次，每级后缀查 suffix（及 special、hosts），再加挂在后缀上的通配符条目
+        start = perf_counter()
+        domain_found, host_rule = compiled.match_domain(lower_domain, labels, suffixes, badfilters)
+        domain_us = (perf_counter() - start) * 1e6
+        probes = 1 + len(suffixes) * (1 + bool(compiled.special) + bool(compiled.hosts))
+        if compiled.wildcard:
+            probes += sum(len(compiled.wildcard.get(s, ())) for s in suffixes[1:])
+        domain_stage['us'] += domain_us
+        domain_stage['candidates'] += probes
+        domain_stage['sources'] += 1
+
+        # 正则预筛：没有正则规则的源整体跳过，被隔离的模式交给隔离进程
+        start = perf_counter()
+        has_regex = bool(compiled.regex or compiled.regex_special)
+        if has_regex:
+            keys = [key for key in compiled.regex.values()]
+            keys.extend(key for key, _ in compiled.regex_special.values())
+            prefilter_stage['candidates'] += len(keys)
+            prefilter_stage['quarantined'] += sum(1 for key in keys if key in quarantined)
+        else:
+            prefilter_stage['skippedSources'].append(source_name)
+        prefilter_stage['us'] += (perf_counter() - start) * 1e6
+
+        regex_us = 0.0
+        regex_found = (None, None, None, None)
+        if has_regex:
+            start = perf_counter()
+            regex_found = compiled.match_regex(lower_domain)
+            regex_us = (perf_counter() - start) * 1e6
+            regex_stage['us'] += regex_us
+            regex_stage['candidates'] += len(compiled.regex) + len(compiled.regex_special)
+            regex_stage['sources'] += 1
+
+        blocks, overridden = CompiledRules.resolve(domain_found, host_rule, regex_found)
+        for rule, rule_type in blocks:
+            matched_by_type[rule_type].append((rule, source_url, rule_type))
+        for allow_rule, allow_type, block_rule, block_type in overridden:
+            exceptions.append((allow_rule, allow_type, block_rule, block_type, source_url))
+        per_source.append({
+            'source': source_name,
+            'domainUs': round(domain_us, 1),
+            'regexUs': round(regex_us, 1),
+            'blocked': [rule for rule, _ in blocks],
+            'allowed': [allow for allow, _, _, _ in overridden]
+        })
+
+    for stage in stages.values():
+        stage['us'] = round(stage['us'], 1)
+    result = DomainQueryResult(
+        domain,
+        tuple(matched_by_type["domain"] + matched_by_type["hosts"] + matched_by_type["regex"]),
+        tuple(exceptions),
+        int(start_time * 1000), int((time.time() - start_time) * 1000)
+    )
+    return result, {
+        'totalUs': round((perf_counter() - total_start) * 1e6, 1),
+        'cache': {'us': round(cache_us, 1), 'hit': cached is not None},
+        'suffixesProbed': suffixes,
+        'stages': stages,
+        'sources': per_source
+    }
+
+def publish_compiled_rules(url: str, compiled: Optional[CompiledRules], digest: Optional[str] = None):
+    """发布（或移除）规则源的编译结果，同步跨规则源生效的 $badfilter 集合并增量维护统计"""
+    publish_compiled_batch({url: (compiled, digest)})
+
+def publish_compiled_batch(updates: Dict[str, tuple]):
+    """
+    一次发布多个规则源 {URL: (编译结果或 None, 内容哈希)}，只递增一次代数、
+    清空一次缓存并推送一次统计（从节点应用主节点的快照或增量时使用）
+    """
+    global badfilter_rules, index_generation, index_fingerprint, delta_floor
+    with _publish_lock:
+        index_generation += 1
+        for url, (compiled, digest) in updates.items():
+            if compiled is not None:
+                # 解析期间登记的键可能已被其他发布清理，重新登记以恢复共享与隔离标记
+                compiled.intern_regex()
+            if compiled is None:
+                compiled_rules.pop(url, None)
+                source_content_hashes.pop(url, None)
+                if source_generations.pop(url, None) is not None:
+                    removed_generations[url] = index_generation
+                    if len(removed_generations) > 1024:
+                        oldest = next(iter(removed_generations))
+                        delta_floor = max(delta_floor, removed_generations.pop(oldest))
+                new_counts = {}
+            else:
+                compiled_rules[url] = compiled
+                if digest:
+                    source_content_hashes[url] = digest
+                else:
+                    source_content_hashes.pop(url, None)
+                source_generations[url] = index_generation
+                removed_generations.pop(url, None)
+                new_counts = compiled.kind_counts()
+            old_counts = source_kind_counts.pop(url, {})
+            if new_counts:
+                source_kind_counts[url] = new_counts
+            for kind in rule_kind_totals:
+                rule_kind_totals[kind] += new_counts.get(kind, 0) - old_counts.get(kind, 0)
+        index_fingerprint = _compute_index_fingerprint()
+        # 规则变化后缓存的查询结果失效
+        query_cache.clear()
+        merged = set()
+        live_regex = set()
+        for rules in list(compiled_rules.values()):
+            merged |= rules.badfilter
+            live_regex.update(rules.regex.values())
+            live_regex.update(key for key, _ in rules.regex_special.values())
+        badfilter_rules = merged
+        regex_cache.prune(live_regex)
+        # 压缩时依赖的祖先规则被新发布的 $badfilter 禁用后，被移除的子域名规则需要恢复
+        disabled = badfiltered_suffixes(merged)
+        stale = [
+            url for url, rules in compiled_rules.items() if not rules.covering.isdisjoint(disabled)
+        ] if disabled else []
+    event_broadcaster.publish('statistics', build_statistics())
+    cache_warmer.trigger()
+    if stale and cluster_follower is None:
+        # 从节点没有原始规则，由主节点重新构建后以增量下发
+        rebuild_compacted_sources(stale)
+
+def rebuild_compacted_sources(urls: List[str]):
+    """从本地保存的原始规则重新解析并发布压缩结果已失效的规则源（解析时排除当前被禁用的祖先）"""
+    updates, parsed = {}, {}
+    for url in urls:
+        digest = source_content_hashes.get(url)
+        try:
+            if digest not in parsed:
+                parsed[digest] = parse_rules(rule_sources.get(url), read_raw_rules(digest),
+                                             SOURCE_MAX_RULES, SOURCE_MAX_REGEX)
+            updates[url] = (parsed[digest], digest)
+        except Exception as e:
+            logger.warning(f"重新构建压缩索引失败: {url} - {e}")
+    if updates:
+        logger.info(f"$badfilter 禁用了压缩时使用的祖先规则，重新构建 {len(updates)} 个规则源")
+        publish_compiled_batch(updates)
+
+def _compute_index_fingerprint() -> str:
+    """由各规则源的内容哈希计算索引指纹，内容不变时重启后保持不变，可用作 ETag"""
+    h = hashlib.sha256(f"{COMPILED_SNAPSHOT_VERSION}:{RULE_COMPACTION}".encode('utf-8'))
+    for url in sorted(compiled_rules):
+        # 没有内容哈希的索引（如直接发布的编译结果）退化为按进程与代数区分
+        digest = source_content_hashes.get(url) or f"{BOOT_ID}:{index_generation}"
+        h.update(f"{url}\0{get_rule_source_name(url)}\0{digest}\n".encode('utf-8'))
+    return h.hexdigest()[:16]
+
+def count_compiled_rules() -> Dict[str, int]:
+    """按编译后的规则类型汇总所有规则源的规则数（发布时增量维护）"""
+    return dict(rule_kind_totals)
+
+def build_statistics() -> dict:
+    """由发布时维护的计数生成统计信息，不遍历规则"""
+    kind_counts = count_compiled_rules()
+    return {
+        "totalSources": len(rule_sources),
+        "enabledSources": enabled_source_count,
+        "domainRules": kind_counts['suffix'] + kind_counts['exact'] + kind_counts['wildcard'],
+        "regexRules": kind_counts['regex'],
+        "hostsRules": kind_counts['hosts'],
+        "lastUpdate": last_rule_update,
+        "cacheSize": len(query_cache),
+        "compiledRules": kind_counts,
+        "indexMemory": {
+            "estimatedBytes": index_memory_usage(),
+            "budgetBytes": INDEX_MEMORY_BUDGET
+        }
+    }
+
+def register_rule_source(source: RuleSource):
+    """添加或替换规则源，同步维护启用计数"""
+    global enabled_source_count
+    with _publish_lock:
+        old = rule_sources.get(source.url)
+        if old is not None and old.enabled:
+            enabled_source_count -= 1
+        rule_sources[source.url] = source
+        if source.enabled:
+            enabled_source_count += 1
+
+def unregister_rule_source(url: str) -> Optional[RuleSource]:
+    """移除规则源，同步维护启用计数"""
+    global enabled_source_count
+    with _publish_lock:
+        old = rule_sources.pop(url, None)
+        if old is not None and old.enabled:
+            enabled_source_count -= 1
+        return old
+
+def mark_index_ready(origin: str):
+    """首次发布索引后标记服务就绪"""
+    global index_ready, index_ready_origin
+    if index_ready:
+        return
+    index_ready = True
+    index_ready_origin = origin
+    logger.info(f"规则索引已就绪 (来源: {origin}, 规则源: {len(compiled_rules)})")
+
+def load_rules_snapshot(sources: List[RuleSource]):
+    """启动时从本地保存的原始规则恢复索引，无需等待网络下载"""
+    global last_rule_update
+    manifest = load_rules_manifest()
+    loaded = 0
+    for source in sources:
+        entry = manifest.get(source.url)
+        if not source.enabled or not entry or source.url in source_content_hashes:
+            continue
+        digest = entry.get('hash')
+        try:
+            mirror_url = next(
+                (url for url, h in source_content_hashes.items() if h == digest),
+                None
+            )
+            if mirror_url is not None:
+                compiled = compiled_rules[mirror_url]
+            else:
+                content = read_raw_rules(digest)
+                compiled = parse_rules(source, content, SOURCE_MAX_RULES, SOURCE_MAX_REGEX)
+                source.expires = parse_expires(content)
+            # 网络刷新已先完成时不再用本地内容覆盖
+            if source.url in source_content_hashes:
+                continue
+            check_memory_budget(source.url, compiled)
+            publish_compiled_rules(source.url, compiled, digest)
+            source.rule_count = compiled.rule_count
+            source.last_updated = entry.get('stored')
+            last_rule_update = max(last_rule_update, source.last_updated or 0)
+            source.status = "已从本地加载"
+            event_broadcaster.publish('source', rule_source_to_dict(source))
+            loaded += 1
+        except SourceQuotaExceeded as e:
+            logger.warning(f"本地规则超出资源限制，跳过: {source.url} - {e}")
+            source.status = f"超出限制: {e}"
+            event_broadcaster.publish('source', rule_source_to_dict(source))
+        except Exception as e:
+            logger.warning(f"从本地加载规则源失败: {source.url} - {e}")
+    logger.info(f"已从本地恢复 {loaded} 个规则源")
+    if loaded:
+        mark_index_ready('snapshot')
+
+COMPILED_SNAPSHOT_VERSION = 3
+
+def save_compiled_snapshot(path: str):
+    """把当前已发布的编译索引序列化到文件，镜像共享的索引只保存一份"""
+    with _publish_lock:
+        rules = dict(compiled_rules)
+        data = {
+            'version': COMPILED_SNAPSHOT_VERSION,
+            'generation': index_generation,
+            'created': int(time.time() * 1000),
+            'sources': [rule_source_to_dict(rule_sources[url]) for url in rules if url in rule_sources],
+            'hashes': {url: source_content_hashes.get(url) for url in rules},
+            'rules': rules
+        }
+    _atomic_write(path, pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL))
+
+def load_compiled_snapshot(path: str) -> int:
+    """从编译索引快照恢复并发布规则，返回加载的规则源数"""
+    with open(path, 'rb') as f:
+        data = pickle.load(f)
+    if data.get('version') != COMPILED_SNAPSHOT_VERSION:
+        raise ValueError(f"不支持的快照版本: {data.get('version')}")
+    sources = {s['url']: s for s in data.get('sources', [])}
+    for url, compiled in data['rules'].items():
+        compiled.intern_regex()
+        info = sources.get(url, {})
+        source = rule_sources.get(url) or RuleSource(url=url, name=info.get('name') or url)
+        source.rule_count = compiled.rule_count
+        source.last_updated = info.get('lastUpdated')
+        source.status = "已从快照加载"
+        register_rule_source(source)
+        publish_compiled_rules(url, compiled, data.get('hashes', {}).get(url))
+    if data['rules']:
+        mark_index_ready('snapshot')
+    return len(data['rules'])
+
+# 集群：主节点下载解析规则并通过 HTTP 发布版本化的全量快照与增量，从节点只拉取并应用，不再各自下载
+# 版本由主节点的 BOOT_ID（epoch）与索引代数组成，主节点重启后代数重新计数，从节点改为拉取全量。
+# 快照为 gzip 压缩的 JSON（不含可执行内容），并以 CLUSTER_TOKEN 为密钥做 HMAC-SHA256 签名，从节点验证后才解析
+CLUSTER_WIRE_VERSION = 1
+CLUSTER_ROLE = os.environ.get('CLUSTER_ROLE', 'standalone').lower()  # standalone / leader / follower
+CLUSTER_LEADER_URL = os.environ.get('CLUSTER_LEADER_URL', '').rstrip('/')
+CLUSTER_TOKEN = os.environ.get('CLUSTER_TOKEN', '')
+CLUSTER_POLL_INTERVAL = float(os.environ.get('CLUSTER_POLL_INTERVAL', 10))
+CLUSTER_NODE_ID = os.environ.get('CLUSTER_NODE_ID') or f"{socket.gethostname()}-{BOOT_ID}"
+CLUSTER_FOLLOWER_TTL = 300  # 超过该秒数未上报的从节点不再显示
+CLUSTER_MAX_FOLLOWERS = 256  # 主节点最多记录的从节点数
+CLUSTER_SIGNATURE_HEADER = 'X-Cluster-Signature'
+
+def check_cluster_config():
+    """主从模式必须设置 CLUSTER_TOKEN：它既用于从节点访问主节点，也是快照签名的密钥"""
+    if CLUSTER_ROLE not in ('standalone', 'leader', 'follower'):
+        raise RuntimeError(f"不支持的 CLUSTER_ROLE: {CLUSTER_ROLE}")
+    if CLUSTER_ROLE != 'standalone' and not CLUSTER_TOKEN:
+        raise RuntimeError(f"CLUSTER_ROLE={CLUSTER_ROLE} 需要设置 CLUSTER_TOKEN")
+    if CLUSTER_ROLE == 'follower' and not CLUSTER_LEADER_URL:
+        raise RuntimeError("CLUSTER_ROLE=follower 需要设置 CLUSTER_LEADER_URL")
+
+def sign_cluster_payload(body: bytes) -> str:
+    return hmac.new(CLUSTER_TOKEN.encode(), body, hashlib.sha256).hexdigest()
+
+def check_cluster_token(request: Request):
+    """主节点接口校验 Authorization: Bearer <CLUSTER_TOKEN>"""
+    if CLUSTER_ROLE != 'leader' or not CLUSTER_TOKEN:
+        raise HTTPException(status_code=404, detail="当前节点不是主节点")
+    auth = request.headers.get('authorization', '')
+    if not hmac.compare_digest(auth[7:].encode() if auth[:7].lower() == 'bearer ' else b'', CLUSTER_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="集群令牌无效")
+
+def reject_if_follower():
+    """从节点的规则源由主节点决定，拒绝本地修改"""
+    if CLUSTER_ROLE == 'follower':
+        raise HTTPException(status_code=409, detail=f"从节点不能修改规则源，请在主节点操作: {CLUSTER_LEADER_URL}")
+
+class DeltaUnavailable(Exception):
+    """请求的基准版本无法计算增量，需要拉取全量快照"""
+
+class ClusterLeader:
+    """主节点：按需生成并缓存当前代数的全量快照与增量，同一代数只序列化一次；记录各从节点上报的版本"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._payloads: Dict[Optional[int], bytes] = {}  # 基准代数（全量为 None）-> 压缩后的快照
+        self._payload_generation = -1
+        self.followers: Dict[str, dict] = {}
+        self.served = {'full': 0, 'delta': 0, 'bytes': 0}
+
+    def manifest(self) -> dict:
+        with _publish_lock:
+            return {
+                'epoch': BOOT_ID,
+                'generation': index_generation,
+                'fingerprint': index_fingerprint,
+                'deltaFloor': delta_floor,
+                'sources': len(compiled_rules)
+            }
+
+    def report_follower(self, node: str, epoch: Optional[str], generation: Optional[int]):
+        if node not in self.followers and len(self.follower_list()) >= CLUSTER_MAX_FOLLOWERS:
+            return
+        self.followers[node] = {
+            'node': node,
+            'epoch': epoch or None,
+            'generation': generation,
+            'inSync': epoch == BOOT_ID and generation == index_generation,
+            'lastSeen': int(time.time() * 1000)
+        }
+
+    def follower_list(self) -> List[dict]:
+        cutoff = int((time.time() - CLUSTER_FOLLOWER_TTL) * 1000)
+        for node, info in list(self.followers.items()):
+            if info['lastSeen'] < cutoff:
+                self.followers.pop(node, None)
+        return sorted(self.followers.values(), key=lambda info: info['node'])
+
+    def payload(self, since: Optional[int] = None) -> tuple:
+        """返回 (代数, gzip 压缩的 JSON)；since 为 None 时为全量快照，否则为该代数之后的增量"""
+        with self._lock:
+            with _publish_lock:
+                generation = index_generation
+                if since is not None and not delta_floor <= since <= generation:
+                    raise DeltaUnavailable(f"无法计算代数 {since} 到 {generation} 的增量")
+                if generation != self._payload_generation:
+                    self._payloads.clear()
+                    self._payload_generation = generation
+                body = self._payloads.get(since)
+                if body is None:
+                    rules = {
+                        url: compiled for url, compiled in compiled_rules.items()
+                        if since is None or source_generations.get(url, 0) > since
+                    }
+                    data = {
+                        'version': CLUSTER_WIRE_VERSION,
+                        'epoch': BOOT_ID,
+                        'generation': generation,
+                        'base': since,
+                        'fingerprint': index_fingerprint,
+                        'sources': [source.model_dump() for source in rule_sources.values()],
+                        'hashes': {url: source_content_hashes.get(url) for url in rules},
+                        'removed': [] if since is None else
+                                   [url for url, removed in removed_generations.items() if removed > since]
+                    }
+            if body is None:
+                # 已发布的编译结果不再修改，可在发布锁外序列化；镜像共享的索引只保存一份，按编号引用
+                refs: Dict[int, str] = {}
+                indexes = {}
+                data['rules'] = {}
+                for url, compiled in rules.items():
+                    ref = refs.get(id(compiled))
+                    if ref is None:
+                        ref = refs[id(compiled)] = str(len(refs))
+                        indexes[ref] = compiled.to_wire()
+                    data['rules'][url] = ref
+                data['indexes'] = indexes
+                body = gzip.compress(dumps_json(data), compresslevel=1)
+                self._payloads[since] = body
+            self.served['full' if since is None else 'delta'] += 1
+            self.served['bytes'] += len(body)
+            return generation, body
+
+    def status(self) -> dict:
+        return {**self.manifest(), 'served': dict(self.served), 'followers': self.follower_list()}
+
+class ClusterFollower:
+    """从节点：定期查询主节点版本，同一 epoch 内拉取增量，否则（首次、主节点重启）拉取全量快照"""
+
+    def __init__(self, leader_url: str, interval: float = CLUSTER_POLL_INTERVAL):
+        self.leader_url = leader_url
+        self.interval = max(0.1, interval)
+        self.epoch: Optional[str] = None  # 当前提供服务的主节点版本
+        self.generation: Optional[int] = None
+        self.fingerprint: Optional[str] = None
+        self.last_sync: Optional[int] = None
+        self.last_error: Optional[str] = None
+        self.stats = {'full': 0, 'delta': 0, 'failures': 0, 'bytes': 0}
+        self._session = requests.Session()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="cluster-follower", daemon=True)
+            self._thread.start()
+            logger.info(f"以从节点模式运行，主节点: {self.leader_url}")
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.sync_once()
+            except Exception as e:
+                self.stats['failures'] += 1
+                self.last_error = str(e)
+                logger.warning(f"从主节点同步索引失败: {e}")
+            self._stop.wait(self.interval)
+
+    def _get(self, path: str, **params) -> requests.Response:
+        headers = {'Authorization': f"Bearer {CLUSTER_TOKEN}"}
+        return self._session.get(f"{self.leader_url}{path}", params=params, headers=headers, timeout=(5, 300))
+
+    def sync_once(self) -> bool:
+        """与主节点同步一次，返回是否应用了新版本"""
+        response = self._get(
+            '/api/cluster/manifest', node=CLUSTER_NODE_ID, epoch=self.epoch, generation=self.generation
+        )
+        response.raise_for_status()
+        manifest = response.json()['data']
+        self.last_sync = int(time.time() * 1000)
+        if manifest['epoch'] == self.epoch and manifest['generation'] == self.generation:
+            return False
+
+        body = None
+        if manifest['epoch'] == self.epoch and self.generation is not None:
+            response = self._get('/api/cluster/delta', epoch=self.epoch, since=self.generation)
+            if response.status_code == 410:
+                logger.info("主节点无法提供增量，改为拉取全量快照")
+            else:
+                response.raise_for_status()
+                body = response.content
+        if body is None:
+            response = self._get('/api/cluster/snapshot')
+            response.raise_for_status()
+            body = response.content
+        # 先验证签名再解压解析，未持有令牌的一方无法向从节点注入索引
+        signature = response.headers.get(CLUSTER_SIGNATURE_HEADER, '')
+        if not hmac.compare_digest(signature.encode(), sign_cluster_payload(body).encode()):
+            raise ValueError("快照签名无效，已拒绝")
+        data = loads_json(gzip.decompress(body))
+        self.apply(data)
+        self.stats['full' if data['base'] is None else 'delta'] += 1
+        self.stats['bytes'] += len(body)
+        return True
+
+    def apply(self, data: dict):
+        """应用全量快照或增量：规则源列表整体同步，编译结果在一次发布中替换"""
+        if data.get('version') != CLUSTER_WIRE_VERSION:
+            raise ValueError(f"不支持的快照版本: {data.get('version')}")
+        if data['base'] is not None and (data['epoch'] != self.epoch or data['base'] != self.generation):
+            raise ValueError(f"增量基准 {data['epoch']}:{data['base']} 与本地版本 {self.epoch}:{self.generation} 不一致")
+        if data['epoch'] == self.epoch and self.generation is not None and data['generation'] < self.generation:
+            raise ValueError(f"快照版本 {data['generation']} 早于本地版本 {self.generation}，已拒绝")
+        sources = [RuleSource(**item) for item in data['sources']]
+        for source in sources:
+            register_rule_source(source)
+        urls = {source.url for source in sources}
+        for url in list(rule_sources):
+            if url not in urls:
+                unregister_rule_source(url)
+
+        # 内容与本地已有索引相同时直接复用，镜像之间继续共享同一份编译结果
+        local = {digest: compiled_rules[url] for url, digest in list(source_content_hashes.items())
+                 if url in compiled_rules}
+        built: Dict[str, CompiledRules] = {}
+        updates = {}
+        for url, ref in data['rules'].items():
+            digest = data['hashes'].get(url)
+            compiled = local.get(digest) if digest else None
+            if compiled is None:
+                compiled = built.get(ref)
+                if compiled is None:
+                    compiled = built[ref] = CompiledRules.from_wire(data['indexes'][ref])
+            updates[url] = (compiled, digest)
+        stale = set(compiled_rules) - set(data['rules']) if data['base'] is None else set(data['removed'])
+        for url in stale:
+            updates[url] = (None, None)
+        publish_compiled_batch(updates)
+
+        self.epoch, self.generation, self.fingerprint = data['epoch'], data['generation'], data['fingerprint']
+        self.last_error = None
+        mark_index_ready('leader')
+        logger.info(
+            f"已应用主节点{'全量快照' if data['base'] is None else '增量'}: 版本 {self.epoch}:{self.generation}, "
+            f"更新 {len(data['rules'])} 个、移除 {len(stale)} 个规则源"
+        )
+
+    def status(self) -> dict:
+        return {
+            'leaderUrl': self.leader_url,
+            'epoch': self.epoch,
+            'generation': self.generation,
+            'fingerprint': self.fingerprint,
+            'consistent': self.fingerprint == index_fingerprint,
+            'lastSync': self.last_sync,
+            'lastError': self.last_error,
+            'pollInterval': self.interval,
+            **self.stats
+        }
+
+def cluster_payload_response(generation: int, body: bytes, base: Optional[int]) -> Response:
+    """快照与增量响应，版本信息放在响应头中"""
+    headers = {
+        'Cache-Control': 'no-store',
+        'X-Cluster-Epoch': BOOT_ID,
+        'X-Cluster-Generation': str(generation)
+    }
+    if base is not None:
+        headers['X-Cluster-Base'] = str(base)
+    headers[CLUSTER_SIGNATURE_HEADER] = sign_cluster_payload(body)
+    return Response(content=body, media_type='application/octet-stream', headers=headers)
+
+cluster_leader = ClusterLeader()
+cluster_follower = ClusterFollower(CLUSTER_LEADER_URL) if CLUSTER_ROLE == 'follower' else None
+
+def get_rule_source_name(url: str) -> str:
+    """获取规则源名称"""
+    source = rule_sources.get(url)
+    return source.name if source else url
+
+
+def rule_source_to_dict(source: RuleSource) -> dict:
+    """将 RuleSource 转换为前端期望的 camelCase 字段格式"""
+    return {
+        'url': source.url,
+        'name': source.name,
+        'enabled': source.enabled,
+        'lastUpdated': source.last_updated,
+        'ruleCount': source.rule_count,
+        'status': source.status,
+        'nextUpdate': source.next_update
+    }
+
+# 事件推送
+SSE_KEEPALIVE_INTERVAL = 15
+
+def format_sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+class EventBroadcaster:
+    """把规则更新事件推送给所有 SSE 订阅者；可在任意线程发布，每个事件只序列化一次"""
+
+    def __init__(self, queue_size: int = 100):
+        self._subscribers: Set[asyncio.Queue] = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue_size = queue_size
+        # 每次发布事件（规则源状态、统计变化）递增，作为规则源列表与统计接口的 ETag 版本
+        self.version = 0
+
+    def bind_loop(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+
+    def subscribe(self) -> asyncio.Queue:
+        subscriber: asyncio.Queue = asyncio.Queue(maxsize=self._queue_size)
+        self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: asyncio.Queue):
+        self._subscribers.discard(subscriber)
+
+    def publish(self, event: str, data: Any):
+        self.version += 1
+        # 没有订阅者时不做任何序列化
+        if not self._subscribers or self._loop is None:
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._deliver, format_sse(event, data))
+        except RuntimeError:
+            # 事件循环已关闭
+            pass
+
+    def _deliver(self, payload: str):
+        for subscriber in list(self._subscribers):
+            if subscriber.full():
+                # 慢客户端丢弃最旧的事件，不阻塞发布方
+                subscriber.get_nowait()
+            subscriber.put_nowait(payload)
+
+event_broadcaster = EventBroadcaster()
+
+def refresh_job_to_dict(job: RefreshJob) -> dict:
+    """将 RefreshJob 转换为前端期望的 camelCase 字段格式"""
+    return {
+        'jobId': job.id,
+        'scope': job.scope,
+        'status': job.status,
+        'created': job.created,
+        'started': job.started,
+        'finished': job.finished,
+        'total': job.total,
+        'completed': job.completed,
+        'failed': job.failed,
+        'error': job.error
+    }
+
+# 规则命中统计
+ANALYTICS_FILE = os.environ.get('ANALYTICS_FILE', 'data/analytics.json')
+ANALYTICS_SAMPLE_RATE = min(1.0, max(0.0, float(os.environ.get('ANALYTICS_SAMPLE_RATE', 1.0))))
+ANALYTICS_TOP_K = max(10, int(os.environ.get('ANALYTICS_TOP_K', 1000)))
+ANALYTICS_SHARDS = max(1, int(os.environ.get('ANALYTICS_SHARDS', 4)))
+ANALYTICS_SAVE_INTERVAL = int(os.environ.get('ANALYTICS_SAVE_INTERVAL', 300))
+
+class TopKCounter:
+    """有界的近似 Top-K 计数：超过 2K 个键时只保留计数最大的 K 个，摊销后每次计数 O(1)"""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.counts: Dict[Any, int] = {}
+
+    def add(self, key, n: int = 1):
+        counts = self.counts
+        counts[key] = counts.get(key, 0) + n
+        if len(counts) > 2 * self.capacity:
+            self._trim()
+
+    def _trim(self):
+        self.counts = dict(heapq.nlargest(self.capacity, self.counts.items(), key=lambda kv: kv[1]))
+
+    def merge(self, other: "TopKCounter"):
+        for key, n in other.counts.items():
+            self.counts[key] = self.counts.get(key, 0) + n
+        if len(self.counts) > 2 * self.capacity:
+            self._trim()
+
+    def top(self, limit: int) -> list:
+        return heapq.nlargest(limit, self.counts.items(), key=lambda kv: kv[1])
+
+class _HitShard:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queries = 0
+        self.blocked = 0
+        self.source_hits: Dict[str, int] = {}
+        self.source_last_hit: Dict[str, int] = {}
+        self.rules = TopKCounter(ANALYTICS_TOP_K)
+        self.queried = TopKCounter(ANALYTICS_TOP_K)
+        self.blocked_domains = TopKCounter(ANALYTICS_TOP_K)
+
+class HitAnalytics:
+    """分片记录查询命中（轮流写入各分片，减少与读取合并之间的锁竞争），读取时再合并；可按 ANALYTICS_SAMPLE_RATE 抽样以降低开销"""
+
+    def __init__(self, shards: int = ANALYTICS_SHARDS, sample_rate: float = ANALYTICS_SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self._shards = [_HitShard() for _ in range(max(1, shards))]
+        # 线程 ident 是按页对齐的地址，取模总落在同一分片；itertools.count 的 next 在 GIL 下是原子的
+        self._next_shard = itertools.count()
+        self._base = _HitShard()  # 从文件恢复的历史数据
+        self.since = int(time.time() * 1000)
+
+    def record(self, result: DomainQueryResult):
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        shard = self._shards[next(self._next_shard) % len(self._shards)]
+        now = int(time.time() * 1000)
+        with shard.lock:
+            shard.queries += 1
+            shard.queried.add(result.domain)
+            if result.blocked:
+                shard.blocked += 1
+                shard.blocked_domains.add(result.domain)
+            fired = set()
+            for rule, url, _ in result.matches:
+                shard.rules.add((url, rule))
+                fired.add(url)
+            for rule, _, _, _, url in result.exceptions:
+                shard.rules.add((url, rule))
+                fired.add(url)
+            for url in fired:
+                shard.source_hits[url] = shard.source_hits.get(url, 0) + 1
+                shard.source_last_hit[url] = now
+
+    def _merged(self) -> _HitShard:
+        merged = _HitShard()
+        for shard in [self._base] + self._shards:
+            with shard.lock:
+                merged.queries += shard.queries
+                merged.blocked += shard.blocked
+                for url, n in shard.source_hits.items():
+                    merged.source_hits[url] = merged.source_hits.get(url, 0) + n
+                for url, ts in shard.source_last_hit.items():
+                    merged.source_last_hit[url] = max(merged.source_last_hit.get(url, 0), ts)
+                merged.rules.merge(shard.rules)
+                merged.queried.merge(shard.queried)
+                merged.blocked_domains.merge(shard.blocked_domains)
+        return merged
+
+    def report(self, limit: int = 20) -> dict:
+        """汇总命中统计，抽样时计数按抽样率换算为估计值"""
+        merged = self._merged()
+        scale = 1.0 / self.sample_rate if self.sample_rate > 0 else 0.0
+
+        def est(n: int) -> int:
+            return int(round(n * scale))
+
+        sources = []
+        for source in list(rule_sources.values()):
+            sources.append({
+                'url': source.url,
+                'name': source.name,
+                'enabled': source.enabled,
+                'ruleCount': source.rule_count,
+                'hits': est(merged.source_hits.get(source.url, 0)),
+                'lastHit': merged.source_last_hit.get(source.url)
+            })
+        sources.sort(key=lambda s: s['hits'], reverse=True)
+        return {
+            'since': self.since,
+            'sampleRate': self.sample_rate,
+            'totalQueries': est(merged.queries),
+            'blockedQueries': est(merged.blocked),
+            'sources': sources,
+            'unusedSources': [s['url'] for s in sources if s['hits'] == 0 and s['enabled']],
+            'topRules': [
+                {'rule': rule, 'ruleSource': get_rule_source_name(url), 'ruleSourceUrl': url, 'hits': est(n)}
+                for (url, rule), n in merged.rules.top(limit)
+            ],
+            'topQueried': [{'domain': d, 'count': est(n)} for d, n in merged.queried.top(limit)],
+            'topBlocked': [{'domain': d, 'count': est(n)} for d, n in merged.blocked_domains.top(limit)]
+        }
+
+    def save(self, path: str = ANALYTICS_FILE):
+        """合并后原子写入文件，重启后继续累计"""
+        merged = self._merged()
+        data = {
+            'since': self.since,
+            'queries': merged.queries,
+            'blocked': merged.blocked,
+            'sourceHits': merged.source_hits,
+            'sourceLastHit': merged.source_last_hit,
+            'rules': [[url, rule, n] for (url, rule), n in merged.rules.counts.items()],
+            'queried': list(merged.queried.counts.items()),
+            'blockedDomains': list(merged.blocked_domains.counts.items())
+        }
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        _atomic_write(path, json.dumps(data, ensure_ascii=False).encode('utf-8'))
+
+    def load(self, path: str = ANALYTICS_FILE):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning(f"读取命中统计失败: {path} - {e}")
+            return
+        base = _HitShard()
+        base.queries = data.get('queries', 0)
+        base.blocked = data.get('blocked', 0)
+        base.source_hits = dict(data.get('sourceHits', {}))
+        base.source_last_hit = dict(data.get('sourceLastHit', {}))
+        for url, rule, n in data.get('rules', []):
+            base.rules.add((url, rule), n)
+        for domain, n in data.get('queried', []):
+            base.queried.add(domain, n)
+        for domain, n in data.get('blockedDomains', []):
+            base.blocked_domains.add(domain, n)
+        self._base = base
+        self.since = data.get('since', self.since)
+        logger.info(f"已加载命中统计: {path} (查询 {base.queries} 次)")
+
+    def popular_domains(self, limit: int) -> List[str]:
+        """查询次数最多的域名（含从文件恢复的历史），用于预热缓存"""
+        return [domain for domain, _ in self._merged().queried.top(limit)]
+
+    def reset(self):
+        self._shards = [_HitShard() for _ in range(len(self._shards))]
+        self._base = _HitShard()
+        self.since = int(time.time() * 1000)
+
+    def start_autosave(self, interval: int = ANALYTICS_SAVE_INTERVAL):
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.save()
+                except Exception as e:
+                    logger.warning(f"保存命中统计失败: {e}")
+        threading.Thread(target=loop, name="analytics-autosave", daemon=True).start()
+
+hit_analytics = HitAnalytics()
+
+# 查询缓存预热：每次发布新索引后，按限定速率重新计算热门域名并写入缓存
+WARMUP_ENABLED = os.environ.get('WARMUP_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+WARMUP_DOMAINS = max(0, int(os.environ.get('WARMUP_DOMAINS', 1000)))
+WARMUP_RATE = max(1.0, float(os.environ.get('WARMUP_RATE', 500)))  # 每秒预热的域名数
+WARMUP_DEBOUNCE = float(os.environ.get('WARMUP_DEBOUNCE', 2))  # 合并连续发布（如全量刷新）的等待秒数
+
+class CacheWarmer:
+    """
+    发布索引后在后台线程中预热热门域名。连续发布只在最后一次之后预热一次，
+    预热期间索引再次变化时放弃本轮（缓存已被清空）等待下一轮
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.runs = 0
+        self.last: Optional[dict] = None
+        self.current: Optional[dict] = None
+
+    def start(self):
+        if not WARMUP_ENABLED or WARMUP_DOMAINS == 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, name="cache-warmer", daemon=True)
+        self._thread.start()
+
+    def trigger(self):
+        """索引发布后调用；未启动时（如离线批量查询）不做任何事"""
+        if self._thread is not None:
+            self._event.set()
+
+    def _loop(self):
+        while True:
+            self._event.wait()
+            # 等待连续发布结束
+            while self._event.is_set():
+                self._event.clear()
+                time.sleep(WARMUP_DEBOUNCE)
+            try:
+                self._run()
+            except Exception as e:
+                logger.warning(f"缓存预热失败: {e}")
+                self.current = None
+
+    def _run(self):
+        domains = hit_analytics.popular_domains(WARMUP_DOMAINS)
+        if not domains:
+            return
+        generation = index_generation
+        run = self.current = {
+            'generation': generation,
+            'started': int(time.time() * 1000),
+            'status': 'running',
+            'planned': len(domains),
+            'warmed': 0,
+            'alreadyCached': 0
+        }
+        start = time.perf_counter()
+        interval = 1.0 / WARMUP_RATE
+        for i, domain in enumerate(domains):
+            if index_generation != generation:
+                run['status'] = 'superseded'
+                break
+            cache_key = f"query:{domain}"
+            if cache_key in query_cache:
+                run['alreadyCached'] += 1
+            else:
+                # 与查询共用 single-flight，不计入命中率与命中统计
+                query_flight.do(cache_key, _compute_domain_query, domain, cache_key)
+                run['warmed'] += 1
+            # 按速率限制：提前完成时休眠到预定时间
+            delay = (i + 1) * interval - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+        else:
+            run['status'] = 'completed'
+        done = run['warmed'] + run['alreadyCached']
+        run['durationMs'] = int((time.perf_counter() - start) * 1000)
+        run['coverage'] = round(done / len(domains), 4)
+        self.runs += 1
+        self.last = run
+        self.current = None
+        logger.info(
+            f"缓存预热{'完成' if run['status'] == 'completed' else '中断（索引已更新）'}: "
+            f"{done}/{len(domains)} 个热门域名，耗时 {run['durationMs']}ms"
+        )
+
+    def stats(self) -> dict:
+        """最近一轮的耗时与覆盖率，以及热门域名当前在缓存中的比例"""
+        domains = hit_analytics.popular_domains(WARMUP_DOMAINS) if WARMUP_DOMAINS else []
+        cached = sum(1 for domain in domains if f"query:{domain}" in query_cache)
+        return {
+            'enabled': WARMUP_ENABLED and self._thread is not None,
+            'domains': WARMUP_DOMAINS,
+            'rate': WARMUP_RATE,
+            'runs': self.runs,
+            'running': self.current,
+            'last': self.last,
+            'currentCoverage': round(cached / len(domains), 4) if domains else 0.0
+        }
+
+cache_warmer = CacheWarmer()
+
+# 规则源重叠分析
+OVERLAP_EXACT_LIMIT = int(os.environ.get('OVERLAP_EXACT_LIMIT', 200000))  # 较小的集合不超过该规模时精确计算
+OVERLAP_SAMPLE_SIZE = int(os.environ.get('OVERLAP_SAMPLE_SIZE', 4096))
+
+def _minhash_sample(keys: Set[str], k: int) -> List[str]:
+    """bottom-k MinHash：取哈希值最小的 k 个规则，相当于对集合的均匀抽样"""
+    if len(keys) <= k:
+        return list(keys)
+    return heapq.nsmallest(k, keys, key=hash)
+
+def _estimate_contained(sample: List[str], size: int, other: Set[str]) -> int:
+    """用抽样中落在另一集合内的比例估计交集大小"""
+    if not sample:
+        return 0
+    hits = sum(1 for key in sample if key in other)
+    return int(round(size * hits / len(sample)))
+
+def build_overlap_report(exact_limit: int = OVERLAP_EXACT_LIMIT,
+                         sample_size: int = OVERLAP_SAMPLE_SIZE) -> dict:
+    """
+    计算各规则源两两之间的交集与各自独有的规则数
+    小列表精确计算；大列表用 bottom-k MinHash 抽样，再在另一方的集合中精确查找命中比例
+    """
+    start = time.time()
+    with _publish_lock:
+        snapshot = list(compiled_rules.items())
+    entries = []
+    for url, compiled in snapshot:
+        keys = compiled.overlap_keys()
+        entries.append({'url': url, 'compiled': compiled, 'keys': keys, 'size': len(keys), 'sample': None})
+
+    def sample_of(entry: dict) -> List[str]:
+        if entry['sample'] is None:
+            entry['sample'] = _minhash_sample(entry['keys'], sample_size)
+        return entry['sample']
+
+    def contained(a: dict, b: dict) -> tuple:
+        """返回 (a 中同时存在于 b 的规则数, 是否为估计值)"""
+        if a['compiled'] is b['compiled']:
+            # 内容相同的镜像共享同一索引
+            return a['size'], False
+        if min(a['size'], b['size']) <= exact_limit:
+            # 集合求交只遍历较小的一方，较小的一方不大时总能精确计算
+            return len(a['keys'] & b['keys']), False
+        # 从较小的一方抽样，误差相对交集更小
+        small, large = (a, b) if a['size'] <= b['size'] else (b, a)
+        return _estimate_contained(sample_of(small), small['size'], large['keys']), True
+
+    pairs = []
+    for i in range(len(entries)):
+        for j in range(i + 1, len(entries)):
+            a, b = entries[i], entries[j]
+            if not a['size'] or not b['size']:
+                continue
+            common, estimated = contained(a, b)
+            if not common:
+                continue
+            union = a['size'] + b['size'] - common
+            pairs.append({
+                'sourceA': a['url'],
+                'sourceB': b['url'],
+                'intersection': common,
+                'onlyA': a['size'] - common,
+                'onlyB': b['size'] - common,
+                'jaccard': round(common / union, 4) if union else 1.0,
+                'estimated': estimated
+            })
+    pairs.sort(key=lambda p: p['jaccard'], reverse=True)
+
+    sources = []
+    for entry in entries:
+        others = [e for e in entries if e is not entry and e['size']]
+        estimated = entry['size'] > exact_limit
+        if any(e['compiled'] is entry['compiled'] for e in others):
+            unique = 0
+            estimated = False
+        elif estimated:
+            sample = sample_of(entry)
+            hits = sum(1 for key in sample if not any(key in e['keys'] for e in others))
+            unique = int(round(entry['size'] * hits / len(sample))) if sample else 0
+        else:
+            remaining = entry['keys']
+            for other in sorted(others, key=lambda e: e['size'], reverse=True):
+                remaining = set(itertools.filterfalse(other['keys'].__contains__, remaining))
+                if not remaining:
+                    break
+            unique = len(remaining)
+        sources.append({
+            'url': entry['url'],
+            'name': get_rule_source_name(entry['url']),
+            'rules': entry['size'],
+            'unique': unique,
+            'uniqueRatio': round(unique / entry['size'], 4) if entry['size'] else 0.0,
+            'estimated': estimated
+        })
+    sources.sort(key=lambda s: s['uniqueRatio'])
+
+    return {
+        'generation': index_generation,
+        'exactLimit': exact_limit,
+        'sampleSize': sample_size,
+        'sources': sources,
+        'pairs': pairs,
+        # 没有独有规则的规则源可以移除而不损失覆盖范围（仅考虑单独移除其中一个）
+        'redundantSources': [s['url'] for s in sources if s['rules'] and s['unique'] == 0],
+        'duration': int((time.time() - start) * 1000)
+    }
+
+# 合并规则导出
+EXPORT_DIR = os.path.join(RULES_DIR, 'exports')
+EXPORT_CHUNK_LINES = 4096
+# 格式 -> (注释符, 行格式, 仅匹配自身的规则的行格式；None 表示格式无法区分，与普通规则一起输出)
+EXPORT_FORMATS = {
+    'hosts': ('#', '0.0.0.0 {}\n', None),
+    'adguard': ('!', '||{}^\n', '|{}^\n'),
+    'dnsmasq': ('#', 'address=/{}/\n', None),
+    'plain': ('#', '{}\n', None)
+}
+
+def _export_exclusions(compiled: CompiledRules, badfilters: Set[tuple], anchor: Optional[str], level: int):
+    """
+    返回判断该规则源中某类规则（锚点 anchor，hosts 为 None；优先级 level）的域名是否不生效的函数，
+    与查询时一致：$badfilter 只禁用锚点与优先级相同的规则且不影响 hosts，白名单覆盖同源的拦截。无需排除时返回 None
+    """
+    disabled = {
+        domain for rule_anchor, domain, rule_level in badfilters if rule_anchor == anchor and rule_level == level
+    } if anchor is not None else set()
+    special = compiled.special
+    if not disabled and not special:
+        return None
+
+    def excluded(domain: str) -> bool:
+        if domain in disabled:
+            return True
+        if not special:
+            return False
+        # 白名单覆盖普通拦截，重要白名单覆盖所有拦截；通配符与正则白名单不在此处计算
+        bits = special.get(('|', domain), 0)
+        labels = domain.split('.')
+        for i in range(len(labels)):
+            bits |= special.get(('||', '.'.join(labels[i:])), 0)
+        if bits & (1 << RULE_IMPORTANT_ALLOW):
+            return True
+        if level == RULE_BLOCK and bits & (1 << RULE_ALLOW):
+            important = special.get(('||', domain), 0) | special.get(('|', domain), 0)
+            return not important & (1 << RULE_IMPORTANT)
+        return False
+    return excluded
+
+def iter_merged_domains(snapshot: List[tuple], badfilters: Set[tuple], compact: bool = False,
+                        keep_exact: bool = False):
+    """
+    按规则源顺序流式产生去重后的拦截域名 (域名, 是否仅匹配自身)，包括 ||x^、纯域名、hosts、|x^ 与 $important，不额外保存输出。
+    去重通过在之前已输出的集合中查找完成；compact 时跳过祖先域名已被导出的子域名。
+    keep_exact 为真时（输出格式能区分 |x^）仅匹配自身的域名单独去重，不会被当作、也不会遮住匹配子域的规则
+    """
+    seen_sets: List[Set[str]] = []
+    seen_exact: List[Set[str]] = []
+    cover: Optional[Set[str]] = None
+    if compact:
+        # 压缩需要跨规则源判断祖先是否被导出，只收集引用，不复制字符串
+        cover = set()
+        for _, compiled in snapshot:
+            cover.update(compiled.suffix)
+            cover.update(compiled.hosts)
+        cover.difference_update(
+            domain for anchor, domain, level in badfilters if anchor == '||' and level == RULE_BLOCK
+        )
+
+    def has_covering_ancestor(domain: str) -> bool:
+        idx = domain.find('.')
+        while idx != -1:
+            if domain[idx + 1:] in cover:
+                return True
+            idx = domain.find('.', idx + 1)
+        return False
+
+    done = set()
+    for _, compiled in snapshot:
+        if id(compiled) in done:
+            # 内容相同的镜像共享同一索引
+            continue
+        done.add(id(compiled))
+        important = {
+            anchor: {
+                domain for (rule_anchor, domain), bits in compiled.special.items()
+                if rule_anchor == anchor and bits & (1 << RULE_IMPORTANT)
+            }
+            for anchor in ('||', '|')
+        }
+        # (域名集合, 是否仅匹配自身, 锚点, 优先级)
+        parts = (
+            (compiled.suffix, False, '||', RULE_BLOCK), (compiled.hosts, False, None, RULE_BLOCK),
+            (compiled.exact, True, '|', RULE_BLOCK),
+            (important['||'], False, '||', RULE_IMPORTANT), (important['|'], True, '|', RULE_IMPORTANT)
+        )
+        for part, exact, anchor, level in parts:
+            if not part:
+                continue
+            exact = exact and keep_exact
+            excluded = _export_exclusions(compiled, badfilters, anchor, level)
+            domains = iter(part)
+            # 仅匹配自身的域名被之前的任何规则覆盖，匹配子域的规则只被同类规则覆盖
+            for previous in seen_sets + seen_exact if exact else seen_sets:
+                domains = itertools.filterfalse(previous.__contains__, domains)
+            if excluded is not None:
+                domains = itertools.filterfalse(excluded, domains)
+            if compact:
+                domains = itertools.filterfalse(has_covering_ancestor, domains)
+            for domain in domains:
+                yield domain, exact
+            (seen_exact if exact else seen_sets).append(part)
+
+def export_cache_path(fingerprint: str, fmt: str, compact: bool) -> str:
+    return os.path.join(EXPORT_DIR, f"{fingerprint}-{fmt}{'-compact' if compact else ''}.txt")
+
+def stream_rules_export(fmt: str, compact: bool):
+    """按当前索引流式生成导出内容，同时写入按索引指纹命名的缓存文件"""
+    with _publish_lock:
+        snapshot = list(compiled_rules.items())
+        badfilters = badfilter_rules
+        fingerprint = index_fingerprint
+    comment, line, exact_line = EXPORT_FORMATS[fmt]
+    header = (
+        f"{comment} Merged blocklist exported by AdGuard域名查询服务\n"
+        f"{comment} Format: {fmt}{' (compacted)' if compact else ''}\n"
+        f"{comment} Index: {fingerprint}\n"
+        f"{comment} Sources: {len(snapshot)}\n"
+    )
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    path = export_cache_path(fingerprint, fmt, compact)
+    fd, tmp_path = tempfile.mkstemp(dir=EXPORT_DIR, prefix='.tmp-')
+    completed = False
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(header)
+            yield header
+            batch = []
+            for domain, exact in iter_merged_domains(snapshot, badfilters, compact, exact_line is not None):
+                batch.append((exact_line if exact else line).format(domain))
+                if len(batch) >= EXPORT_CHUNK_LINES:
+                    chunk = ''.join(batch)
+                    batch = []
+                    f.write(chunk)
+                    yield chunk
+            if batch:
+                chunk = ''.join(batch)
+                f.write(chunk)
+                yield chunk
+        os.replace(tmp_path, path)
+        completed = True
+        # 只保留当前索引的导出缓存
+        for name in os.listdir(EXPORT_DIR):
+            if not name.startswith(fingerprint) and not name.startswith('.tmp-'):
+                try:
+                    os.unlink(os.path.join(EXPORT_DIR, name))
+                except OSError:
+                    pass
+    finally:
+        if not completed:
+            # 客户端中途断开时丢弃不完整的缓存
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+# 定时任务
+class RefreshScheduler:
+    """按规则源计算下次刷新时间的调度器，到期的规则源进入有界队列由固定数量的工作线程处理"""
+
+    def __init__(self, workers: int = REFRESH_WORKERS):
+        self.workers = workers
+        self._heap: List[tuple] = []  # (due, priority, seq, url)
+        self._due: Dict[str, float] = {}  # url -> 当前有效的到期时间，用于淘汰堆中的过期条目
+        self._running: Set[str] = set()
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._queue: "queue.Queue[str]" = queue.Queue(maxsize=workers)
+        self._started = False
+
+    def start(self):
+        with self._cond:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._dispatch_loop, name="refresh-dispatcher", daemon=True).start()
+        for i in range(self.workers):
+            threading.Thread(target=self._worker_loop, name=f"refresh-worker-{i}", daemon=True).start()
+
+    def schedule(self, source: RuleSource, delay: Optional[float] = None):
+        """安排规则源的下次刷新；delay 为空时根据规则源状态计算"""
+        if delay is None:
+            delay = compute_refresh_delay(source)
+        due = time.time() + max(0.0, delay)
+        source.next_update = int(due * 1000)
+        with self._cond:
+            self._seq += 1
+            self._due[source.url] = due
+            heapq.heappush(self._heap, (due, source.priority, self._seq, source.url))
+            self._cond.notify()
+
+    def schedule_all(self, sources: List[RuleSource], spread: float = 0.0):
+        """批量安排规则源，按优先级排序后在 spread 秒内错峰"""
+        ordered = sorted((s for s in sources if s.enabled), key=lambda s: s.priority)
+        step = spread / len(ordered) if ordered else 0
+        for i, source in enumerate(ordered):
+            self.schedule(source, delay=i * step)
+
+    def unschedule(self, url: str):
+        with self._cond:
+            self._due.pop(url, None)
+
+    def _dispatch_loop(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.time()
+                    if self._heap and self._heap[0][0] <= now:
+                        due, _, _, url = heapq.heappop(self._heap)
+                        # 已被重新安排或删除的条目直接丢弃
+                        if self._due.get(url) != due or url in self._running:
+                            continue
+                        del self._due[url]
+                        self._running.add(url)
+                        break
+                    timeout = self._heap[0][0] - now if self._heap else None
+                    self._cond.wait(timeout)
+            # 队列满时阻塞，限制同时进行的下载与解析数量
+            self._queue.put(url)
+
+    def _worker_loop(self):
+        while True:
+            url = self._queue.get()
+            try:
+                source = rule_sources.get(url)
+                if source and source.enabled:
+                    refresh_source(source)
+            except Exception as e:
+                logger.error(f"定时刷新规则源失败: {url} - {e}")
+            finally:
+                with self._cond:
+                    self._running.discard(url)
+                self._queue.task_done()
+
+    def snapshot(self) -> dict:
+        """返回即将进行的刷新计划"""
+        with self._cond:
+            due = dict(self._due)
+            running = set(self._running)
+        now = time.time()
+        items = []
+        for source in rule_sources.values():
+            if not source.enabled:
+                continue
+            next_due = due.get(source.url)
+            items.append({
+                'url': source.url,
+                'name': source.name,
+                'priority': source.priority,
+                'running': source.url in running,
+                'nextUpdate': int(next_due * 1000) if next_due else None,
+                'dueIn': max(0, int(next_due - now)) if next_due else None,
+                'refreshInterval': source.refresh_interval,
+                'expires': source.expires,
+                'failureCount': source.failure_count,
+                'status': source.status
+            })
+        items.sort(key=lambda x: (x['nextUpdate'] is None, x['nextUpdate'] or 0, x['priority']))
+        return {
+            'workers': self.workers,
+            'queued': self._queue.qsize(),
+            'running': len(running),
+            'sources': items
+        }
+
+refresh_scheduler = RefreshScheduler()
+
+# 在线诊断：需设置 DEBUG_TOKEN 才启用，采样线程与 tracemalloc 只在请求期间运行，平时没有开销
+DEBUG_TOKEN = os.environ.get('DEBUG_TOKEN', '')
+
+def check_debug_token(request: Request):
+    """校验 Authorization: Bearer <DEBUG_TOKEN> 或 X-Debug-Token 请求头"""
+    if not DEBUG_TOKEN:
+        raise HTTPException(status_code=404, detail="调试接口未启用（未设置 DEBUG_TOKEN）")
+    auth = request.headers.get('authorization', '')
+    token = auth[7:] if auth[:7].lower() == 'bearer ' else request.headers.get('x-debug-token', '')
+    if not hmac.compare_digest(token.encode(), DEBUG_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="调试令牌无效")
+
+# 调用栈叶子为这些 (文件, 函数) 的线程视为空闲等待，默认不计入采样
+IDLE_FRAMES = {
+    ('threading.py', 'wait'), ('threading.py', '_wait_for_tstate_lock'), ('selectors.py', 'select'),
+    ('queue.py', 'get'), ('handlers.py', 'dequeue'), ('thread.py', '_worker'),
+}
+
+class StackSampler:
+    """
+    统计式 CPU 采样：采集期间由调用线程按固定间隔读取所有线程的 Python 调用栈，
+    输出 flamegraph.pl / speedscope 可直接读取的折叠栈格式（每行 "帧;帧;帧 次数"）
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    def capture(self, seconds: float, interval: float, include_idle: bool = False) -> dict:
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError("已有 CPU 采样正在进行")
+        try:
+            me = threading.get_ident()
+            stacks: Dict[str, int] = {}
+            samples = idle = 0
+            started = time.perf_counter()
+            deadline = started + seconds
+            while time.perf_counter() < deadline:
+                names = {t.ident: t.name for t in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    code = frame.f_code
+                    if not include_idle and (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                        idle += 1
+                        continue
+                    frames = []
+                    while frame is not None:
+                        code = frame.f_code
+                        frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                        frame = frame.f_back
+                    frames.append(names.get(ident, str(ident)))
+                    key = ';'.join(reversed(frames))
+                    stacks[key] = stacks.get(key, 0) + 1
+                samples += 1
+                time.sleep(interval)
+            return {
+                'samples': samples,
+                'idleSamples': idle,
+                'duration': int((time.perf_counter() - started) * 1000),
+                'stacks': stacks
+            }
+        finally:
+            self._lock.release()
+
+    @staticmethod
+    def collapsed(profile: dict) -> str:
+        stacks = sorted(profile['stacks'].items(), key=lambda item: item[1], reverse=True)
+        return ''.join(f"{stack} {count}\n" for stack, count in stacks)
+
+    @staticmethod
+    def top_functions(profile: dict, limit: int) -> List[dict]:
+        """按函数汇总：self 为位于栈顶的采样数，total 为出现在栈中的采样数"""
+        own: Dict[str, int] = {}
+        total: Dict[str, int] = {}
+        for stack, count in profile['stacks'].items():
+            frames = stack.split(';')[1:]
+            if not frames:
+                continue
+            own[frames[-1]] = own.get(frames[-1], 0) + count
+            for frame in set(frames):
+                total[frame] = total.get(frame, 0) + count
+        return [
+            {'function': name, 'self': own.get(name, 0), 'total': count}
+            for name, count in heapq.nlargest(limit, total.items(), key=lambda item: (own.get(item[0], 0), item[1]))
+        ]
+
+stack_sampler = StackSampler()
+
+class MemoryTracer:
+    """按需开启 tracemalloc，开启时记录基线快照，之后的快照给出分配位置与相对基线的增长"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.baseline = None
+        self.started_at: Optional[int] = None
+
+    def start(self, frames: int = 1) -> dict:
+        with self._lock:
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+            tracemalloc.start(frames)
+            self.baseline = self._snapshot()
+            self.started_at = int(time.time() * 1000)
+            return self.status()
+
+    def stop(self) -> dict:
+        with self._lock:
+            tracemalloc.stop()
+            self.baseline = None
+            self.started_at = None
+            return self.status()
+
+    @staticmethod
+    def _snapshot():
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+        ))
+
+    def status(self) -> dict:
+        tracing = tracemalloc.is_tracing()
+        current, peak = tracemalloc.get_traced_memory() if tracing else (0, 0)
+        return {
+            'tracing': tracing,
+            'since': self.started_at,
+            'frames': tracemalloc.get_traceback_limit() if tracing else 0,
+            'tracedBytes': current,
+            'peakBytes': peak
+        }
+
+    def report(self, limit: int, group_by: str) -> dict:
+        with self._lock:
+            report = self.status()
+            if not report['tracing']:
+                return report
+            snapshot = self._snapshot()
+            report['top'] = [
+                {'location': self._location(stat.traceback), 'sizeBytes': stat.size, 'count': stat.count}
+                for stat in snapshot.statistics(group_by)[:limit]
+            ]
+            if self.baseline is not None:
+                report['growth'] = [
+                    {'location': self._location(stat.traceback), 'sizeDiffBytes': stat.size_diff,
+                     'countDiff': stat.count_diff, 'sizeBytes': stat.size}
+                    for stat in snapshot.compare_to(self.baseline, group_by)[:limit]
+                ]
+            return report
+
+    @staticmethod
+    def _location(traceback) -> str:
+        return ' <- '.join(f"{os.path.basename(frame.filename)}:{frame.lineno}" for frame in traceback)
+
+memory_tracer = MemoryTracer()
+
+def build_memory_report() -> dict:
+    """按规则源与数据结构估算内存：规则索引、正则编译缓存、查询缓存"""
+    sources, structures, seen = [], {}, {}
+    for url, compiled in list(compiled_rules.items()):
+        if id(compiled) in seen:
+            # 与镜像共享的编译结果只计一次
+            sources.append({'url': url, 'name': get_rule_source_name(url), 'rules': compiled.rule_count,
+                            'estimatedBytes': 0, 'sharedWith': seen[id(compiled)]})
+            continue
+        seen[id(compiled)] = url
+        breakdown = compiled.memory_breakdown()
+        for kind, size in breakdown.items():
+            structures[kind] = structures.get(kind, 0) + size
+        sources.append({'url': url, 'name': get_rule_source_name(url), 'rules': compiled.rule_count,
+                        'estimatedBytes': sum(breakdown.values()), 'structures': breakdown})
+    sources.sort(key=lambda item: item['estimatedBytes'], reverse=True)
+
+    # 查询缓存按抽样条目的平均大小估算，规则文本与索引共享不重复计算
+    getsizeof = sys.getsizeof
+    # 查询缓存只在发布锁内写入与清空，持锁取样避免在工作线程中遍历时被修改
+    with _publish_lock:
+        entry_count = len(query_cache)
+        sample = list(itertools.islice(query_cache.items(), 200))
+    per_entry = sum(
+        getsizeof(key) + getsizeof(value) + getsizeof(value.matches) + getsizeof(value.exceptions)
+        + sum(map(getsizeof, value.matches)) + sum(map(getsizeof, value.exceptions))
+        for key, value in sample
+    ) / len(sample) if sample else 0
+    index_bytes = sum(structures.values())
+    return {
+        'index': {'estimatedBytes': index_bytes, 'budgetBytes': INDEX_MEMORY_BUDGET, 'structures': structures},
+        'regexCache': {'compiled': regex_cache.stats()['compiled'], 'estimatedBytes': regex_cache.memory_usage()},
+        'queryCache': {'entries': entry_count,
+                       'estimatedBytes': int(getsizeof(query_cache) + per_entry * entry_count)},
+        'sources': sources,
+        'tracemalloc': memory_tracer.status()
+    }
+
+# HTTP 缓存
+HTTP_CACHE_MAX_AGE = int(os.environ.get('HTTP_CACHE_MAX_AGE', 60))  # 查询与搜索结果允许代理缓存的秒数
+
+def make_etag(version: Any, *params: Any) -> str:
+    """由版本号与请求参数生成弱 ETag（响应中的 timestamp 每次不同，只保证语义相同）"""
+    digest = hashlib.sha1('\0'.join(str(p) for p in params).encode('utf-8')).hexdigest()[:12]
+    return f'W/"{version}-{digest}"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """按弱比较判断 If-None-Match 是否命中"""
+    header = request.headers.get('if-none-match')
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    target = etag[2:] if etag.startswith('W/') else etag
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == target:
+            return True
+    return False
+
+def not_modified(etag: str, cache_control: str) -> Response:
+    return Response(status_code=304, headers={'ETag': etag, 'Cache-Control': cache_control})
+
+def set_cache_headers(response: Response, etag: str, cache_control: str):
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = cache_control
+
+def index_cache_control() -> str:
+    # 索引就绪前的空结果不允许缓存
+    return f"public, max-age={HTTP_CACHE_MAX_AGE}" if HTTP_CACHE_MAX_AGE > 0 and index_ready else "no-cache"
+
+# 规则源状态与统计随时变化，只允许带验证器的再验证
+STATE_CACHE_CONTROL = "no-cache"
+
+def state_etag(*params: Any) -> str:
+    return make_etag(f"{BOOT_ID}.{event_broadcaster.version}", *params)
+
+# 准入控制：按优先级分类限制并发与排队，预算耗尽时快速拒绝，保证单域名查询的延迟
+ADMISSION_ENABLED = os.environ.get('ADMISSION_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+ADMISSION_MAX_CONCURRENCY = max(1, int(os.environ.get('ADMISSION_MAX_CONCURRENCY', 32)))
+
+# 类别 -> (优先级, 默认并发上限, 默认排队上限, 默认最长等待毫秒)，优先级数字越小越优先
+ADMISSION_CLASS_DEFAULTS = {
+    'lookup': (0, ADMISSION_MAX_CONCURRENCY, 256, 1000),
+    'bulk': (1, 8, 32, 2000),
+    'search': (2, 2, 8, 2000),
+    'admin': (3, 2, 8, 5000),
+}
 
+# (方法, 路径) -> 类别，未列出的接口（健康检查、统计、事件流等）不受限制
+ADMISSION_ROUTES = {
+    ('GET', '/api/query/domain'): 'lookup',
+    ('POST', '/api/query/domains'): 'bulk',
+    ('GET', '/api/rules/search'): 'search',
+    ('GET', '/api/rules/overlap'): 'search',
+    ('GET', '/api/rules/export'): 'search',
+    ('POST', '/api/rules/refresh'): 'admin',
+    ('POST', '/api/rules/refresh_one'): 'admin',
+    ('POST', '/api/rules/sources'): 'admin',
+    ('DELETE', '/api/rules/sources'): 'admin',
+    ('DELETE', '/api/analytics'): 'admin',
+    ('GET', '/api/debug/memory'): 'admin',
+    ('POST', '/api/debug/memory/trace'): 'admin',
+    ('DELETE', '/api/debug/memory/trace'): 'admin',
+    ('GET', '/api/debug/profile/cpu'): 'admin',
+}
 
-def rule_source_to_dict(source: RuleSource) -> dict:
-    """将 RuleSource 转换为前端期望的 camelCase 字段格式"""
-    return {
-        'url': source.url,
-        'name': source.name,
-        'enabled': source.enabled,
-        'lastUpdated': source.last_updated,
-        'ruleCount': source.rule_count,
-        'status': source.status
-    }
+class AdmissionClass:
+    """一个优先级类别的限额与计数"""
 
-# 定时任务
-def schedule_checker():
-    """定时任务检查器"""
-    while True:
-        schedule.run_pending()
-        time.sleep(60)
+    def __init__(self, name: str, priority: int, max_concurrency: int, max_queue: int, max_wait: float):
+        self.name = name
+        self.priority = priority
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.active = 0
+        self.queued = 0
+        self.admitted = 0
+        self.shed_queue_full = 0
+        self.shed_timeout = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.service_avg = 0.0  # 处理耗时的指数移动平均，用于估算 Retry-After
+
+    def retry_after(self) -> int:
+        backlog = (self.queued + 1) / max(1, self.max_concurrency)
+        return max(1, int(math.ceil(backlog * self.service_avg)))
+
+    def stats(self) -> dict:
+        return {
+            'priority': self.priority,
+            'maxConcurrency': self.max_concurrency,
+            'maxQueue': self.max_queue,
+            'maxWaitMs': int(self.max_wait * 1000),
+            'active': self.active,
+            'queued': self.queued,
+            'admitted': self.admitted,
+            'shedQueueFull': self.shed_queue_full,
+            'shedTimeout': self.shed_timeout,
+            'avgQueueWaitMs': round(self.wait_total / self.admitted * 1000, 3) if self.admitted else 0.0,
+            'maxQueueWaitMs': round(self.wait_max * 1000, 3),
+            'avgServiceMs': round(self.service_avg * 1000, 3)
+        }
+
+class AdmissionRejected(Exception):
+    def __init__(self, status_code: int, detail: str, retry_after: int):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+class AdmissionController:
+    """
+    所有类别共享总并发预算，另受各自并发上限约束；名额释放时按优先级唤醒排队的请求。
+    排队已满返回 429，排队超时返回 503。只在事件循环中调用，不需要加锁
+    """
+
+    def __init__(self, max_concurrency: int = ADMISSION_MAX_CONCURRENCY):
+        self.max_concurrency = max_concurrency
+        self.active = 0
+        self.classes: Dict[str, AdmissionClass] = {}
+        for name, (priority, concurrency, queue_limit, wait_ms) in ADMISSION_CLASS_DEFAULTS.items():
+            prefix = f"ADMISSION_{name.upper()}_"
+            self.classes[name] = AdmissionClass(
+                name, priority,
+                max(1, int(os.environ.get(prefix + 'CONCURRENCY', concurrency))),
+                max(0, int(os.environ.get(prefix + 'QUEUE', queue_limit))),
+                int(os.environ.get(prefix + 'WAIT_MS', wait_ms)) / 1000
+            )
+        self._waiters: List[tuple] = []  # (优先级, 序号, 类别, future)
+        self._seq = itertools.count()
+
+    def _can_run(self, cls: AdmissionClass) -> bool:
+        return self.active < self.max_concurrency and cls.active < cls.max_concurrency
+
+    def _grant(self, cls: AdmissionClass):
+        self.active += 1
+        cls.active += 1
+
+    async def acquire(self, cls: AdmissionClass) -> float:
+        """取得名额，返回排队等待的秒数"""
+        # 有同级或更高优先级、且未受类别上限阻挡的请求在排队时不插队
+        if self._can_run(cls) and not any(
+            w[0] <= cls.priority and w[2].active < w[2].max_concurrency for w in self._waiters
+        ):
+            self._grant(cls)
+            cls.admitted += 1
+            return 0.0
+        if cls.queued >= cls.max_queue:
+            cls.shed_queue_full += 1
+            raise AdmissionRejected(429, "请求过多，请稍后重试", cls.retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (cls.priority, next(self._seq), cls, future)
+        heapq.heappush(self._waiters, entry)
+        cls.queued += 1
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(future, cls.max_wait)
+        except asyncio.TimeoutError:
+            cls.shed_timeout += 1
+            raise AdmissionRejected(503, "服务繁忙，请稍后重试", cls.retry_after())
+        except BaseException:
+            # 已分配名额后请求被取消（如客户端断开），归还名额
+            if future.done() and not future.cancelled():
+                self.release(cls)
+            raise
+        finally:
+            cls.queued -= 1
+            if not future.done() or future.cancelled():
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+        waited = time.perf_counter() - start
+        cls.admitted += 1
+        cls.wait_total += waited
+        cls.wait_max = max(cls.wait_max, waited)
+        return waited
+
+    def release(self, cls: AdmissionClass, service_time: Optional[float] = None):
+        self.active -= 1
+        cls.active -= 1
+        if service_time is not None:
+            cls.service_avg = service_time if cls.service_avg == 0 else cls.service_avg * 0.9 + service_time * 0.1
+        self._wake()
+
+    def _wake(self):
+        # 按优先级依次唤醒；高优先级类别已达上限时，低优先级的请求仍可使用剩余的总预算
+        for entry in sorted(self._waiters):
+            if self.active >= self.max_concurrency:
+                break
+            _, _, cls, future = entry
+            if future.done() or cls.active >= cls.max_concurrency:
+                continue
+            self._waiters.remove(entry)
+            self._grant(cls)
+            future.set_result(None)
+        heapq.heapify(self._waiters)
+
+    def stats(self) -> dict:
+        return {
+            'enabled': ADMISSION_ENABLED,
+            'maxConcurrency': self.max_concurrency,
+            'active': self.active,
+            'classes': {name: cls.stats() for name, cls in self.classes.items()}
+        }
 
-# 设置定时更新规则（每6小时）
-schedule.every(6).hours.do(update_all_rules)
+admission_controller = AdmissionController()
+
+class AdmissionMiddleware:
+    """ASGI 中间件：按路由类别申请名额，响应体发送完毕后释放（流式导出也计入）"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        name = ADMISSION_ROUTES.get((scope.get('method'), scope.get('path'))) if scope['type'] == 'http' else None
+        if name is None or not ADMISSION_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        cls = admission_controller.classes[name]
+        try:
+            await admission_controller.acquire(cls)
+        except AdmissionRejected as e:
+            response = JSONResponse(
+                status_code=e.status_code,
+                content={'detail': e.detail},
+                headers={'Retry-After': str(e.retry_after)}
+            )
+            await response(scope, receive, send)
+            return
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            admission_controller.release(cls, time.perf_counter() - start)
+
+app.add_middleware(AdmissionMiddleware)
+
+# 配置CORS：最后注册的中间件在最外层，准入控制拒绝的 429/503 响应也带 CORS 头
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
 
 # API端点
 @app.on_event("startup")
@@ -576,28 +3924,83 @@ async def startup_event():
     """应用启动时初始化"""
     global all_default_sources
     logger.info("启动AdGuard域名查询服务...")
+    # 主从模式配置不完整时拒绝启动
+    check_cluster_config()
+    
+    event_broadcaster.bind_loop(asyncio.get_running_loop())
+    hit_analytics.load()
+    hit_analytics.start_autosave()
+    cache_warmer.start()
     
-    # 启动定时任务线程
-    threading.Thread(target=schedule_checker, daemon=True).start()
+    if cluster_follower is not None:
+        # 从节点的规则源与索引都来自主节点，不读取本地配置也不下载规则
+        cluster_follower.start()
+        return
     
     # 加载规则源配置
     all_default_sources = load_rule_sources()
     
     # 初始化规则源
     for source in all_default_sources:
-        rule_sources[source.url] = source
+        register_rule_source(source)
+    
+    # 先从本地保存的规则恢复索引，网络刷新随后按计划进行
+    threading.Thread(
+        target=load_rules_snapshot, args=(all_default_sources,),
+        name="rules-snapshot", daemon=True
+    ).start()
     
-    # 后台更新规则
-    threading.Thread(target=update_all_rules, daemon=True).start()
+    # 启动刷新调度器，首次更新按优先级错峰进入工作队列
+    refresh_scheduler.start()
+    refresh_scheduler.schedule_all(all_default_sources, spread=STARTUP_REFRESH_SPREAD)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """应用退出时保存命中统计"""
+    if cluster_follower is not None:
+        cluster_follower.stop()
+    try:
+        hit_analytics.save()
+    except Exception as e:
+        logger.warning(f"保存命中统计失败: {e}")
 
 @app.get("/")
 async def root():
     """根路径"""
     return {"message": "AdGuard域名查询服务正在运行", "version": "1.0.0"}
 
+@app.get("/api/health/live")
+async def liveness():
+    """存活检查，仅表示进程可以响应请求"""
+    return ApiResponse(
+        code=200,
+        message="存活",
+        data={"status": "ok"},
+        timestamp=int(time.time() * 1000)
+    )
+
+@app.get("/api/health/ready")
+async def readiness():
+    """就绪检查，首次发布规则索引后才返回 200，仅读取发布时维护的计数"""
+    if not index_ready:
+        raise HTTPException(status_code=503, detail="规则索引尚未就绪")
+    return ApiResponse(
+        code=200,
+        message="就绪",
+        data={
+            "status": "ready",
+            "origin": index_ready_origin,
+            "generation": index_generation,
+            "loadedSources": len(source_kind_counts),
+            "compiledRules": count_compiled_rules(),
+            "lastUpdate": last_rule_update
+        },
+        timestamp=int(time.time() * 1000)
+    )
+
 @app.get("/api/query/domain")
-async def query_domain(domain: str):
-    """查询单个域名"""
+async def query_domain(domain: str, request: Request, response: Response, explain: bool = False):
+    """查询单个域名，explain=true 时附带各阶段耗时与候选数"""
     try:
         if not domain or not domain.strip():
             raise HTTPException(status_code=400, detail="域名不能为空")
@@ -607,14 +4010,38 @@ async def query_domain(domain: str):
         if not is_valid_domain(clean_domain):
             raise HTTPException(status_code=400, detail="域名格式不正确")
         
-        result = query_domain_internal(clean_domain)
+        if explain:
+            # 诊断请求不走条件缓存，也不计入命中统计
+            result, trace = await run_in_threadpool(explain_domain, clean_domain)
+            response.headers['Cache-Control'] = 'no-store'
+            return api_json_response("查询成功", result.to_pairs() + [['explain', trace]], response)
         
-        return ApiResponse(
-            code=200,
-            message="查询成功",
-            data=result,
-            timestamp=int(time.time() * 1000)
-        )
+        access_start = time.perf_counter() if access_log_sampled() else None
+        
+        # 结果只随规则索引变化，条件请求在查询之前直接返回 304
+        etag = make_etag(index_fingerprint, 'query', clean_domain)
+        if etag_matches(request, etag):
+            cached = get_cached_query_result(clean_domain)
+            if cached is not None:
+                hit_analytics.record(cached)
+            if access_start is not None:
+                log_query_access('/api/query/domain', clean_domain, 'not_modified', access_start)
+            return not_modified(etag, index_cache_control())
+        set_cache_headers(response, etag, index_cache_control())
+        
+        result = get_cached_query_result(clean_domain)
+        cache_status = 'hit'
+        if result is not None:
+            note_local_cache_hit()
+        else:
+            # 未命中时在线程池中计算，避免耗时的正则匹配阻塞事件循环
+            cache_status = 'miss'
+            result = await run_in_threadpool(query_domain_internal, clean_domain)
+        hit_analytics.record(result)
+        if access_start is not None:
+            log_query_access('/api/query/domain', clean_domain, cache_status, access_start, result.blocked)
+        
+        return api_json_response("查询成功", result.to_pairs(), response)
         
     except HTTPException:
         raise
@@ -634,20 +4061,25 @@ async def query_domains(request: BulkQueryRequest):
         if len(domains) > 100:
             raise HTTPException(status_code=400, detail="单次查询域名数量不能超过100个")
         
-        results = []
-        for domain in domains:
-            if domain and domain.strip():
-                clean_domain = domain.strip().lower()
-                if is_valid_domain(clean_domain):
-                    result = query_domain_internal(clean_domain)
-                    results.append(result)
+        clean_domains = [
+            domain.strip().lower() for domain in domains
+            if domain and domain.strip() and is_valid_domain(domain.strip().lower())
+        ]
+        access_start = None
+        if access_log_sampled():
+            access_start = time.perf_counter()
+            cache_hits = sum(1 for d in clean_domains if get_cached_query_result(d) is not None)
+        results = await run_in_threadpool(lambda: [query_domain_internal(d) for d in clean_domains])
+        for result in results:
+            hit_analytics.record(result)
+        if access_start is not None:
+            log_query_access(
+                '/api/query/domains', f"{len(clean_domains)} domains",
+                f"{cache_hits}/{len(clean_domains)}", access_start,
+                any(result.blocked for result in results)
+            )
         
-        return ApiResponse(
-            code=200,
-            message="批量查询成功",
-            data=results,
-            timestamp=int(time.time() * 1000)
-        )
+        return api_json_response("批量查询成功", [result.to_dict() for result in results])
         
     except HTTPException:
         raise
@@ -655,10 +4087,42 @@ async def query_domains(request: BulkQueryRequest):
         logger.error(f"批量查询域名失败: {e}")
         raise HTTPException(status_code=500, detail=f"批量查询失败: {str(e)}")
 
+@app.get("/api/admission")
+async def get_admission_stats():
+    """获取准入控制的并发、排队等待与拒绝计数"""
+    try:
+        return ApiResponse(
+            code=200,
+            message="获取成功",
+            data=admission_controller.stats(),
+            timestamp=int(time.time() * 1000)
+        )
+    except Exception as e:
+        logger.error(f"获取准入控制统计失败: {e}")
+        raise HTTPException(status_code=500, detail=f"获取准入控制统计失败: {str(e)}")
+
+@app.get("/api/query/cache")
+async def get_query_cache_stats():
+    """获取两级查询缓存的命中率"""
+    try:
+        return ApiResponse(
+            code=200,
+            message="获取成功",
+            data=query_cache_stats(),
+            timestamp=int(time.time() * 1000)
+        )
+    except Exception as e:
+        logger.error(f"获取查询缓存统计失败: {e}")
+        raise HTTPException(status_code=500, detail=f"获取查询缓存统计失败: {str(e)}")
+
 @app.get("/api/rules/sources")
-async def get_rule_sources():
+async def get_rule_sources(request: Request, response: Response):
     """获取所有规则源"""
     try:
+        etag = state_etag('sources')
+        if etag_matches(request, etag):
+            return not_modified(etag, STATE_CACHE_CONTROL)
+        set_cache_headers(response, etag, STATE_CACHE_CONTROL)
         sources = [rule_source_to_dict(s) for s in rule_sources.values()]
         return ApiResponse(
             code=200,
@@ -674,6 +4138,7 @@ async def get_rule_sources():
 async def add_rule_source(source: RuleSource, background_tasks: BackgroundTasks):
     """添加规则源"""
     try:
+        reject_if_follower()
         if not source.url or not source.url.strip():
             raise HTTPException(status_code=400, detail="规则源URL不能为空")
 
@@ -681,11 +4146,12 @@ async def add_rule_source(source: RuleSource, background_tasks: BackgroundTasks)
             raise HTTPException(status_code=400, detail="规则源名称不能为空")
 
         # 添加到规则源列表
-        rule_sources[source.url] = source
+        register_rule_source(source)
+        event_broadcaster.publish('sources', [rule_source_to_dict(s) for s in list(rule_sources.values())])
 
         # 如果启用，后台更新规则
         if source.enabled:
-            background_tasks.add_task(update_rule_from_source, source)
+            background_tasks.add_task(refresh_source, source)
 
         return ApiResponse(
             code=200,
@@ -702,9 +4168,10 @@ async def add_rule_source(source: RuleSource, background_tasks: BackgroundTasks)
 
 
 @app.post("/api/rules/refresh_one")
-async def refresh_one_rule(url: str, background_tasks: BackgroundTasks):
-    """刷新单个规则源（后台执行）"""
+async def refresh_one_rule(url: str):
+    """刷新单个规则源（后台执行），返回可轮询的任务"""
     try:
+        reject_if_follower()
         if not url or not url.strip():
             raise HTTPException(status_code=400, detail="规则源URL不能为空")
 
@@ -712,16 +4179,13 @@ async def refresh_one_rule(url: str, background_tasks: BackgroundTasks):
         if not source:
             raise HTTPException(status_code=404, detail="未找到指定的规则源")
 
-        # 清理查询缓存
-        query_cache.clear()
-
-        # 后台更新单个源
-        background_tasks.add_task(update_rule_from_source, source)
+        # 后台更新单个源，查询缓存在新规则发布时失效
+        job, joined = refresh_coordinator.submit(url)
 
         return ApiResponse(
             code=200,
-            message="单个规则刷新已开始，请稍后查看该源的状态",
-            data=rule_source_to_dict(source),
+            message="已加入正在进行的刷新任务" if joined else "单个规则刷新已开始，请稍后查看该源的状态",
+            data=refresh_job_to_dict(job),
             timestamp=int(time.time() * 1000)
         )
     except HTTPException:
@@ -734,17 +4198,16 @@ async def refresh_one_rule(url: str, background_tasks: BackgroundTasks):
 async def remove_rule_source(url: str):
     """删除规则源"""
     try:
+        reject_if_follower()
         if not url or not url.strip():
             raise HTTPException(status_code=400, detail="规则源URL不能为空")
         
         # 从所有存储中删除
-        domain_rules.pop(url, None)
-        regex_rules.pop(url, None)
-        hosts_rules.pop(url, None)
-        rule_sources.pop(url, None)
-        
-        # 清理查询缓存
-        query_cache.clear()
+        unregister_rule_source(url)
+        publish_compiled_rules(url, None)
+        event_broadcaster.publish('sources', [rule_source_to_dict(s) for s in list(rule_sources.values())])
+        refresh_scheduler.unschedule(url)
+        forget_raw_rules(url)
         
         return ApiResponse(
             code=200,
@@ -759,62 +4222,98 @@ async def remove_rule_source(url: str):
         raise HTTPException(status_code=500, detail=f"删除规则源失败: {str(e)}")
 
 @app.post("/api/rules/refresh")
-async def refresh_rules(background_tasks: BackgroundTasks):
-    """刷新所有规则"""
+async def refresh_rules():
+    """刷新所有规则，返回可轮询的任务；已有全量刷新在进行时直接加入"""
     try:
-        # 清理缓存
-        query_cache.clear()
-        
-        # 后台更新规则
-        background_tasks.add_task(update_all_rules)
+        reject_if_follower()
+        # 后台更新规则，查询缓存在新规则发布时失效
+        job, joined = refresh_coordinator.submit()
         
         return ApiResponse(
             code=200,
-            message="规则刷新已开始，请稍后查看更新状态",
+            message="已加入正在进行的刷新任务" if joined else "规则刷新已开始，请稍后查看更新状态",
+            data=refresh_job_to_dict(job),
             timestamp=int(time.time() * 1000)
         )
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"刷新规则失败: {e}")
         raise HTTPException(status_code=500, detail=f"刷新规则失败: {str(e)}")
 
+@app.get("/api/rules/refresh/{job_id}")
+async def get_refresh_job(job_id: str):
+    """查询刷新任务状态"""
+    job = refresh_coordinator.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="未找到指定的刷新任务")
+    return ApiResponse(
+        code=200,
+        message="获取成功",
+        data=refresh_job_to_dict(job),
+        timestamp=int(time.time() * 1000)
+    )
+
+@app.get("/api/rules/schedule")
+async def get_refresh_schedule():
+    """获取各规则源的刷新计划"""
+    try:
+        return ApiResponse(
+            code=200,
+            message="获取成功",
+            data=refresh_scheduler.snapshot(),
+            timestamp=int(time.time() * 1000)
+        )
+    except Exception as e:
+        logger.error(f"获取刷新计划失败: {e}")
+        raise HTTPException(status_code=500, detail=f"获取刷新计划失败: {str(e)}")
+
 @app.get("/api/rules/statistics")
-async def get_statistics():
+async def get_statistics(request: Request, response: Response):
     """获取统计信息"""
     try:
-        total_sources = len(rule_sources)
-        enabled_sources = sum(1 for s in rule_sources.values() if s.enabled)
-        domain_rule_count = sum(len(rules) for rules in domain_rules.values())
-        regex_rule_count = sum(len(rules) for rules in regex_rules.values())
-        hosts_rule_count = sum(len(rules) for rules in hosts_rules.values())
-        
-        last_update = 0
-        if rule_sources:
-            last_update = max(
-                (s.last_updated or 0) for s in rule_sources.values()
-            )
-        
-        stats = {
-            "totalSources": total_sources,
-            "enabledSources": enabled_sources,
-            "domainRules": domain_rule_count,
-            "regexRules": regex_rule_count,
-            "hostsRules": hosts_rule_count,
-            "lastUpdate": last_update,
-            "cacheSize": len(query_cache)
-        }
-        
+        statistics = build_statistics()
+        # 缓存条目数与索引内存不触发事件，计入 ETag 以免返回过期的值
+        etag = state_etag('statistics', statistics['cacheSize'], statistics['indexMemory']['estimatedBytes'])
+        if etag_matches(request, etag):
+            return not_modified(etag, STATE_CACHE_CONTROL)
+        set_cache_headers(response, etag, STATE_CACHE_CONTROL)
         return ApiResponse(
             code=200,
             message="获取成功",
-            data=stats,
+            data=statistics,
             timestamp=int(time.time() * 1000)
         )
     except Exception as e:
         logger.error(f"获取统计信息失败: {e}")
         raise HTTPException(status_code=500, detail=f"获取统计信息失败: {str(e)}")
 
+@app.get("/api/rules/events")
+async def rule_events(request: Request):
+    """以 Server-Sent Events 推送规则源状态、统计信息与刷新进度"""
+    subscriber = event_broadcaster.subscribe()
+
+    async def stream():
+        try:
+            # 连接建立时先推送当前快照
+            yield format_sse('statistics', build_statistics())
+            yield format_sse('sources', [rule_source_to_dict(s) for s in list(rule_sources.values())])
+            while not await request.is_disconnected():
+                try:
+                    yield await asyncio.wait_for(subscriber.get(), timeout=SSE_KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ': keep-alive\n\n'
+        finally:
+            event_broadcaster.unsubscribe(subscriber)
+
+    return StreamingResponse(
+        stream(),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 @app.get("/api/rules/search")
-async def search_rules(keyword: str, limit: int = 100):
+async def search_rules(keyword: str, request: Request, response: Response, limit: int = 100):
     """按关键字搜索规则"""
     try:
         if not keyword or not keyword.strip():
@@ -822,16 +4321,23 @@ async def search_rules(keyword: str, limit: int = 100):
         
         clean_keyword = keyword.strip().lower()
         limit = max(1, min(limit, 1000))  # 限制在1-1000之间
+        
+        etag = make_etag(index_fingerprint, 'search', clean_keyword, limit)
+        if etag_matches(request, etag):
+            return not_modified(etag, index_cache_control())
+        set_cache_headers(response, etag, index_cache_control())
         results = []
         
+        sources = list(compiled_rules.items())
+        
         # 搜索域名规则
-        for source_url, domains in domain_rules.items():
+        for source_url, compiled in sources:
             if len(results) >= limit:
                 break
             source = rule_sources.get(source_url)
             source_name = source.name if source else source_url
             
-            for domain in domains:
+            for domain in compiled.iter_domain_rules():
                 if len(results) >= limit:
                     break
                 if clean_keyword in domain.lower() or clean_keyword in source_name.lower():
@@ -844,13 +4350,13 @@ async def search_rules(keyword: str, limit: int = 100):
         
         # 搜索Hosts规则
         if len(results) < limit:
-            for source_url, hosts in hosts_rules.items():
+            for source_url, compiled in sources:
                 if len(results) >= limit:
                     break
                 source = rule_sources.get(source_url)
                 source_name = source.name if source else source_url
                 
-                for host in hosts:
+                for host in compiled.hosts:
                     if len(results) >= limit:
                         break
                     if clean_keyword in host.lower() or clean_keyword in source_name.lower():
@@ -863,19 +4369,18 @@ async def search_rules(keyword: str, limit: int = 100):
         
         # 搜索正则规则
         if len(results) < limit:
-            for source_url, patterns in regex_rules.items():
+            for source_url, compiled in sources:
                 if len(results) >= limit:
                     break
                 source = rule_sources.get(source_url)
                 source_name = source.name if source else source_url
                 
-                for pattern in patterns:
+                for rule in compiled.regex:
                     if len(results) >= limit:
                         break
-                    pattern_str = pattern.pattern.lower()
-                    if clean_keyword in pattern_str or clean_keyword in source_name.lower():
+                    if clean_keyword in rule.lower() or clean_keyword in source_name.lower():
                         results.append(SearchResult(
-                            rule=pattern.pattern,
+                            rule=rule,
                             rule_source=source_name,
                             rule_source_url=source_url,
                             rule_type="regex"
@@ -893,18 +4398,353 @@ async def search_rules(keyword: str, limit: int = 100):
         logger.error(f"搜索规则失败: {e}")
         raise HTTPException(status_code=500, detail=f"搜索失败: {str(e)}")
 
+@app.get("/api/rules/overlap")
+async def get_rules_overlap(exact_limit: int = OVERLAP_EXACT_LIMIT, sample_size: int = OVERLAP_SAMPLE_SIZE):
+    """分析规则源之间的重叠与冗余"""
+    try:
+        if exact_limit < 0 or sample_size < 16:
+            raise HTTPException(status_code=400, detail="参数取值无效")
+        report = await run_in_threadpool(build_overlap_report, exact_limit, sample_size)
+        return ApiResponse(
+            code=200,
+            message="分析完成",
+            data=report,
+            timestamp=int(time.time() * 1000)
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"规则源重叠分析失败: {e}")
+        raise HTTPException(status_code=500, detail=f"规则源重叠分析失败: {str(e)}")
+
+@app.get("/api/rules/export")
+async def export_rules(request: Request, format: str = "adguard", compact: bool = False):
+    """导出所有规则源合并去重后的拦截域名"""
+    try:
+        if format not in EXPORT_FORMATS:
+            raise HTTPException(status_code=400, detail=f"不支持的格式，可选: {', '.join(EXPORT_FORMATS)}")
+        if not index_ready:
+            raise HTTPException(status_code=503, detail="规则索引尚未就绪")
+
+        etag = f'"{index_fingerprint}-{format}{"-c" if compact else ""}"'
+        headers = {
+            'ETag': etag,
+            'Cache-Control': 'public, max-age=300',
+            'Content-Disposition': f'attachment; filename="blocklist-{format}.txt"'
+        }
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers=headers)
+
+        # 当前索引已导出过时直接发送缓存文件
+        path = export_cache_path(index_fingerprint, format, compact)
+        if os.path.exists(path):
+            return FileResponse(path, media_type='text/plain; charset=utf-8', headers=headers)
+        return StreamingResponse(
+            stream_rules_export(format, compact),
+            media_type='text/plain; charset=utf-8',
+            headers=headers
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"导出规则失败: {e}")
+        raise HTTPException(status_code=500, detail=f"导出规则失败: {str(e)}")
+
+@app.get("/api/rules/regex/profile")
+async def get_regex_profile(limit: int = 50):
+    """按累计耗时排序的正则规则，以及被隔离的模式"""
+    try:
+        if limit < 1 or limit > 1000:
+            raise HTTPException(status_code=400, detail="limit 取值范围为 1-1000")
+        report = await run_in_threadpool(regex_profiler.report, limit)
+        report['sandboxSkipped'] = regex_sandbox.skipped
+        report['quarantined'] = [
+            {
+                'pattern': key[0],
+                'reason': reason,
+                'timeouts': regex_sandbox.timeouts.get(key, 0),
+                'disabled': key in regex_sandbox.disabled
+            }
+            for key, reason in list(regex_cache.quarantined.items())
+        ]
+        return ApiResponse(
+            code=200,
+            message="获取成功",
+            data=report,
+            timestamp=int(time.time() * 1000)
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"获取正则耗时统计失败: {e}")
+        raise HTTPException(status_code=500, detail=f"获取正则耗时统计失败: {str(e)}")
+
+@app.get("/api/rules/regex/cache")
+async def get_regex_cache_stats():
+    """获取正则编译缓存统计"""
+    try:
+        return ApiResponse(
+            code=200,
+            message="获取成功",
+            data=regex_cache.stats(),
+            timestamp=int(time.time() * 1000)
+        )
+    except Exception as e:
+        logger.error(f"获取正则缓存统计失败: {e}")
+        raise HTTPException(status_code=500, detail=f"获取正则缓存统计失败: {str(e)}")
+
+@app.get("/api/rules/compaction")
+async def get_rules_compaction():
+    """获取各规则源的压缩统计（需启用 RULE_COMPACTION）"""
+    try:
+        sources = []
+        for url, compiled in list(compiled_rules.items()):
+            if compiled.compaction is None:
+                continue
+            sources.append({'url': url, 'name': get_rule_source_name(url), **compiled.compaction})
+        sources.sort(key=lambda s: s['bytesSaved'], reverse=True)
+        return ApiResponse(
+            code=200,
+            message="获取成功",
+            data={
+                'enabled': RULE_COMPACTION,
+                'removed': sum(s['removed'] for s in sources),
+                'bytesSaved': sum(s['bytesSaved'] for s in sources),
+                'sources': sources
+            },
+            timestamp=int(time.time() * 1000)
+        )
+    except Exception as e:
+        logger.error(f"获取压缩统计失败: {e}")
+        raise HTTPException(status_code=500, detail=f"获取压缩统计失败: {str(e)}")
+
+@app.get("/api/analytics")
+async def get_analytics(limit: int = 20):
+    """获取规则命中统计：各规则源命中次数、Top 规则与 Top 查询/拦截域名"""
+    try:
+        if limit < 1 or limit > 1000:
+            raise HTTPException(status_code=400, detail="limit 取值范围为 1-1000")
+        return ApiResponse(
+            code=200,
+            message="获取成功",
+            data=hit_analytics.report(limit),
+            timestamp=int(time.time() * 1000)
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"获取命中统计失败: {e}")
+        raise HTTPException(status_code=500, detail=f"获取命中统计失败: {str(e)}")
+
+@app.delete("/api/analytics")
+async def reset_analytics():
+    """清空命中统计"""
+    try:
+        hit_analytics.reset()
+        hit_analytics.save()
+        return ApiResponse(
+            code=200,
+            message="命中统计已清空",
+            timestamp=int(time.time() * 1000)
+        )
+    except Exception as e:
+        logger.error(f"清空命中统计失败: {e}")
+        raise HTTPException(status_code=500, detail=f"清空命中统计失败: {str(e)}")
+
+@app.get("/api/cluster")
+async def get_cluster_status():
+    """本节点的集群角色与正在提供服务的索引版本"""
+    try:
+        data = {
+            'role': CLUSTER_ROLE,
+            'node': CLUSTER_NODE_ID,
+            'generation': index_generation,
+            'fingerprint': index_fingerprint,
+            'ready': index_ready
+        }
+        if CLUSTER_ROLE == 'leader':
+            data['leader'] = cluster_leader.status()
+        elif cluster_follower is not None:
+            data['follower'] = cluster_follower.status()
+        return ApiResponse(
+            code=200,
+            message="获取成功",
+            data=data,
+            timestamp=int(time.time() * 1000)
+        )
+    except Exception as e:
+        logger.error(f"获取集群状态失败: {e}")
+        raise HTTPException(status_code=500, detail=f"获取集群状态失败: {str(e)}")
+
+@app.get("/api/cluster/manifest")
+async def get_cluster_manifest(request: Request, node: str = "", epoch: str = "", generation: Optional[int] = None):
+    """主节点当前的索引版本；从节点轮询时附带自身的节点 ID 与版本"""
+    try:
+        check_cluster_token(request)
+        if node:
+            cluster_leader.report_follower(node, epoch, generation)
+        return ApiResponse(
+            code=200,
+            message="获取成功",
+            data=cluster_leader.manifest(),
+            timestamp=int(time.time() * 1000)
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"获取集群版本失败: {e}")
+        raise HTTPException(status_code=500, detail=f"获取集群版本失败: {str(e)}")
+
+@app.get("/api/cluster/snapshot")
+async def get_cluster_snapshot(request: Request):
+    """当前代数的全量编译索引快照（gzip 压缩的 JSON，带 HMAC 签名）"""
+    try:
+        check_cluster_token(request)
+        generation, body = await run_in_threadpool(cluster_leader.payload)
+        return cluster_payload_response(generation, body, None)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"生成集群快照失败: {e}")
+        raise HTTPException(status_code=500, detail=f"生成集群快照失败: {str(e)}")
+
+@app.get("/api/cluster/delta")
+async def get_cluster_delta(request: Request, epoch: str, since: int):
+    """自 since 代数以来变化的规则源；epoch 不同或无法计算时返回 410，从节点应改为拉取全量快照"""
+    try:
+        check_cluster_token(request)
+        if epoch != BOOT_ID:
+            raise HTTPException(status_code=410, detail="主节点已重启，请拉取全量快照")
+        try:
+            generation, body = await run_in_threadpool(cluster_leader.payload, since)
+        except DeltaUnavailable as e:
+            raise HTTPException(status_code=410, detail=str(e))
+        return cluster_payload_response(generation, body, since)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"生成集群增量失败: {e}")
+        raise HTTPException(status_code=500, detail=f"生成集群增量失败: {str(e)}")
+
+@app.get("/api/debug/profile/cpu")
+async def profile_cpu(request: Request, seconds: float = 10, interval_ms: int = 10,
+                      format: str = "collapsed", idle: bool = False, limit: int = 50):
+    """对线上流量做统计式 CPU 采样，默认返回折叠栈文本（可用 flamegraph.pl / speedscope 打开）"""
+    try:
+        check_debug_token(request)
+        if seconds <= 0 or seconds > 60:
+            raise HTTPException(status_code=400, detail="seconds 取值范围为 (0, 60]")
+        if interval_ms < 1 or interval_ms > 1000:
+            raise HTTPException(status_code=400, detail="interval_ms 取值范围为 1-1000")
+        if format not in ('collapsed', 'json'):
+            raise HTTPException(status_code=400, detail="format 仅支持 collapsed 或 json")
+        if stack_sampler.running:
+            raise HTTPException(status_code=409, detail="已有 CPU 采样正在进行")
+        logger.info(f"开始 CPU 采样: {seconds} 秒, 间隔 {interval_ms} 毫秒")
+        try:
+            profile = await run_in_threadpool(stack_sampler.capture, seconds, interval_ms / 1000, idle)
+        except RuntimeError as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        if format == 'collapsed':
+            return Response(
+                content=StackSampler.collapsed(profile),
+                media_type='text/plain; charset=utf-8',
+                headers={
+                    'Cache-Control': 'no-store',
+                    'X-Profile-Samples': str(profile['samples']),
+                    'X-Profile-Duration': str(profile['duration'])
+                }
+            )
+        return ApiResponse(
+            code=200,
+            message="采样完成",
+            data={
+                'samples': profile['samples'],
+                'idleSamples': profile['idleSamples'],
+                'duration': profile['duration'],
+                'intervalMs': interval_ms,
+                'functions': StackSampler.top_functions(profile, limit)
+            },
+            timestamp=int(time.time() * 1000)
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"CPU 采样失败: {e}")
+        raise HTTPException(status_code=500, detail=f"CPU 采样失败: {str(e)}")
+
+@app.get("/api/debug/memory")
+async def get_memory_report(request: Request, limit: int = 20, group_by: str = "lineno"):
+    """按规则源与数据结构估算内存；开启 tracemalloc 时附带分配位置与相对基线的增长"""
+    try:
+        check_debug_token(request)
+        if limit < 1 or limit > 500:
+            raise HTTPException(status_code=400, detail="limit 取值范围为 1-500")
+        if group_by not in ('lineno', 'filename', 'traceback'):
+            raise HTTPException(status_code=400, detail="group_by 仅支持 lineno、filename 或 traceback")
+        report = await run_in_threadpool(build_memory_report)
+        report['tracemalloc'] = await run_in_threadpool(memory_tracer.report, limit, group_by)
+        return ApiResponse(
+            code=200,
+            message="获取成功",
+            data=report,
+            timestamp=int(time.time() * 1000)
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"获取内存报告失败: {e}")
+        raise HTTPException(status_code=500, detail=f"获取内存报告失败: {str(e)}")
+
+@app.post("/api/debug/memory/trace")
+async def start_memory_trace(request: Request, frames: int = 1):
+    """开启 tracemalloc 并记录基线快照（开启期间内存分配有额外开销）"""
+    try:
+        check_debug_token(request)
+        if frames < 1 or frames > 25:
+            raise HTTPException(status_code=400, detail="frames 取值范围为 1-25")
+        status = await run_in_threadpool(memory_tracer.start, frames)
+        logger.warning(f"已开启 tracemalloc 内存追踪 (frames={frames})")
+        return ApiResponse(
+            code=200,
+            message="内存追踪已开启",
+            data=status,
+            timestamp=int(time.time() * 1000)
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"开启内存追踪失败: {e}")
+        raise HTTPException(status_code=500, detail=f"开启内存追踪失败: {str(e)}")
+
+@app.delete("/api/debug/memory/trace")
+async def stop_memory_trace(request: Request):
+    """关闭 tracemalloc 并释放追踪数据"""
+    try:
+        check_debug_token(request)
+        status = memory_tracer.stop()
+        logger.info("已关闭 tracemalloc 内存追踪")
+        return ApiResponse(
+            code=200,
+            message="内存追踪已关闭",
+            data=status,
+            timestamp=int(time.time() * 1000)
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"关闭内存追踪失败: {e}")
+        raise HTTPException(status_code=500, detail=f"关闭内存追踪失败: {str(e)}")
+
+
 if __name__ == "__main__":
     import uvicorn
     
-    # 确保日志目录存在
-    import os
-    os.makedirs("logs", exist_ok=True)
-    
     # 启动服务
     uvicorn.run(
         "main:app",
         host="0.0.0.0",
         port=8080,
         reload=True,
-        log_level="info"
+        log_level=LOG_LEVEL.lower()
     )
@@ -116,7 +116,7 @@ $COMPOSE_CMD -f docker-compose.prod.yml ps
 # Test connectivity
 echo ""
 echo "🔍 Testing connectivity..."
-if curl -s -f http://localhost:8080/api/rules/statistics > /dev/null 2>&1; then
+if curl -s -f http://localhost:8080/api/health/live > /dev/null 2>&1; then
     echo "✅ Backend API is responding"
 else
     echo "⚠️  Backend API is not responding yet"
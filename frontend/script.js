@@ -21,6 +21,7 @@ console.info('API_BASE_URL =', API_BASE_URL);
 document.addEventListener('DOMContentLoaded', function() {
     loadStatistics();
     loadRuleSources();
+    connectRuleEvents();
     const addForm = document.getElementById('addRuleForm');
     if (addForm) addForm.addEventListener('submit', handleAddRule);
     // Bind domain query Enter key
@@ -35,6 +36,38 @@ document.addEventListener('DOMContentLoaded', function() {
     }
 });
 
+// ------------------ Rule update event stream ------------------
+// The backend pushes statistics, source status and refresh job progress over SSE,
+// so the page no longer needs to poll after add/remove/refresh actions.
+let ruleEventSource = null;
+let currentRuleSources = [];
+
+function connectRuleEvents() {
+    if (typeof EventSource === 'undefined') return;
+    ruleEventSource = new EventSource(`${API_BASE_URL}/rules/events`);
+    ruleEventSource.addEventListener('statistics', e => displayStatistics(JSON.parse(e.data)));
+    ruleEventSource.addEventListener('sources', e => displayRuleSources(JSON.parse(e.data)));
+    ruleEventSource.addEventListener('source', e => {
+        const s = JSON.parse(e.data);
+        const idx = currentRuleSources.findIndex(x => x.url === s.url);
+        if (idx === -1) return;
+        currentRuleSources[idx] = s;
+        displayRuleSources(currentRuleSources);
+    });
+    ruleEventSource.addEventListener('refresh', e => {
+        const job = JSON.parse(e.data);
+        if (job.status === 'completed') showMessage(`规则刷新完成 (${job.completed}/${job.total})`, 'success');
+        else if (job.status === 'completed_with_errors') showMessage(`规则刷新完成，${job.failed} 个规则源失败`, 'warning');
+        else if (job.status === 'failed') showMessage(job.error || '规则刷新失败', 'error');
+    });
+    // EventSource reconnects on its own; nothing to do on error besides logging
+    ruleEventSource.onerror = () => console.warn('rule events stream disconnected, retrying');
+}
+
+function ruleEventsConnected() {
+    return !!ruleEventSource && ruleEventSource.readyState === EventSource.OPEN;
+}
+
 async function loadRuleSources() {
     try {
         const resp = await fetch(`${API_BASE_URL}/rules/sources`);
@@ -47,6 +80,7 @@ async function loadRuleSources() {
 }
 
 function displayRuleSources(sources) {
+    currentRuleSources = sources || [];
     const el = document.getElementById('ruleSources');
     if (!el) return;
     if (!sources || sources.length === 0) { el.innerHTML = '<p class="no-result">暂无规则源</p>'; return; }
@@ -88,7 +122,7 @@ async function refreshOneRule(encodedUrl) {
         const j = await resp.json();
         if (j.code === 200) {
             showMessage('单个规则刷新已开始，稍后自动更新列表', 'success');
-            setTimeout(() => { loadRuleSources(); loadStatistics(); }, 3000);
+            if (!ruleEventsConnected()) setTimeout(() => { loadRuleSources(); loadStatistics(); }, 3000);
         } else showMessage(j.message || '刷新失败', 'error');
     } catch (e) { console.error('refreshOneRule', e); showMessage('无法连接后端，刷新失败', 'error'); }
 }
@@ -117,7 +151,7 @@ function removeRuleSource(url) {
     if (!confirm('确定要删除这个规则源吗？')) return;
     fetch(`${API_BASE_URL}/rules/sources?url=${encodeURIComponent(url)}`, { method: 'DELETE' })
         .then(r => r.json())
-        .then(j => { if (j.code === 200) { showMessage('规则源删除成功', 'success'); loadRuleSources(); loadStatistics(); } else showMessage(j.message || '删除失败', 'error'); })
+        .then(j => { if (j.code === 200) { showMessage('规则源删除成功', 'success'); if (!ruleEventsConnected()) { loadRuleSources(); loadStatistics(); } } else showMessage(j.message || '删除失败', 'error'); })
         .catch(e => { console.error('removeRuleSource', e); showMessage('网络错误', 'error'); });
 }
 
@@ -356,7 +390,7 @@ function toggleRuleUrl(i) {
     } 
 }
 
-async function handleAddRule(e) { if (e && e.preventDefault) e.preventDefault(); const name = (document.getElementById('ruleName') || {}).value || ''; const url = (document.getElementById('ruleUrl') || {}).value || ''; const enabled = !!(document.getElementById('ruleEnabled') || {}).checked; if (!name || !url) { showMessage('请填写完整信息', 'error'); return; } try { const resp = await fetch(`${API_BASE_URL}/rules/sources`, { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify({ name, url, enabled }) }); const j = await resp.json(); if (j.code === 200) { showMessage('规则源添加成功', 'success'); loadRuleSources(); loadStatistics(); } else showMessage(j.message || '添加失败', 'error'); } catch (e) { console.error('handleAddRule', e); showMessage('网络错误', 'error'); } }
+async function handleAddRule(e) { if (e && e.preventDefault) e.preventDefault(); const name = (document.getElementById('ruleName') || {}).value || ''; const url = (document.getElementById('ruleUrl') || {}).value || ''; const enabled = !!(document.getElementById('ruleEnabled') || {}).checked; if (!name || !url) { showMessage('请填写完整信息', 'error'); return; } try { const resp = await fetch(`${API_BASE_URL}/rules/sources`, { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify({ name, url, enabled }) }); const j = await resp.json(); if (j.code === 200) { showMessage('规则源添加成功', 'success'); if (!ruleEventsConnected()) { loadRuleSources(); loadStatistics(); } } else showMessage(j.message || '添加失败', 'error'); } catch (e) { console.error('handleAddRule', e); showMessage('网络错误', 'error'); } }
 
 function showMessage(msg, type = 'info') { const div = document.createElement('div'); div.className = `message message-${type}`; div.textContent = msg; div.style.cssText = 'position:fixed;top:20px;right:20px;padding:10px 14px;border-radius:8px;color:#fff;font-weight:600;z-index:10000;max-width:320px;'; switch (type) { case 'success': div.style.background = '#27ae60'; break; case 'error': div.style.background = '#e74c3c'; break; case 'warning': div.style.background = '#f39c12'; break; default: div.style.background = '#3498db'; } document.body.appendChild(div); setTimeout(() => { div.style.transition = 'opacity 0.3s'; div.style.opacity = 0; setTimeout(() => { if (div.parentNode) div.parentNode.removeChild(div); }, 300); }, 3000); }
 
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+规则解析性能基准
+对比旧的逐行解析实现与 main.parse_rules 的批量分类实现，输出每秒解析行数
+
+用法:
+    python3 scripts/testing/bench_parse_rules.py                 # 使用合成规则
+    python3 scripts/testing/bench_parse_rules.py rules.txt ...   # 使用实际规则文件
+"""
+
+import os
+import re
+import sys
+import time
+import random
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'backend-python')
+sys.path.insert(0, os.path.abspath(BACKEND_DIR))
+os.chdir(BACKEND_DIR)
+os.makedirs('logs', exist_ok=True)
+
+import main  # noqa: E402
+
+
+def legacy_is_valid_domain(domain: str) -> bool:
+    if not domain or not isinstance(domain, str):
+        return False
+    domain = domain.strip().lower()
+    if not domain:
+        return False
+    pattern = r'^[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
+    return (re.match(pattern, domain) and
+            not domain.startswith('.') and
+            not domain.endswith('.') and
+            '..' not in domain)
+
+
+def legacy_parse_rules(content: str) -> tuple:
+    """重构前的逐行解析实现，仅用于对比"""
+    domains, regexes, hosts = set(), set(), set()
+    rule_count = 0
+    for line in content.split('\n'):
+        line = line.strip()
+        if not line or line.startswith('#') or line.startswith('!'):
+            continue
+        try:
+            if line.startswith('||') and line.endswith('^'):
+                domain = line[2:-1].lower()
+                if legacy_is_valid_domain(domain):
+                    domains.add(domain)
+                    rule_count += 1
+            elif line.startswith('/') and line.endswith('/'):
+                try:
+                    regexes.add(re.compile(line[1:-1], re.IGNORECASE))
+                    rule_count += 1
+                except re.error:
+                    pass
+            elif ' ' in line:
+                parts = line.split()
+                if len(parts) >= 2:
+                    domain = parts[1].lower()
+                    if legacy_is_valid_domain(domain):
+                        hosts.add(domain)
+                        rule_count += 1
+            elif line.startswith('@@'):
+                continue
+            elif legacy_is_valid_domain(line):
+                domains.add(line.lower())
+                rule_count += 1
+        except Exception:
+            pass
+    return domains, regexes, hosts, rule_count
+
+
+def synthetic_content(lines: int = 200000) -> str:
+    """生成混合格式的规则内容"""
+    rnd = random.Random(42)
+    words = ['ads', 'track', 'cdn', 'metrics', 'pixel', 'img', 'static', 'api', 'log', 'stat']
+    tlds = ['com', 'net', 'org', 'cn', 'io']
+
+    def domain():
+        labels = [rnd.choice(words) + str(rnd.randint(0, 9999)) for _ in range(rnd.randint(1, 3))]
+        return '.'.join(labels) + '.' + rnd.choice(tlds)
+
+    out = ['! Title: synthetic', '! Expires: 4 days']
+    for _ in range(lines):
+        r = rnd.random()
+        if r < 0.45:
+            out.append(f'||{domain()}^')
+        elif r < 0.65:
+            out.append(f'0.0.0.0 {domain()}')
+        elif r < 0.75:
+            out.append(domain())
+        elif r < 0.80:
+            out.append(f'{domain()}##.ad-banner')
+        elif r < 0.85:
+            out.append(f'||{domain()}/ads/*$script')
+        elif r < 0.90:
+            out.append(f'@@||{domain()}^')
+        elif r < 0.95:
+            out.append(f'address=/{domain()}/0.0.0.0')
+        elif r < 0.99:
+            out.append(f'! comment {rnd.random()}')
+        else:
+            out.append(f'/^{rnd.choice(words)}[0-9]+\\./')
+    return '\n'.join(out)
+
+
+def bench(name: str, func, content: str, line_count: int, rounds: int = 3):
+    best = float('inf')
+    result = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = func(content)
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:<10} {best * 1000:9.1f} ms  {line_count / best:12,.0f} 行/秒  规则数: {result:,}")
+    return best
+
+
+def main_bench():
+    if len(sys.argv) > 1:
+        content = ''
+        for path in sys.argv[1:]:
+            with open(path, 'r', encoding='utf-8', errors='replace') as f:
+                content += f.read() + '\n'
+    else:
+        content = synthetic_content()
+
+    line_count = content.count('\n') + 1
+    print(f"共 {line_count:,} 行, {len(content) / 1024 / 1024:.1f} MB")
+    before = bench('旧实现', lambda c: legacy_parse_rules(c)[3], content, line_count)
+    after = bench('新实现', lambda c: main.parse_rules(None, c).rule_count, content, line_count)
+    print(f"加速比: {before / after:.2f}x")
+
+
+if __name__ == '__main__':
+    main_bench()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+查询结果序列化性能基准
+对比旧实现（pydantic 结果对象 + ApiResponse 校验 + jsonable_encoder + JSONResponse）
+与 main 中紧凑结果 + 快速 JSON 序列化的实现，输出每次查询的计算与序列化耗时
+
+用法:
+    python3 scripts/testing/bench_query_serialization.py
+"""
+
+import os
+import sys
+import time
+import random
+from typing import List, Optional
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'backend-python')
+sys.path.insert(0, os.path.abspath(BACKEND_DIR))
+os.chdir(BACKEND_DIR)
+os.makedirs('logs', exist_ok=True)
+
+import main  # noqa: E402
+from pydantic import BaseModel  # noqa: E402
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+
+
+class LegacyMatchedRule(BaseModel):
+    rule: str
+    rule_source: str
+    rule_source_url: str
+    rule_type: str
+
+
+class LegacyExceptionMatch(BaseModel):
+    rule: str
+    rule_type: str
+    overridden_rule: str
+    overridden_rule_type: str
+    rule_source: str
+    rule_source_url: str
+
+
+class LegacyDomainQueryResult(BaseModel):
+    domain: str
+    blocked: bool
+    matched_rules: List[LegacyMatchedRule] = []
+    exceptions: List[LegacyExceptionMatch] = []
+    matched_rule: Optional[str] = None
+    rule_source: Optional[str] = None
+    rule_type: Optional[str] = None
+    query_time: int
+    duration: int
+
+
+def legacy_evaluate_domain(domain: str) -> LegacyDomainQueryResult:
+    """重构前的 evaluate_domain：每个命中构造 pydantic 对象并立即解析规则源名称，仅用于对比"""
+    start_time = time.time()
+    result = LegacyDomainQueryResult(domain=domain, blocked=False, query_time=int(start_time * 1000), duration=0)
+    lower_domain = domain.lower()
+    labels = lower_domain.split('.')
+    suffixes = ['.'.join(labels[i:]) for i in range(len(labels))]
+    matched_by_type = {"domain": [], "hosts": [], "regex": []}
+    exceptions = []
+    for source_url, compiled in list(main.compiled_rules.items()):
+        blocks, overridden = compiled.evaluate(lower_domain, labels, suffixes, main.badfilter_rules)
+        if not blocks and not overridden:
+            continue
+        source_name = main.get_rule_source_name(source_url)
+        for rule, rule_type in blocks:
+            matched_by_type[rule_type].append(LegacyMatchedRule(
+                rule=rule, rule_source=source_name, rule_source_url=source_url, rule_type=rule_type
+            ))
+        for allow_rule, allow_type, block_rule, block_type in overridden:
+            exceptions.append(LegacyExceptionMatch(
+                rule=allow_rule, rule_type=allow_type,
+                overridden_rule=block_rule, overridden_rule_type=block_type,
+                rule_source=source_name, rule_source_url=source_url
+            ))
+    matched_rules = matched_by_type["domain"] + matched_by_type["hosts"] + matched_by_type["regex"]
+    result.exceptions = exceptions
+    result.matched_rules = matched_rules
+    result.blocked = len(matched_rules) > 0
+    if matched_rules:
+        result.matched_rule = matched_rules[0].rule
+        result.rule_source = matched_rules[0].rule_source
+        result.rule_type = matched_rules[0].rule_type
+    result.duration = int((time.time() - start_time) * 1000)
+    return result
+
+
+def legacy_render(message: str, data) -> bytes:
+    """接口返回 ApiResponse 时 FastAPI 的处理：模型校验、jsonable_encoder、JSONResponse 编码"""
+    response = main.ApiResponse(code=200, message=message, data=data, timestamp=int(time.time() * 1000))
+    return JSONResponse(jsonable_encoder(response)).body
+
+
+def build_index(sources: int = 4, hosts_per_source: int = 1000):
+    rnd = random.Random(42)
+    domains = [f"ads{i}.track{i % 50}.com" for i in range(hosts_per_source * 3)]
+    for s in range(sources):
+        url = f"https://example.com/list{s}.txt"
+        main.register_rule_source(main.RuleSource(url=url, name=f"规则源 {s}"))
+        lines = [f"||track{i}.com^" for i in range(s, 50, 2)]
+        lines += [f"0.0.0.0 {d}" for d in rnd.sample(domains, hosts_per_source)]
+        lines += ["@@||ads7.track7.com^", "/^ads1[0-9]\\./"]
+        main.publish_compiled_rules(url, main.parse_rules(None, '\n'.join(lines)))
+    return domains + [f"x{i}.clean.org" for i in range(len(domains) // 4)]
+
+
+def bench(name: str, func, count: int, unit: str, rounds: int = 3) -> float:
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    per = best / count * 1e6
+    print(f"{name:<24} {per:10.1f} µs/{unit}")
+    return per
+
+
+def main_bench():
+    domains = build_index()
+    rnd = random.Random(7)
+    queries = [rnd.choice(domains) for _ in range(5000)]
+    bulks = [queries[i:i + 100] for i in range(0, 2000, 100)]
+    legacy_results = [legacy_evaluate_domain(d) for d in queries]
+    results = [main.evaluate_domain(d) for d in queries]
+    print(f"JSON 序列化: {'orjson' if main.orjson is not None else 'json (未安装 orjson)'}")
+    print(f"规则源 {len(main.compiled_rules)} 个, 查询 {len(queries):,} 次, 拦截比例 "
+          f"{sum(r.blocked for r in results) / len(results):.0%}")
+
+    print("\n计算（未命中缓存的查询）")
+    before = bench('旧实现', lambda: [legacy_evaluate_domain(d) for d in queries], len(queries), '查询')
+    after = bench('新实现', lambda: [main.evaluate_domain(d) for d in queries], len(queries), '查询')
+    print(f"加速比: {before / after:.2f}x")
+
+    print("\n序列化（单域名查询响应）")
+    before = bench('旧实现', lambda: [legacy_render("查询成功", r) for r in legacy_results], len(queries), '响应')
+    after = bench('新实现', lambda: [main.api_json_response("查询成功", r.to_pairs()).body for r in results],
+                  len(queries), '响应')
+    print(f"加速比: {before / after:.2f}x")
+
+    print("\n序列化（100 个域名的批量查询响应）")
+    legacy_bulks = [legacy_results[i:i + 100] for i in range(0, 2000, 100)]
+    result_bulks = [results[i:i + 100] for i in range(0, 2000, 100)]
+    before = bench('旧实现', lambda: [legacy_render("批量查询成功", b) for b in legacy_bulks], len(bulks), '响应')
+    after = bench('新实现', lambda: [main.api_json_response("批量查询成功", [r.to_dict() for r in b]).body
+                                   for b in result_bulks], len(bulks), '响应')
+    print(f"加速比: {before / after:.2f}x")
+
+
+if __name__ == '__main__':
+    main_bench()
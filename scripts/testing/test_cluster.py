@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+主从索引分发测试
+在本机启动一个规则文件服务器、一个主节点和两个从节点（均为独立进程），验证：
+从节点首次拉取全量快照、主节点刷新后拉取增量、删除规则源后同步移除、
+主节点重启后改为拉取全量快照，以及各节点提供服务的索引版本与指纹一致；
+未设置 CLUSTER_TOKEN 时拒绝启动，签名无效的快照不会被应用
+
+用法:
+    python3 scripts/testing/test_cluster.py [--base-port 18080]
+"""
+
+import argparse
+import gzip
+import http.server
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+BACKEND_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'backend-python'))
+TOKEN = 'cluster-test-token'
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_rules(directory: str) -> http.server.ThreadingHTTPServer:
+    handler = lambda *args, **kwargs: QuietHandler(*args, directory=directory, **kwargs)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_node(name: str, port: int, workdir: str, env: dict) -> subprocess.Popen:
+    node_dir = os.path.join(workdir, name)
+    os.makedirs(node_dir, exist_ok=True)
+    env = {
+        **os.environ,
+        'RULES_DIR': os.path.join(node_dir, 'rules'),
+        'ANALYTICS_FILE': os.path.join(node_dir, 'analytics.json'),
+        'LOG_FILE': os.path.join(node_dir, 'backend.log'),
+        'CLUSTER_TOKEN': TOKEN,
+        'CLUSTER_NODE_ID': name,
+        'WARMUP_ENABLED': 'false',
+        **env
+    }
+    return subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'main:app', '--host', '127.0.0.1', '--port', str(port), '--log-level', 'warning'],
+        cwd=BACKEND_DIR, env=env
+    )
+
+
+class RogueLeader(http.server.BaseHTTPRequestHandler):
+    """冒充主节点，返回签名错误的快照"""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.startswith('/api/cluster/manifest'):
+            body = json.dumps({'code': 200, 'data': {'epoch': 'rogue', 'generation': 1}}).encode()
+            headers = {'Content-Type': 'application/json'}
+        else:
+            body = gzip.compress(json.dumps({'version': 1, 'base': None}).encode())
+            headers = {'X-Cluster-Signature': '0' * 64}
+        self.send_response(200)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def api(port: int, path: str, method: str = 'GET', **kwargs) -> dict:
+    response = requests.request(method, f"http://127.0.0.1:{port}/api{path}", timeout=10, **kwargs)
+    response.raise_for_status()
+    return response.json()['data']
+
+
+def wait_for(description: str, predicate, timeout: float = 30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if predicate():
+                print(f"✅ {description}")
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.3)
+    raise AssertionError(f"超时: {description}")
+
+
+def blocked(port: int, domain: str) -> bool:
+    response = requests.get(f"http://127.0.0.1:{port}/api/query/domain", params={'domain': domain}, timeout=10)
+    response.raise_for_status()
+    return dict(response.json()['data'])['blocked']
+
+
+def in_sync(leader: int, followers: list) -> bool:
+    expected = api(leader, '/cluster')['fingerprint']
+    states = [api(port, '/cluster') for port in followers]
+    return all(s['ready'] and s['fingerprint'] == expected and s['follower']['consistent'] for s in states)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='主从索引分发测试')
+    parser.add_argument('--base-port', type=int, default=18080)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='cluster-test-')
+    www = os.path.join(workdir, 'www')
+    os.makedirs(www)
+    with open(os.path.join(www, 'a.txt'), 'w') as f:
+        f.write('||ads.example.com^\n||tracker.example.net^\n@@||ok.ads.example.com^\n'
+                '||cdn.*.example.io^\n/^beacon[0-9]+\\./\n|exact.example.com^\n')
+    with open(os.path.join(www, 'b.txt'), 'w') as f:
+        f.write('0.0.0.0 telemetry.example.org\n')
+    server = serve_rules(www)
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    config = os.path.join(workdir, 'rule_sources.json')
+    with open(config, 'w') as f:
+        json.dump([
+            {'url': f"{base}/a.txt", 'name': 'List A'},
+            {'url': f"{base}/b.txt", 'name': 'List B'}
+        ], f)
+
+    leader_port = args.base_port
+    follower_ports = [args.base_port + 1, args.base_port + 2]
+    leader_env = {'CLUSTER_ROLE': 'leader', 'RULE_SOURCES_CONFIG_FILE': config}
+    follower_env = {
+        'CLUSTER_ROLE': 'follower',
+        'CLUSTER_LEADER_URL': f"http://127.0.0.1:{leader_port}",
+        'CLUSTER_POLL_INTERVAL': '0.5'
+    }
+    nodes = {'leader': start_node('leader', leader_port, workdir, leader_env)}
+    for i, port in enumerate(follower_ports, 1):
+        nodes[f'follower{i}'] = start_node(f'follower{i}', port, workdir, follower_env)
+
+    try:
+        wait_for("主节点加载全部规则源", lambda: all(
+            source['ruleCount'] > 0 for source in api(leader_port, '/rules/sources')
+        ))
+        wait_for("从节点拉取全量快照并与主节点一致", lambda: in_sync(leader_port, follower_ports))
+        probes = ['x.ads.example.com', 'ok.ads.example.com', 'cdn.eu.example.io', 'beacon42.example.com',
+                  'exact.example.com', 'sub.exact.example.com', 'telemetry.example.org']
+        expected = [blocked(leader_port, domain) for domain in probes]
+        assert expected == [True, False, True, True, True, False, True], expected
+        for port in follower_ports:
+            assert [blocked(port, domain) for domain in probes] == expected
+            follower = api(port, '/cluster')['follower']
+            assert follower['full'] >= 1, follower
+        print("✅ 从节点查询结果与主节点相同")
+
+        response = requests.post(f"http://127.0.0.1:{follower_ports[0]}/api/rules/refresh", timeout=10)
+        assert response.status_code == 409, response.status_code
+        response = requests.get(f"http://127.0.0.1:{leader_port}/api/cluster/snapshot", timeout=10)
+        assert response.status_code == 401, response.status_code
+        print("✅ 从节点拒绝修改规则源，主节点快照需要令牌")
+
+        with open(os.path.join(www, 'a.txt'), 'a') as f:
+            f.write('||new.example.com^\n')
+        api(leader_port, '/rules/refresh_one', 'POST', params={'url': f"{base}/a.txt"})
+        wait_for("从节点通过增量获得新规则", lambda: all(blocked(port, 'new.example.com') for port in follower_ports))
+        for port in follower_ports:
+            follower = api(port, '/cluster')['follower']
+            assert follower['delta'] >= 1, follower
+        wait_for("增量应用后版本一致", lambda: in_sync(leader_port, follower_ports))
+
+        api(leader_port, '/rules/sources', 'DELETE', params={'url': f"{base}/b.txt"})
+        wait_for("删除规则源后从节点同步移除",
+                 lambda: not any(blocked(port, 'telemetry.example.org') for port in follower_ports))
+        wait_for("主节点记录了所有从节点", lambda: all(
+            f['inSync'] for f in api(leader_port, '/cluster')['leader']['followers']
+        ) and len(api(leader_port, '/cluster')['leader']['followers']) == len(follower_ports))
+
+        nodes['leader'].terminate()
+        nodes['leader'].wait()
+        nodes['leader'] = start_node('leader', leader_port, workdir, leader_env)
+        full_before = [api(port, '/cluster')['follower']['full'] for port in follower_ports]
+        wait_for("主节点重启后从节点改为拉取全量快照", lambda: all(
+            api(port, '/cluster')['follower']['full'] > before for port, before in zip(follower_ports, full_before)
+        ))
+        wait_for("重启后版本一致", lambda: in_sync(leader_port, follower_ports))
+
+        nodes['no-token'] = start_node('no-token', args.base_port + 3, workdir,
+                                       {**leader_env, 'CLUSTER_TOKEN': ''})
+        assert nodes['no-token'].wait(timeout=30) != 0
+        print("✅ 未设置 CLUSTER_TOKEN 时拒绝启动")
+
+        rogue = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RogueLeader)
+        threading.Thread(target=rogue.serve_forever, daemon=True).start()
+        port = args.base_port + 4
+        nodes['victim'] = start_node('victim', port, workdir, {
+            **follower_env, 'CLUSTER_LEADER_URL': f"http://127.0.0.1:{rogue.server_address[1]}"
+        })
+        wait_for("签名无效的快照被拒绝", lambda: '签名' in (api(port, '/cluster')['follower']['lastError'] or ''))
+        assert not api(port, '/cluster')['ready']
+        rogue.shutdown()
+        print("🎉 主从索引分发测试通过")
+    finally:
+        for process in nodes.values():
+            process.terminate()
+        for process in nodes.values():
+            process.wait()
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
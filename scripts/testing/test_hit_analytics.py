@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+命中统计分片测试
+验证记录会分散到多个分片（单线程与多线程都是），合并后的计数与实际记录数一致
+
+用法:
+    python3 scripts/testing/test_hit_analytics.py
+"""
+
+import os
+import sys
+import threading
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'backend-python')
+sys.path.insert(0, os.path.abspath(BACKEND_DIR))
+os.chdir(BACKEND_DIR)
+os.makedirs('logs', exist_ok=True)
+
+import main  # noqa: E402
+
+
+def make_result(domain: str, blocked: bool) -> main.DomainQueryResult:
+    matches = (('||example.com^', 'https://example.com/list.txt', 'domain'),) if blocked else ()
+    return main.DomainQueryResult(domain, matches, (), 0, 0)
+
+
+def used_shards(analytics: main.HitAnalytics) -> int:
+    return sum(1 for shard in analytics._shards if shard.queries)
+
+
+def test_single_thread_uses_all_shards():
+    analytics = main.HitAnalytics(shards=4, sample_rate=1.0)
+    for i in range(100):
+        analytics.record(make_result(f"d{i}.example.com", i % 2 == 0))
+    assert used_shards(analytics) == 4, used_shards(analytics)
+    report = analytics.report(5)
+    assert report['totalQueries'] == 100 and report['blockedQueries'] == 50, report
+    print("✅ 单线程记录分散到全部分片")
+
+
+def test_threads_use_multiple_shards():
+    analytics = main.HitAnalytics(shards=4, sample_rate=1.0)
+
+    def worker():
+        for i in range(250):
+            analytics.record(make_result(f"t{i}.example.com", True))
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert used_shards(analytics) > 1, used_shards(analytics)
+    assert analytics.report(5)['totalQueries'] == 1000
+    print("✅ 多线程记录使用多个分片，合并计数准确")
+
+
+if __name__ == "__main__":
+    test_single_thread_uses_all_shards()
+    test_threads_use_multiple_shards()
+    print("🎉 All tests passed!")
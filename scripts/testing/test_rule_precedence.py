@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+规则优先级测试
+直接解析并发布规则（不启动服务），验证同一规则源内 @@ 覆盖拦截、$important 覆盖 @@、
+@@...$important 覆盖 $important，$badfilter 跨规则源禁用规则（开启规则压缩时也一样），
+以及通配符与 hosts 规则在同一次后缀遍历中命中
+
+用法:
+    python3 scripts/testing/test_rule_precedence.py
+"""
+
+import os
+import sys
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'backend-python')
+sys.path.insert(0, os.path.abspath(BACKEND_DIR))
+os.chdir(BACKEND_DIR)
+os.makedirs('logs', exist_ok=True)
+
+import main  # noqa: E402
+
+
+def publish(sources: dict):
+    """按 {URL: 规则内容} 替换全部已发布的规则源"""
+    updates = {url: (None, None) for url in main.compiled_rules}
+    for url, content in sources.items():
+        source = main.RuleSource(url=url, name=url)
+        updates[url] = (main.parse_rules(source, content), None)
+    main.publish_compiled_batch(updates)
+
+
+def query(domain: str):
+    result = main.evaluate_domain(domain)
+    return [rule for rule, _, _ in result.matches], [(allow, rule) for allow, _, rule, _, _ in result.exceptions]
+
+
+def test_allow_overrides_block():
+    publish({'a': '||ads.example.com^\n@@||ok.ads.example.com^\n'})
+    assert query('x.ads.example.com') == (['ads.example.com'], []), query('x.ads.example.com')
+    blocked, exceptions = query('ok.ads.example.com')
+    assert blocked == [] and exceptions == [('@@||ok.ads.example.com^', 'ads.example.com')], exceptions
+    print("✅ 同源 @@ 规则覆盖拦截规则")
+
+
+def test_allow_only_applies_to_its_source():
+    publish({'a': '||ads.example.com^\n', 'b': '@@||ads.example.com^\n'})
+    assert query('ads.example.com')[0] == ['ads.example.com'], query('ads.example.com')
+    print("✅ @@ 规则只覆盖本规则源的拦截")
+
+
+def test_important_overrides_allow():
+    publish({'a': '||ads.example.com^$important\n@@||ads.example.com^\n'
+                  '||cdn.*.example.io^$important\n@@||cdn.eu.example.io^\n'})
+    assert query('ads.example.com')[0] == ['||ads.example.com^$important'], query('ads.example.com')
+    assert query('cdn.eu.example.io')[0] == ['||cdn.*.example.io^$important'], query('cdn.eu.example.io')
+    print("✅ $important 拦截覆盖 @@ 规则（含通配符）")
+
+
+def test_important_allow_overrides_important():
+    publish({'a': '||ads.example.com^$important\n@@||ok.ads.example.com^$important\n'
+                  '0.0.0.0 ok.ads.example.com\n'})
+    blocked, exceptions = query('ok.ads.example.com')
+    assert blocked == [], blocked
+    assert {rule for _, rule in exceptions} == {'||ads.example.com^$important', 'ok.ads.example.com'}, exceptions
+    print("✅ @@...$important 覆盖 $important 与 hosts 拦截")
+
+
+def test_badfilter_across_sources():
+    publish({
+        'a': '||ads.example.com^\n||cdn.*.example.io^\n/^beacon[0-9]+\\./\n0.0.0.0 telemetry.example.org\n',
+        'b': '||ads.example.com^$badfilter\n||tracker.example.net^\n'
+    })
+    assert query('ads.example.com')[0] == [], query('ads.example.com')
+    assert query('cdn.eu.example.io')[0] == ['||cdn.*.example.io^'], query('cdn.eu.example.io')
+    assert query('beacon42.example.com')[0] == ['^beacon[0-9]+\\.'], query('beacon42.example.com')
+    assert query('x.telemetry.example.org')[0] == ['telemetry.example.org'], query('x.telemetry.example.org')
+    publish({'a': '||ads.example.com^\n', 'b': '||tracker.example.net^\n'})
+    assert query('ads.example.com')[0] == ['ads.example.com'], query('ads.example.com')
+    print("✅ $badfilter 禁用其他规则源的规则，移除后规则恢复生效")
+
+
+def test_compaction_keeps_badfilter_verdicts():
+    main.RULE_COMPACTION = True
+    try:
+        publish({'b': '||example.com^$badfilter\n'})
+        publish({'b': '||example.com^$badfilter\n', 'a': '||example.com^\n||ads.example.com^\n|x.example.com^\n'})
+        assert main.compiled_rules['a'].compaction['removed'] == 0, main.compiled_rules['a'].compaction
+        assert query('ads.example.com')[0] == ['ads.example.com'], query('ads.example.com')
+        assert query('x.example.com')[0] == ['|x.example.com^'], query('x.example.com')
+        assert query('example.com')[0] == [], query('example.com')
+        stale = main.CompiledRules()
+        stale.suffix = {'example.com', 'ads.example.com'}
+        stale.compact()
+        assert stale.covering == {'example.com'}, stale.covering
+    finally:
+        main.RULE_COMPACTION = False
+    print("✅ 规则压缩不使用被其他规则源 $badfilter 禁用的祖先规则，并记录起覆盖作用的祖先")
+
+
+def test_single_walk_collects_all_kinds():
+    compiled = main.parse_rules(None, '||example.com^\n||cdn.*.example.io^\n0.0.0.0 ads.example.io\n'
+                                      '@@||ok.example.io^$important\n')
+    labels = 'cdn.ads.example.io'.split('.')
+    suffixes = ['.'.join(labels[i:]) for i in range(len(labels))]
+    found, host_rule = compiled.match_domain('cdn.ads.example.io', labels, suffixes)
+    assert found[main.RULE_BLOCK] == '||cdn.*.example.io^' and host_rule == 'ads.example.io', (found, host_rule)
+    print("✅ 一次后缀遍历同时命中通配符与 hosts 规则")
+
+
+if __name__ == "__main__":
+    test_allow_overrides_block()
+    test_allow_only_applies_to_its_source()
+    test_important_overrides_allow()
+    test_important_allow_overrides_important()
+    test_badfilter_across_sources()
+    test_compaction_keeps_badfilter_verdicts()
+    test_single_walk_collects_all_kinds()
+    print("🎉 All tests passed!")
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+共享查询缓存测试
+在进程内启动一个最小的 Redis 协议（RESP2）替身服务器，验证 SharedQueryCache：
+写入经后台线程批量提交后可以读回、AUTH 失败与无法解析的响应不会让写入线程退出、
+服务器不可用时读写直接跳过，恢复后继续工作
+
+用法:
+    python3 scripts/testing/test_shared_cache.py
+"""
+
+import os
+import socketserver
+import sys
+import threading
+import time
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'backend-python')
+sys.path.insert(0, os.path.abspath(BACKEND_DIR))
+os.chdir(BACKEND_DIR)
+os.makedirs('logs', exist_ok=True)
+
+import main  # noqa: E402
+
+
+class RespStandIn(socketserver.ThreadingTCPServer):
+    """支持 AUTH/SELECT/PING/GET/SET [EX] 的替身服务器；password 为要求的密码，garbage 为真时返回无法解析的响应"""
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, password: str = ''):
+        super().__init__(('127.0.0.1', 0), RespHandler)
+        self.password = password
+        self.garbage = False
+        self.store = {}
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        auth = f":{self.password}@" if self.password else ''
+        return f"redis://{auth}127.0.0.1:{self.server_address[1]}/1"
+
+
+class RespHandler(socketserver.StreamRequestHandler):
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:-2])):
+            size = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(size + 2)[:-2])
+        return args
+
+    def handle(self):
+        server = self.server
+        authed = not server.password
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            cmd = args[0].upper()
+            if server.garbage:
+                out = b':not-a-number\r\n'
+            elif cmd == b'AUTH':
+                authed = args[1].decode() == server.password
+                out = b'+OK\r\n' if authed else b'-WRONGPASS invalid password\r\n'
+            elif not authed:
+                out = b'-NOAUTH Authentication required\r\n'
+            elif cmd in (b'SELECT', b'PING'):
+                out = b'+OK\r\n'
+            elif cmd == b'SET':
+                expires = time.time() + int(args[4]) if len(args) > 4 else None
+                server.store[args[1]] = (args[2], expires)
+                out = b'+OK\r\n'
+            elif cmd == b'GET':
+                value, expires = server.store.get(args[1], (None, None))
+                if value is None or (expires and expires < time.time()):
+                    out = b'$-1\r\n'
+                else:
+                    out = b'$%d\r\n%s\r\n' % (len(value), value)
+            else:
+                out = b'-ERR unknown command\r\n'
+            self.wfile.write(out)
+
+
+def make_result(domain: str) -> main.DomainQueryResult:
+    return main.DomainQueryResult(domain, (('||example.com^', 'https://example.com/list.txt', 'domain'),), (), 1, 0)
+
+
+def wait_for(predicate, timeout: float = 5) -> bool:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_round_trip():
+    server = RespStandIn(password='secret')
+    cache = main.SharedQueryCache(server.url)
+    assert cache.get('fp', 'a.example.com') is None
+    cache.put('fp', 'a.example.com', make_result('a.example.com'))
+    assert wait_for(lambda: cache.writes == 1), cache.stats()
+    result = cache.get('fp', 'a.example.com')
+    assert result is not None and result.blocked and result.matched_rule == '||example.com^'
+    assert cache.get('other', 'a.example.com') is None
+    print("✅ 写入后可按指纹读回，不同指纹互不可见")
+    server.shutdown()
+
+
+def test_auth_failure_keeps_writer_alive():
+    server = RespStandIn(password='secret')
+    url = server.url.replace(':secret@', ':wrong@')
+    cache = main.SharedQueryCache(url)
+    cache.put('fp', 'a.example.com', make_result('a.example.com'))
+    assert wait_for(lambda: cache.errors >= 1), cache.stats()
+    assert cache._writer.is_alive() and not cache.available()
+    assert cache.get('fp', 'a.example.com') is None
+    # 修正密码后，重试间隔过去即可恢复写入
+    cache._password = 'secret'
+    cache._down_until = 0.0
+    cache.put('fp', 'b.example.com', make_result('b.example.com'))
+    assert wait_for(lambda: cache.writes == 1), cache.stats()
+    print("✅ AUTH 失败时写入线程继续运行并在恢复后写入")
+    server.shutdown()
+
+
+def test_garbage_reply_keeps_writer_alive():
+    server = RespStandIn()
+    cache = main.SharedQueryCache(server.url)
+    server.garbage = True
+    assert cache.get('fp', 'a.example.com') is None and cache.errors == 1
+    cache._down_until = 0.0
+    cache.put('fp', 'a.example.com', make_result('a.example.com'))
+    assert wait_for(lambda: cache.errors >= 2), cache.stats()
+    assert cache._writer.is_alive()
+    server.garbage = False
+    cache._down_until = 0.0
+    cache.put('fp', 'c.example.com', make_result('c.example.com'))
+    assert wait_for(lambda: cache.writes == 1), cache.stats()
+    print("✅ 无法解析的响应不会让写入线程退出")
+    server.shutdown()
+
+
+def test_server_down():
+    server = RespStandIn()
+    url = server.url
+    server.shutdown()
+    server.server_close()
+    cache = main.SharedQueryCache(url)
+    assert cache.get('fp', 'a.example.com') is None and not cache.available()
+    cache.put('fp', 'a.example.com', make_result('a.example.com'))
+    assert cache._pending.qsize() == 0
+    print("✅ 服务器不可用时读写直接跳过")
+
+
+if __name__ == "__main__":
+    test_round_trip()
+    test_auth_failure_keeps_writer_alive()
+    test_garbage_reply_keeps_writer_alive()
+    test_server_down()
+    print("🎉 All tests passed!")
@@ -72,7 +72,7 @@ echo "🔍 检查后端API..."
 max_attempts=30
 attempt=1
 while [ $attempt -le $max_attempts ]; do
-    if curl -s -f http://localhost:8080/api/rules/statistics > /dev/null 2>&1; then
+    if curl -s -f http://localhost:8080/api/health/live > /dev/null 2>&1; then
         echo "✅ 后端API启动成功"
         break
     fi
@@ -49,12 +49,12 @@ echo "⏳ 等待后端服务启动..."
 sleep 5
 
 # 检查后端服务是否启动成功
-if curl -s http://localhost:8080/api/rules/statistics > /dev/null; then
+if curl -s http://localhost:8080/api/health/live > /dev/null; then
     echo "✅ 后端服务启动成功: http://localhost:8080/api"
 else
     echo "❌ 后端服务启动失败，正在重试..."
     sleep 5
-    if curl -s http://localhost:8080/api/rules/statistics > /dev/null; then
+    if curl -s http://localhost:8080/api/health/live > /dev/null; then
         echo "✅ 后端服务启动成功: http://localhost:8080/api"
     else
         echo "❌ 后端服务启动失败，请查看日志文件"